@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+bench.py - End-to-end benchmarks for ghe sub-commands
+
+usage: bench.py [-h] [-repos INT] [-batch INT] [-latency SECONDS]
+                [-conflicts INT] [-import-seconds FLOAT] [-drift FLOAT]
+                [-orgs INT] [-only NAME] [-- ARGS ...]
+
+Runs ghe-migrate and ghe-org-diff as sub-processes against the local mock
+GitHub API (mockserver.py) and the fake SSH appliance (mockssh.py), then
+reports the wall time, API request counts, SSH commands and peak RSS of each
+run. Any arguments after `--` are passed on to the ghe-migrate run. With
+-orgs above 1, ghe-migrate moves that many source organizations in one run
+through an -orgs mapping file.
+
+The fake appliance authenticates with public keys, so a throwaway ssh-agent
+holding a generated key is started for the duration of the run.
+"""
+
+import argparse, json, os, re, shutil, subprocess, sys, tempfile, time
+
+import paramiko
+import requests
+
+from mockserver import MockServer, MockState
+from mockssh import MockSSHServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+COMMANDS = os.path.join(ROOT, 'ghe', 'commands')
+
+
+class SSHAgent(object):
+    """ A private ssh-agent holding a freshly generated key. """
+
+    def __init__(self):
+        """ Start the agent and add the key. """
+
+        self.dir = tempfile.mkdtemp(prefix='ghe-bench-')
+        key = os.path.join(self.dir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key)
+
+        out = subprocess.check_output(['ssh-agent', '-s']).decode('utf-8')
+        self.env = dict(re.findall(r'(SSH_AUTH_SOCK|SSH_AGENT_PID)=([^;]+);',
+                                   out))
+
+        env = os.environ.copy()
+        env.update(self.env)
+        subprocess.check_call(['ssh-add', '-q', key], env=env)
+
+    def close(self):
+        """ Stop the agent. """
+
+        os.kill(int(self.env['SSH_AGENT_PID']), 15)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def run(name, cmd, env, http, ssh):
+    """ Run one command and return its measurements. """
+
+    requests.post('%s/_reset' % http.url)
+    ssh.commands = 0
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.stdout.read()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+
+    stats = requests.get('%s/_stats' % http.url).json()
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    return {
+        'name': name,
+        'status': os.WEXITSTATUS(status),
+        'seconds': elapsed,
+        'requests': stats,
+        'ssh_commands': ssh.commands,
+        'peak_rss': rss,
+        'output': output.decode('utf-8', 'replace')
+    }
+
+def report(result, verbose=False):
+    """ Print the measurements of one run. """
+
+    print('%s' % result['name'])
+    print('  exit status:   %d' % result['status'])
+    print('  wall time:     %.2fs' % result['seconds'])
+    print('  peak RSS:      %.1fMB' % (result['peak_rss'] / 1024.0 / 1024.0))
+    print('  ssh commands:  %d' % result['ssh_commands'])
+    print('  api requests:  %d' % sum(result['requests'].values()))
+    for endpoint, count in sorted(result['requests'].items()):
+        print('    %-28s %d' % (endpoint, count))
+
+    if verbose or result['status']:
+        print('  output:')
+        for line in result['output'].splitlines()[-40:]:
+            print('    %s' % line)
+    print('')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end benchmarks for ghe sub-commands.'
+    )
+    parser.add_argument('-repos', type=int, default=1000, metavar='INT',
+        help='number of repos in the generated organizations (default: 1000)')
+    parser.add_argument('-batch', type=int, default=100, metavar='INT',
+        help='ghe-migrate batch size (default: 100)')
+    parser.add_argument('-latency', type=float, default=0.0,
+        metavar='SECONDS', help='average latency added to API requests')
+    parser.add_argument('-conflicts', type=int, default=0, metavar='INT',
+        help='user conflicts reported per migration')
+    parser.add_argument('-import-seconds', type=float, default=0.0,
+        metavar='FLOAT', help='time each `ghe-migrator import` takes')
+    parser.add_argument('-drift', type=float, default=0.01, metavar='FLOAT',
+        help='fraction of destination repos with a different head')
+    parser.add_argument('-orgs', type=int, default=1, metavar='INT',
+        help='source organizations migrated by ghe-migrate (default: 1)')
+    parser.add_argument('-only', choices=['migrate', 'org-diff'],
+        help='run a single benchmark')
+    parser.add_argument('-json', action='store_true',
+        help='print the results as JSON')
+    parser.add_argument('-verbose', action='store_true',
+        help='show the output of each command')
+
+    args, extra = parser.parse_known_args()
+    extra = [a for a in extra if a != '--']
+
+    http = MockServer(MockState(
+        org='source-org',
+        dest='dest-org',
+        repos=args.repos,
+        latency=args.latency,
+        drift=args.drift,
+        rate_limit=10 ** 6
+    ))
+    for i in range(2, args.orgs + 1):
+        http.state.add_org('source-org-%d' % i, args.repos)
+    http.start()
+    ssh = MockSSHServer(env={
+        'MOCK_CONFLICTS': str(args.conflicts),
+        'MOCK_IMPORT_SECONDS': str(args.import_seconds)
+    }).start()
+    agent = SSHAgent()
+
+    env = os.environ.copy()
+    env.update(agent.env)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env.update({
+        'ghe-host': '127.0.0.1',
+        'ghe-ssh-port': str(ssh.port),
+        'ghe-ssh-user': 'admin',
+        'ghe-user': 'ghe-admin',
+        'ghe-token': 'ghe-token',
+        'gh-token': 'gh-token',
+        'gh-api-url': http.url
+    })
+
+    orgs = ['source-org'] + [
+        'source-org-%d' % i for i in range(2, args.orgs + 1)
+    ]
+    if len(orgs) > 1:
+        target = ['-orgs', os.path.join(ssh.root, 'orgs.csv')]
+        with open(target[1], 'w') as f:
+            f.writelines('%s,dest-org\n' % org for org in orgs)
+    else:
+        target = ['source-org', 'dest-org', '-all']
+
+    results = []
+    try:
+        if args.only in (None, 'migrate'):
+            results.append(run('migrate %d repos' % (args.repos * len(orgs)), [
+                sys.executable, os.path.join(COMMANDS, 'ghe-migrate.py'),
+                '-resolve-all', '-batch', str(args.batch)
+            ] + target + extra, env, http, ssh))
+
+        if args.only in (None, 'org-diff'):
+            results.append(run('org-diff %d repos' % args.repos, [
+                sys.executable, os.path.join(COMMANDS, 'ghe-org-diff.py'),
+                'source-org', 'dest-org', '-ghe-host', http.url
+            ], env, http, ssh))
+    finally:
+        agent.close()
+        ssh.close()
+        http.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for result in results:
+            report(result, args.verbose)
+
+    sys.exit(max(r['status'] for r in results) if results else 0)
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+"""
+mockserver.py - Local stand-in for the GitHub.com and GHE HTTP endpoints
+
+usage: mockserver.py [-h] [-port PORT] [-org ORG] [-dest ORG] [-repos INT]
+                     [-latency SECONDS] [-rate-limit INT] [-fail-rate FLOAT]
+                     [-export-polls INT] [-export-fail-rate FLOAT]
+
+Serves the REST endpoints used by ghe-migrate and ghe-org-diff (organization
+repo listings, migrations, commits) plus the stafftools forms used by
+ghe-delete-user and ghe-reset-user-email. GitHub Enterprise paths are served
+under the /api/v3 prefix from the same state.
+
+Request counts per endpoint are available as JSON from /_stats and can be
+cleared with a POST to /_reset.
+"""
+
+import argparse, hashlib, json, random, re, threading, time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+
+class MockState(object):
+    """ Organizations, migrations and counters shared by all requests. """
+
+    def __init__(self, **kwargs):
+        """ Initial setup. """
+
+        self.latency = kwargs.get('latency', 0.0)
+        self.rate_limit = kwargs.get('rate_limit', 5000)
+        self.rate_window = kwargs.get('rate_window', 3600)
+        self.fail_rate = kwargs.get('fail_rate', 0.0)
+        self.export_polls = kwargs.get('export_polls', 1)
+        self.export_fail_rate = kwargs.get('export_fail_rate', 0.0)
+        self.drift = kwargs.get('drift', 0.0)
+
+        self.lock = threading.Lock()
+        self.orgs = {}
+        self.index = {}
+        self.migrations = {}
+        self.users = {}
+        self.limits = {}
+        self.stats = {}
+
+        org = kwargs.get('org', 'source-org')
+        dest = kwargs.get('dest', 'dest-org')
+        self.add_org(org, kwargs.get('repos', 1000))
+        self.add_org(dest, kwargs.get('repos', 1000), like=org)
+
+        for i in range(kwargs.get('users', 100)):
+            login = 'user%d' % i
+            self.users[login] = {'login': login, 'emails': []}
+
+    def add_org(self, org, count, like=None):
+        """ Create an organization with `count` generated repositories. """
+
+        rand = random.Random(org if like is None else like)
+        repos = []
+        for i in range(count):
+            name = 'repo-%05d' % i
+            sha = hashlib.sha1(name.encode('utf-8')).hexdigest()
+            if like is not None and rand.random() < self.drift:
+                sha = hashlib.sha1(sha.encode('utf-8')).hexdigest()
+            repos.append({
+                'name': name,
+                'full_name': '%s/%s' % (org, name),
+                'size': int(rand.paretovariate(1.2) * 100),
+                'pushed_at': '2017-%02d-%02dT00:00:00Z' % (
+                    rand.randint(1, 12), rand.randint(1, 28)
+                ),
+                'archived': rand.random() < 0.05,
+                'default_branch': 'master',
+                'sha': sha,
+                'commits': int(rand.paretovariate(1.5) * 20)
+            })
+            self.index[(org, name)] = repos[-1]
+        self.orgs[org] = repos
+
+    def count(self, endpoint):
+        """ Count a request against an endpoint. """
+
+        with self.lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+    def take_token(self, token):
+        """ Consume one request from a token's budget; return the headers. """
+
+        now = time.time()
+        with self.lock:
+            remaining, reset = self.limits.get(
+                token, (self.rate_limit, now + self.rate_window)
+            )
+            if now >= reset:
+                remaining, reset = self.rate_limit, now + self.rate_window
+            if remaining > 0:
+                remaining -= 1
+                allowed = True
+            else:
+                allowed = False
+            self.limits[token] = (remaining, reset)
+
+        return allowed, {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(reset))
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Dispatches requests to the `route_*` methods by regex. """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    routes = [
+        ('GET', r'/orgs/([^/]+)/repos', 'org_repos'),
+        ('GET', r'/orgs/([^/]+)', 'org'),
+        ('POST', r'/orgs/([^/]+)/migrations', 'start_migration'),
+        ('GET', r'/orgs/([^/]+)/migrations/(\d+)', 'migration'),
+        ('GET', r'/orgs/([^/]+)/migrations/(\d+)/archive', 'archive_url'),
+        ('DELETE', r'/orgs/([^/]+)/migrations/(\d+)/repos/([^/]+)/lock',
+            'unlock_repo'),
+        ('GET', r'/_archives/(\d+)\.tar\.gz', 'archive'),
+        ('GET', r'/repos/([^/]+)/([^/]+)', 'repo'),
+        ('GET', r'/repos/([^/]+)/([^/]+)/commits', 'commits'),
+        ('GET', r'/login', 'login_form'),
+        ('POST', r'/session', 'login'),
+        ('GET', r'/stafftools/users/([^/]+)/admin', 'user_admin'),
+        ('POST', r'/stafftools/users/([^/]+)', 'delete_user'),
+        ('GET', r'/stafftools/users/([^/]+)/emails', 'user_emails'),
+        ('POST', r'/stafftools/users/([^/]+)/emails', 'add_email'),
+        ('POST', r'/stafftools/users/([^/]+)/password/send_reset_email',
+            'reset_password'),
+        ('GET', r'/_stats', 'stats'),
+        ('POST', r'/_reset', 'reset'),
+    ]
+
+    def log_message(self, format, *args):
+        """ Keep the benchmark output quiet. """
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        """ Apply latency, failures and rate limits, then route. """
+
+        state = self.server.state
+        url = urlparse(self.path)
+        path = url.path
+        if path.startswith('/api/v3'):
+            path = path[len('/api/v3'):]
+        self.query = parse_qs(url.query)
+        self.body = self.read_body()
+
+        for verb, pattern, name in self.routes:
+            match = re.match(pattern + '/?$', path)
+            if verb == method and match:
+                break
+        else:
+            return self.send_json({'message': 'Not Found'}, 404)
+
+        if name in ('stats', 'reset'):
+            return getattr(self, 'route_%s' % name)()
+
+        state.count('%s %s' % (method, name))
+        if name == 'archive':
+            return self.route_archive(*match.groups())
+
+        if state.latency:
+            time.sleep(state.latency * random.uniform(0.5, 1.5))
+
+        if state.fail_rate and random.random() < state.fail_rate:
+            return self.send_json({'message': 'Server Error'}, 502)
+
+        token = self.headers.get('Authorization', '')
+        allowed, self.limit_headers = state.take_token(token)
+        if not allowed:
+            return self.send_json(
+                {'message': 'API rate limit exceeded'}, 403
+            )
+
+        getattr(self, 'route_%s' % name)(*match.groups())
+
+    def read_body(self):
+        """ Read the request body, if any. """
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return b''
+
+        return self.rfile.read(length)
+
+    def send_body(self, body, status=200, content_type='application/json',
+                  headers=None):
+        """ Send a complete response. """
+
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in dict(getattr(self, 'limit_headers', {}),
+                               **(headers or {})).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=None):
+        """ Send a JSON response. """
+
+        self.send_body(json.dumps(data), status, headers=headers)
+
+    def base_url(self):
+        """ The URL prefix this request was made against. """
+
+        prefix = '/api/v3' if self.path.startswith('/api/v3') else ''
+        return 'http://%s%s' % (self.headers.get('Host'), prefix)
+
+    def route_org(self, org):
+        if org not in self.server.state.orgs:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json({
+            'login': org,
+            'url': '%s/orgs/%s' % (self.base_url(), org),
+            'repos_url': '%s/orgs/%s/repos' % (self.base_url(), org)
+        })
+
+    def route_org_repos(self, org):
+        repos = self.server.state.orgs.get(org)
+        if repos is None:
+            return self.send_json({'message': 'Not Found'}, 404)
+
+        per_page = min(100, int(self.query.get('per_page', ['30'])[0]))
+        page = int(self.query.get('page', ['1'])[0])
+        last = max(1, (len(repos) + per_page - 1) // per_page)
+
+        url = '%s/orgs/%s/repos?per_page=%d&page=%%d' % (
+            self.base_url(), org, per_page
+        )
+        links = []
+        if page < last:
+            links.append('<%s>; rel="next"' % (url % (page + 1)))
+            links.append('<%s>; rel="last"' % (url % last))
+        if page > 1:
+            links.append('<%s>; rel="first"' % (url % 1))
+            links.append('<%s>; rel="prev"' % (url % (page - 1)))
+
+        chunk = repos[(page - 1) * per_page:page * per_page]
+        self.send_json(
+            [self.repo_json(org, r) for r in chunk],
+            headers={'Link': ', '.join(links)} if links else None
+        )
+
+    def repo_json(self, org, repo):
+        """ Render a repository in the shape of the REST API. """
+
+        base = self.base_url()
+        return {
+            'id': abs(hash(repo['full_name'])) % (10 ** 9),
+            'name': repo['name'],
+            'full_name': repo['full_name'],
+            'owner': {'login': org},
+            'private': True,
+            'size': repo['size'],
+            'pushed_at': repo['pushed_at'],
+            'archived': repo['archived'],
+            'default_branch': repo['default_branch'],
+            'url': '%s/repos/%s' % (base, repo['full_name']),
+            'commits_url': '%s/repos/%s/commits{/sha}' % (
+                base, repo['full_name']
+            )
+        }
+
+    def find_repo(self, owner, name):
+        """ Look up a generated repository. """
+
+        return self.server.state.index.get((owner, name))
+
+    def route_repo(self, owner, name):
+        repo = self.find_repo(owner, name)
+        if repo is None:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json(self.repo_json(owner, repo))
+
+    def route_commits(self, owner, name):
+        repo = self.find_repo(owner, name)
+        if repo is None:
+            return self.send_json({'message': 'Not Found'}, 404)
+
+        per_page = min(100, int(self.query.get('per_page', ['30'])[0]))
+        page = int(self.query.get('page', ['1'])[0])
+        last = max(1, (repo['commits'] + per_page - 1) // per_page)
+        url = '%s/repos/%s/commits?per_page=%d&page=%%d' % (
+            self.base_url(), repo['full_name'], per_page
+        )
+        links = []
+        if page < last:
+            links.append('<%s>; rel="next"' % (url % (page + 1)))
+            links.append('<%s>; rel="last"' % (url % last))
+
+        count = min(per_page, repo['commits'] - (page - 1) * per_page)
+        commit = {
+            'sha': repo['sha'],
+            'url': '%s/repos/%s/commits/%s' % (
+                self.base_url(), repo['full_name'], repo['sha']
+            )
+        }
+        self.send_json(
+            [commit] * max(0, count),
+            headers={'Link': ', '.join(links)} if links else None
+        )
+
+    def route_start_migration(self, org):
+        state = self.server.state
+        data = json.loads(self.body.decode('utf-8') or '{}')
+        with state.lock:
+            number = len(state.migrations) + 1
+            failed = random.random() < state.export_fail_rate
+            state.migrations[number] = {
+                'org': org,
+                'repositories': data.get('repositories', []),
+                'lock_repositories': data.get('lock_repositories', False),
+                'polls': 0,
+                'failed': failed
+            }
+        self.send_json(self.migration_json(org, number), 201)
+
+    def migration_json(self, org, number):
+        """ Render a migration, advancing its export state. """
+
+        state = self.server.state
+        migration = state.migrations[number]
+        if migration['polls'] >= state.export_polls:
+            status = 'failed' if migration['failed'] else 'exported'
+        else:
+            status = 'exporting'
+        migration['polls'] += 1
+
+        return {
+            'id': number,
+            'state': status,
+            'lock_repositories': migration['lock_repositories'],
+            'url': '%s/orgs/%s/migrations/%d' % (self.base_url(), org, number)
+        }
+
+    def route_migration(self, org, number):
+        if int(number) not in self.server.state.migrations:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json(self.migration_json(org, int(number)))
+
+    def route_archive_url(self, org, number):
+        self.send_body(
+            'http://%s/_archives/%s.tar.gz' % (self.headers.get('Host'),
+                                               number),
+            content_type='text/plain'
+        )
+
+    def route_archive(self, number):
+        state = self.server.state
+        migration = state.migrations.get(int(number))
+        if migration is None:
+            return self.send_json({'message': 'Not Found'}, 404)
+
+        sizes = dict(
+            (r['full_name'], r['size'])
+            for repos in state.orgs.values() for r in repos
+        )
+        size = sum(sizes.get(r, 0) for r in migration['repositories']) * 1024
+        self.send_body(b'\0' * size, content_type='application/gzip')
+
+    def route_unlock_repo(self, org, number, repo):
+        self.send_body(b'', 204)
+
+    def route_login_form(self):
+        self.send_body(
+            '<html><head><title>Sign in</title></head><body>'
+            '<form action="/session" method="post">'
+            '<input name="utf8" value="&#x2713;">'
+            '<input name="authenticity_token" value="token">'
+            '<input name="login"><input name="password">'
+            '<input type="submit" name="commit" value="Sign in">'
+            '</form></body></html>',
+            content_type='text/html'
+        )
+
+    def route_login(self):
+        self.send_body(b'', 302, headers={'Location': '/'})
+
+    def user_page(self, user, body):
+        """ Render a stafftools page for a user, or a not found page. """
+
+        if user not in self.server.state.users:
+            return self.send_body(
+                '<html><head><title>Page not found</title></head></html>',
+                404, content_type='text/html'
+            )
+
+        self.send_body(
+            '<html><head><title>%s - Site admin</title></head>'
+            '<body>%s</body></html>' % (user, body),
+            content_type='text/html'
+        )
+
+    def route_user_admin(self, user):
+        self.user_page(user, (
+            '<div id="confirm_deletion"><form method="post" '
+            'action="/stafftools/users/%s">'
+            '<input name="utf8" value="&#x2713;">'
+            '<input name="_method" value="delete">'
+            '<input name="authenticity_token" value="token">'
+            '</form></div>'
+        ) % user)
+
+    def route_delete_user(self, user):
+        with self.server.state.lock:
+            self.server.state.users.pop(user, None)
+        self.send_body(b'', 302, headers={'Location': '/stafftools/users'})
+
+    def route_user_emails(self, user):
+        emails = self.server.state.users.get(user, {}).get('emails', [])
+        self.user_page(user, (
+            '<ul>%s</ul>'
+            '<form method="post" action="/stafftools/users/%s/emails">'
+            '<input name="utf8" value="&#x2713;">'
+            '<input name="authenticity_token" value="token">'
+            '</form>'
+            '<form method="post" '
+            'action="/stafftools/users/%s/password/send_reset_email">'
+            '<input name="utf8" value="&#x2713;">'
+            '<input name="_method" value="put">'
+            '<input name="authenticity_token" value="token">'
+            '</form>'
+        ) % (''.join('<li>%s</li>' % e for e in emails), user, user))
+
+    def route_add_email(self, user):
+        form = parse_qs(self.body.decode('utf-8'))
+        with self.server.state.lock:
+            if user in self.server.state.users:
+                self.server.state.users[user]['emails'].extend(
+                    form.get('email', [])
+                )
+        self.send_body(b'', 302, headers={
+            'Location': '/stafftools/users/%s/emails' % user
+        })
+
+    def route_reset_password(self, user):
+        self.send_body(b'', 302, headers={
+            'Location': '/stafftools/users/%s/emails' % user
+        })
+
+    def route_stats(self):
+        with self.server.state.lock:
+            self.send_json(dict(self.server.state.stats))
+
+    def route_reset(self):
+        with self.server.state.lock:
+            self.server.state.stats.clear()
+            self.server.state.limits.clear()
+        self.send_body(b'', 204)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """ Threaded HTTP server holding a MockState. """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, state, port=0):
+        """ Bind to localhost; port 0 picks a free port. """
+
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.state = state
+
+    @property
+    def url(self):
+        """ Base URL of the server. """
+
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        """ Serve requests from a background thread. """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the GitHub.com and GHE HTTP endpoints.'
+    )
+    parser.add_argument('-port', type=int, default=8000, metavar='PORT',
+        help='port to listen on (default: 8000)')
+    parser.add_argument('-org', default='source-org', metavar='ORG',
+        help='name of the generated source organization')
+    parser.add_argument('-dest', default='dest-org', metavar='ORG',
+        help='name of the generated destination organization')
+    parser.add_argument('-repos', type=int, default=1000, metavar='INT',
+        help='number of repos per organization (default: 1000)')
+    parser.add_argument('-latency', type=float, default=0.0,
+        metavar='SECONDS', help='average latency added to API requests')
+    parser.add_argument('-rate-limit', type=int, default=5000, metavar='INT',
+        help='requests per token per hour (default: 5000)')
+    parser.add_argument('-fail-rate', type=float, default=0.0,
+        metavar='FLOAT', help='fraction of API requests answered with 502')
+    parser.add_argument('-export-polls', type=int, default=1, metavar='INT',
+        help='polls before a migration export finishes (default: 1)')
+    parser.add_argument('-export-fail-rate', type=float, default=0.0,
+        metavar='FLOAT', help='fraction of migration exports that fail')
+    parser.add_argument('-drift', type=float, default=0.0, metavar='FLOAT',
+        help='fraction of destination repos with a different head')
+
+    args = parser.parse_args()
+
+    server = MockServer(MockState(
+        org=args.org,
+        dest=args.dest,
+        repos=args.repos,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        fail_rate=args.fail_rate,
+        export_polls=args.export_polls,
+        export_fail_rate=args.export_fail_rate,
+        drift=args.drift
+    ), args.port)
+
+    print('Serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
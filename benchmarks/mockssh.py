@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+mockssh.py - Fake GitHub Enterprise appliance reachable over SSH
+
+usage: mockssh.py [-h] [-port PORT] [-conflicts INT] [-import-seconds FLOAT]
+
+Accepts any public key and runs each exec request with /bin/sh inside a
+scratch directory, with stand-ins for `ghe-migrator`, `ghe-maintenance`,
+`ghe-announce`, `ghe-resque-info` and `ghe-user-csv` first on the PATH.
+Everything else, such as the `curl` calls that download migration archives,
+runs for real. SFTP uploads land in the same scratch directory.
+"""
+
+import argparse, os, shutil, socket, stat, subprocess, sys, tempfile
+import threading
+
+import paramiko
+
+GHE_MIGRATOR = r'''
+import os, sys, time, uuid
+
+args = sys.argv[1:]
+cmd = args[0] if args else ''
+guid = args[args.index('-g') + 1] if '-g' in args else ''
+state = os.path.join(os.getcwd(), '.migrations')
+if not os.path.isdir(state):
+    os.makedirs(state)
+
+def progress(name, seconds):
+    for pct in range(0, 101, 10):
+        sys.stdout.write('%s %d%% complete\r' % (name, pct))
+        sys.stdout.flush()
+        time.sleep(seconds / 10.0)
+    sys.stdout.write('\n')
+
+if cmd == 'prepare':
+    guid = str(uuid.uuid4())
+    open(os.path.join(state, guid), 'w').close()
+    progress('Prepare', float(os.environ.get('MOCK_PREPARE_SECONDS', 0)))
+    print('Migration GUID: %s' % guid)
+elif cmd == 'conflicts':
+    if os.path.exists(os.path.join(state, guid + '.resolved')):
+        sys.exit(0)
+    print('model_name,source_url,target_url,recommended_action,notes')
+    for i in range(int(os.environ.get('MOCK_CONFLICTS', 0))):
+        print('user,https://github.com/u%d,https://ghe/u%d,map,' % (i, i))
+elif cmd == 'map':
+    if '-i' in args:
+        open(os.path.join(state, guid + '.resolved'), 'w').close()
+        print('Conflicts resolved')
+elif cmd == 'import':
+    progress('Import', float(os.environ.get('MOCK_IMPORT_SECONDS', 0)))
+    print('Import finished')
+elif cmd == 'unlock':
+    print('Unlocked')
+else:
+    sys.stderr.write('ghe-migrator: unknown command %s\n' % cmd)
+    sys.exit(1)
+'''
+
+GHE_MAINTENANCE = r'''
+import os, sys
+
+flag = os.path.join(os.getcwd(), '.maintenance')
+if '-s' in sys.argv:
+    open(flag, 'w').close()
+elif '-u' in sys.argv and os.path.exists(flag):
+    os.remove(flag)
+elif '-q' in sys.argv:
+    if os.path.exists(flag):
+        print('maintenance mode set')
+    else:
+        print('maintenance mode not set')
+'''
+
+GHE_ANNOUNCE = r'''
+import os, sys
+
+path = os.path.join(os.getcwd(), '.announce')
+if '-s' in sys.argv:
+    with open(path, 'w') as f:
+        f.write(sys.argv[sys.argv.index('-s') + 1])
+elif '-u' in sys.argv and os.path.exists(path):
+    os.remove(path)
+elif '-g' in sys.argv:
+    print(open(path).read() if os.path.exists(path) else '')
+'''
+
+GHE_RESQUE_INFO = r'''
+import os
+
+depth = int(os.environ.get('MOCK_QUEUE_DEPTH', 0))
+print('%-30s %s' % ('Queue', 'Size'))
+print('-' * 36)
+print('%-30s %d' % ('maint_default', depth))
+print('%-30s %d' % ('index_high', 0))
+'''
+
+GHE_USER_CSV = r'''
+import os
+
+users = int(os.environ.get('MOCK_USERS', 1000))
+print('id,login,email,role,ssh_keys,org_memberships,repos,suspension_status')
+for i in range(users):
+    print('%d,user-%d,user-%d@example.com,%s,1,2,3,%s' % (
+        i + 1, i, i, 'admin' if i == 0 else 'user',
+        'suspended' if i % 100 == 99 else 'active'
+    ))
+'''
+
+
+class MockAppliance(paramiko.ServerInterface):
+    """ Authentication and channel policy for one SSH connection. """
+
+    def __init__(self, server):
+        """ Initial setup. """
+
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+
+        thread = threading.Thread(
+            target=self.server.run, args=(channel, command)
+        )
+        thread.daemon = True
+        thread.start()
+
+        return True
+
+
+class MockSFTPHandle(paramiko.SFTPHandle):
+    """ File handle for the scratch directory SFTP server. """
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno())
+        )
+
+
+class MockSFTPServer(paramiko.SFTPServerInterface):
+    """ SFTP server rooted at the appliance scratch directory. """
+
+    def __init__(self, server, root, *args, **kwargs):
+        """ Initial setup. """
+
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = MockSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        path = self._path(path)
+        return [
+            paramiko.SFTPAttributes.from_stat(
+                os.stat(os.path.join(path, name)), name
+            )
+            for name in os.listdir(path)
+        ]
+
+
+class MockSSHServer(object):
+    """ Listens for SSH connections and runs commands in a scratch dir. """
+
+    def __init__(self, port=0, env=None):
+        """ Create the scratch directory, host key and fake commands. """
+
+        self.root = tempfile.mkdtemp(prefix='ghe-mockssh-')
+        self.bin = os.path.join(self.root, '.bin')
+        os.makedirs(self.bin)
+
+        for name, source in (('ghe-migrator', GHE_MIGRATOR),
+                             ('ghe-maintenance', GHE_MAINTENANCE),
+                             ('ghe-announce', GHE_ANNOUNCE),
+                             ('ghe-resque-info', GHE_RESQUE_INFO),
+                             ('ghe-user-csv', GHE_USER_CSV)):
+            path = os.path.join(self.bin, name)
+            with open(path, 'w') as f:
+                f.write('#!%s\n%s' % (sys.executable, source))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+        self.env = os.environ.copy()
+        self.env.update(env or {})
+        self.env['PATH'] = self.bin + os.pathsep + self.env.get('PATH', '')
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.commands = 0
+        self.lock = threading.Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        """ Accept connections from a background thread. """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def serve_forever(self):
+        """ Accept connections until the socket is closed. """
+
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except (OSError, socket.error):
+                return
+
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, MockSFTPServer, self.root
+            )
+            transport.start_server(server=MockAppliance(self))
+
+    def run(self, channel, command):
+        """ Run an exec request and stream its output back. """
+
+        with self.lock:
+            self.commands += 1
+
+        proc = subprocess.Popen(
+            ['/bin/sh', '-c', command],
+            cwd=self.root,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+        try:
+            while True:
+                data = os.read(proc.stdout.fileno(), 32768)
+                if not data:
+                    break
+                channel.sendall(data)
+        except (EOFError, OSError, socket.error):
+            proc.kill()
+
+        channel.sendall_stderr(proc.stderr.read())
+        # Report a command killed by a signal the way a shell does.
+        status = proc.wait()
+        channel.send_exit_status(status if status >= 0 else 128 - status)
+        channel.close()
+
+    def close(self):
+        """ Stop listening and remove the scratch directory. """
+
+        self.sock.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fake GitHub Enterprise appliance reachable over SSH.'
+    )
+    parser.add_argument('-port', type=int, default=2222, metavar='PORT',
+        help='port to listen on (default: 2222)')
+    parser.add_argument('-conflicts', type=int, default=0, metavar='INT',
+        help='user conflicts reported by `ghe-migrator conflicts`')
+    parser.add_argument('-import-seconds', type=float, default=0.0,
+        metavar='FLOAT', help='time each `ghe-migrator import` takes')
+
+    args = parser.parse_args()
+
+    server = MockSSHServer(args.port, env={
+        'MOCK_CONFLICTS': str(args.conflicts),
+        'MOCK_IMPORT_SECONDS': str(args.import_seconds)
+    })
+    print('Serving SSH on 127.0.0.1:%d from %s' % (server.port, server.root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
@@ -6,7 +6,23 @@ __author__ = 'Elliott Carlson'
 __license__ = 'ISC'
 __url__ = 'https://git.generalassemb.ly/ga-admin-utils/ghe'
 
-from .ghe import GHE, GHECLI, get_key, set_key, unset_key
+import sys
+
+__all__ = ['GHE', 'GHECLI', 'get_key', 'set_key', 'unset_key']
+
+# The shell pulls in cmd2 and keyring, which thin `ghe serve` clients do not
+# need; where modules support __getattr__, it is loaded on first use.
+if sys.version_info < (3, 7):
+    from .ghe import GHE, GHECLI, get_key, set_key, unset_key
+else:
+    def __getattr__(name):
+        if name not in __all__:
+            raise AttributeError(
+                "module %r has no attribute %r" % (__name__, name)
+            )
+        from . import ghe
+
+        return getattr(ghe, name)
 
 if __name__ == '__main__':
     ghe = GHECLI()
@@ -1,7 +1,18 @@
-from .ghe import GHECLI
+import sys
+
+from .server import LOCAL, call
 
 def main():
+    # Hand commands to a running `ghe serve` before loading the shell and
+    # reading the keyring.
+    args = sys.argv[1:]
+    if args and not args[0].startswith('-') and args[0] not in LOCAL:
+        status = call(args[0], args[1:])
+        if status is not None:
+            sys.exit(status)
+
+    from .ghe import GHECLI
     GHECLI()
 
 if __name__ == '__main__':
-    GHECLI()
+    main()
@@ -0,0 +1,478 @@
+# asyncio client for the GitHub REST API. Python 3 only; commands fall back
+# to their threaded requests code paths without it.
+
+import asyncio
+import json
+import re
+import ssl
+import threading
+import time
+import zlib
+
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+from requests.utils import parse_header_links
+
+from . import __title__, __version__
+from .credentials import CredentialPool, Token
+from .inventory import LAST_PAGE, RepoInfo
+from .ratelimit import NORMAL
+from .trace import tracer
+
+STATUS_LINE = re.compile(r'HTTP/(\d\.\d) (\d{3}) ?(.*)')
+
+
+class Response(object):
+    """ A complete HTTP response. """
+
+    def __init__(self, method, url, status, reason, headers, content):
+        """ Initial setup. """
+
+        self.method = method
+        self.url = url
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """ Decode the body as JSON. """
+
+        return json.loads(self.content.decode('utf-8'))
+
+    @property
+    def links(self):
+        """ The `Link` header keyed by `rel`, like requests does. """
+
+        links = {}
+        for link in parse_header_links(self.headers.get('Link', '')):
+            links[link.get('rel') or link['url']] = link
+
+        return links
+
+    def raise_for_status(self):
+        """ Raise requests.HTTPError for 4xx and 5xx responses. """
+
+        if self.status_code >= 400:
+            raise requests.HTTPError('%d %s for url: %s' % (
+                self.status_code, self.reason, self.url
+            ), response=self)
+
+
+class Connection(object):
+    """ One keep-alive HTTP/1.1 connection. """
+
+    def __init__(self, reader, writer):
+        """ Initial setup. """
+
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+
+    @classmethod
+    async def open(cls, scheme, host, port, timeout):
+        """ Connect to `host`, with TLS for https. """
+
+        context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), timeout
+        )
+
+        return cls(reader, writer)
+
+    async def request(self, method, target, headers, body):
+        """ Send a request and read the response.
+
+        Returns (status, reason, headers, body, keep_alive).
+        """
+
+        lines = ['%s %s HTTP/1.1' % (method, target)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        self.writer.write(
+            ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        )
+        await self.writer.drain()
+        self.requests += 1
+
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed by server')
+
+        match = STATUS_LINE.match(line.decode('latin-1').rstrip())
+        if not match:
+            raise requests.ConnectionError('Bad status line %r' % line)
+        version, status, reason = match.groups()
+        status = int(status)
+
+        res_headers = CaseInsensitiveDict()
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').rstrip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            value = value.strip()
+            if key in res_headers:
+                value = '%s, %s' % (res_headers[key], value)
+            res_headers[key] = value
+
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            content = b''
+        elif 'chunked' in res_headers.get('Transfer-Encoding', '').lower():
+            content = await self._read_chunked()
+        elif 'Content-Length' in res_headers:
+            content = await self.reader.readexactly(
+                int(res_headers['Content-Length'])
+            )
+        else:
+            content = await self.reader.read()
+            res_headers['Connection'] = 'close'
+
+        if res_headers.get('Content-Encoding', '').lower() == 'gzip':
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+
+        keep_alive = res_headers.get('Connection', '').lower() != 'close' \
+            and version == '1.1'
+
+        return status, reason, res_headers, content, keep_alive
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = (await self.reader.readline()).split(b';', 1)[0].strip()
+            size = int(size, 16)
+            if not size:
+                # Skip any trailers up to the closing blank line.
+                while (await self.reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        """ Close the socket. """
+
+        self.writer.close()
+
+
+class Client(object):
+    """ An asyncio client for the GitHub REST API.
+
+    Connections are pooled per host and kept alive between requests, with
+    at most `limit` requests in flight. Every request goes through the rate
+    limit governor of `token` at the given `priority`, and is traced like
+    requests made through an instrumented requests session. `token` may
+    also be a CredentialPool, in which case each request is sent with the
+    credential that has the most budget left. Requests are made over
+    HTTP/1.1; HTTP/2 is not negotiated.
+    """
+
+    def __init__(self, base_url, token, accept='application/vnd.github.v3+json',
+                 limit=64, priority=NORMAL, timeout=60, retries=5):
+        """ Initial setup. """
+
+        self.base_url = base_url.rstrip('/')
+        self.limit = limit
+        self.priority = priority
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = token if isinstance(token, CredentialPool) else \
+            CredentialPool([Token(token)])
+        self.headers = {
+            'Accept': accept,
+            'Accept-Encoding': 'gzip',
+            'User-Agent': '%s/%s' % (__title__, __version__)
+        }
+
+        self.loop = None
+        self.idle = {}
+        self.slots = None
+
+    async def request(self, method, url, params=None, json_body=None,
+                      pool=None):
+        """ Send a request and return the Response.
+
+        Relative URLs are resolved against `base_url`. Requests rejected by
+        a rate limit are retried once the governor allows it, and those
+        sent with an expired installation token are retried with a new one.
+        The credential is taken from `pool`, by default the client's.
+        """
+
+        if '://' not in url:
+            url = self.base_url + '/' + url.lstrip('/')
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+
+        body = b''
+        headers = dict(self.headers)
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if body or method in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(body))
+
+        # Connections belong to the event loop that opened them.
+        loop = asyncio.get_event_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.idle = {}
+            self.slots = asyncio.Semaphore(self.limit)
+
+        async with self.slots:
+            for attempt in range(self.retries + 1):
+                credential = await self._acquire(pool or self.pool)
+                res = await self._send(method, url, dict(
+                    headers, Authorization='token %s' % credential.token
+                ), body)
+                retry = await loop.run_in_executor(
+                    None, self._settle, credential, res
+                )
+                if not retry or attempt == self.retries:
+                    return res
+
+    async def get(self, url, params=None, pool=None):
+        """ GET a URL, raising on HTTP errors. """
+
+        res = await self.request('GET', url, params, pool=pool)
+        res.raise_for_status()
+
+        return res
+
+    async def post(self, url, json_body):
+        """ POST a JSON body, raising on HTTP errors. """
+
+        res = await self.request('POST', url, json_body=json_body)
+        res.raise_for_status()
+
+        return res
+
+    async def pages(self, url, params=None, per_page=100):
+        """ Yield each page of a paginated listing, in order.
+
+        When the first page links to the last one, the remaining pages are
+        all requested at once; otherwise `next` links are followed. Every
+        page is requested with the same credential, so a pool of accounts
+        that see different private repos can't leave any out.
+        """
+
+        pool = await asyncio.get_event_loop().run_in_executor(
+            None, self.pool.pin
+        )
+        params = dict(params or {}, per_page=per_page)
+        res = await self.get(url, params, pool)
+        yield res.json()
+
+        match = LAST_PAGE.search(res.links.get('last', {}).get('url', ''))
+        if match:
+            pending = deque(
+                asyncio.ensure_future(
+                    self.get(url, dict(params, page=page), pool)
+                )
+                for page in range(2, int(match.group(1)) + 1)
+            )
+            try:
+                while pending:
+                    yield (await pending.popleft()).json()
+            finally:
+                for future in pending:
+                    future.cancel()
+            return
+
+        while 'next' in res.links:
+            res = await self.get(res.links['next']['url'], pool=pool)
+            yield res.json()
+
+    async def close(self):
+        """ Close all idle connections. """
+
+        for connections in self.idle.values():
+            while connections:
+                connections.pop().close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # The governors lock and rewrite their state files, so they are
+    # consulted on executor threads rather than on the event loop.
+
+    async def _acquire(self, pool):
+        loop = asyncio.get_event_loop()
+        waiter = 'task:%d' % id(asyncio.current_task())
+        waited = 0
+        while True:
+            credential, delay = await loop.run_in_executor(
+                None, pool.take, self.priority, waiter
+            )
+            if credential is not None:
+                break
+            waited += delay
+            await asyncio.sleep(delay)
+
+        if waited:
+            tracer.count('ghe_api_throttled_seconds_total', waited,
+                         priority=str(self.priority))
+
+        # Minting an installation token blocks, so it is done off the loop.
+        if not credential.fresh:
+            await loop.run_in_executor(None, lambda: credential.token)
+
+        return credential
+
+    @staticmethod
+    def _settle(credential, res):
+        # Whether the request should be retried.
+        return credential.governor.update(res) or (
+            res.status_code == 401 and credential.expire()
+        )
+
+    async def _send(self, method, url, headers, body):
+        parts = urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path + ('?' + parts.query if parts.query else '')
+
+        headers = dict(headers, Host=parts.netloc)
+        idle = self.idle.setdefault(key, [])
+
+        start = time.time()
+        while True:
+            reused = bool(idle)
+            try:
+                conn = idle.pop() if reused else await Connection.open(
+                    scheme, parts.hostname, port, self.timeout
+                )
+            except (OSError, asyncio.TimeoutError) as err:
+                raise requests.ConnectionError(err)
+
+            try:
+                result = await asyncio.wait_for(
+                    conn.request(method, target, headers, body), self.timeout
+                )
+                break
+            except (ConnectionError, asyncio.IncompleteReadError) as err:
+                conn.close()
+                # The server may have dropped an idle keep-alive connection.
+                if not reused:
+                    raise requests.ConnectionError(err)
+            except asyncio.TimeoutError:
+                conn.close()
+                raise requests.Timeout('Timed out reading %s' % url)
+            except BaseException:
+                conn.close()
+                raise
+
+        status, reason, res_headers, content, keep_alive = result
+        if keep_alive:
+            idle.append(conn)
+        else:
+            conn.close()
+
+        tracer.observe_api(method, url, status, res_headers, start,
+                           time.time())
+
+        return Response(method, url, status, reason, res_headers, content)
+
+
+async def org_repos(client, org, per_page=100):
+    """ Return every repository in `org` as a list of RepoInfo. """
+
+    repos = []
+    async for page in client.pages('orgs/%s/repos' % org, per_page=per_page):
+        repos.extend(RepoInfo.from_api(repo) for repo in page)
+
+    return repos
+
+
+async def repo_head(client, owner, name):
+    """ Return the SHA of the latest commit in a repository.
+
+    Empty repositories have no commits; their error message is returned.
+    """
+
+    res = await client.request(
+        'GET', 'repos/%s/%s/commits' % (owner, name), {'per_page': 1}
+    )
+    if res.status_code == 409:
+        return res.json().get('message')
+    res.raise_for_status()
+
+    return res.json()[0]['sha']
+
+
+async def start_migration(client, org, repos, lock=False):
+    """ Start a migration export and return the new migration object.
+
+    With `lock`, the repositories are locked on GitHub from now on.
+    """
+
+    res = await client.post('orgs/%s/migrations' % org, {
+        'lock_repositories': lock,
+        'repositories': repos
+    })
+
+    return res.json()
+
+
+async def export_migration(client, org, repos, lock=False, poll=5):
+    """ Start a migration export and wait until it is exported or failed.
+
+    Returns the final migration object.
+    """
+
+    migration = await start_migration(client, org, repos, lock)
+
+    while migration['state'] not in ('exported', 'failed'):
+        await asyncio.sleep(poll)
+        migration = (await client.get(migration['url'])).json()
+
+    return migration
+
+
+async def gather(*aws, **kwargs):
+    """ asyncio.gather for callers without a running event loop. """
+
+    return await asyncio.gather(*aws, **kwargs)
+
+
+def run(coro, *clients):
+    """ Run a coroutine to completion on a new event loop.
+
+    The connections of `clients` are closed before the loop is.
+    """
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        for client in clients:
+            loop.run_until_complete(client.close())
+        loop.close()
+
+
+class LoopThread(object):
+    """ An event loop running in a daemon thread, for threaded callers. """
+
+    def __init__(self):
+        """ Start the loop. """
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, coro):
+        """ Schedule a coroutine; return a concurrent.futures.Future. """
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """ Run a coroutine on the loop and wait for its result. """
+
+        return self.submit(coro).result()
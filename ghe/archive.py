@@ -0,0 +1,369 @@
+import codecs
+import heapq
+import json
+import re
+import struct
+import tarfile
+import zlib
+
+from collections import namedtuple
+
+from .trace import tracer
+
+# Blobs and files over this size are reported; GitHub refuses to accept
+# files larger than 100 MB.
+LARGE = 100 * 1024 ** 2
+
+# Metadata files such as `issues_000001.json`, one per model and chunk.
+MODEL_FILE = re.compile(r'^([a-z_]+)_\d+\.json$')
+
+# Git data of a repository or its wiki.
+REPO_PATH = re.compile(r'^repositories/([^/]+)/([^/]+?)(\.wiki)?\.git/(.*)$')
+
+# A repository URL, and the URL of something inside a repository.
+REPO_URL = re.compile(r'^\w+://[^/]+/([^/]+/[^/?#]+)/?$')
+IN_REPO_URL = re.compile(
+    r'^\w+://[^/]+/([^/]+/[^/?#]+)/(?:issues|pull|commit|releases|'
+    r'milestones?|labels|wiki|projects)\b'
+)
+
+# Git object types, as numbered in pack files.
+OBJECT_TYPES = {
+    1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag', 6: 'delta', 7: 'delta'
+}
+
+Outlier = namedtuple('Outlier', ['size', 'repo', 'path', 'kind'])
+
+
+def _strip(name):
+    return name[2:] if name.startswith('./') else name
+
+def record_repo(model, record):
+    """ The `owner/repo` a metadata record belongs to, or None. """
+
+    if model == 'repositories':
+        match = REPO_URL.match(record.get('url') or '')
+        return match.group(1) if match else None
+
+    value = record.get('repository')
+    if hasattr(value, 'startswith'):
+        match = REPO_URL.match(value)
+        if match:
+            return match.group(1)
+
+    for key in ('issue', 'pull_request', 'url'):
+        value = record.get(key)
+        if hasattr(value, 'startswith'):
+            match = IN_REPO_URL.match(value)
+            if match:
+                return match.group(1)
+
+    return None
+
+def iter_records(f, bufsize=65536):
+    """ Yield the objects of a JSON array read from a file, one at a time.
+
+    Only the record being decoded is held in memory, so metadata files of
+    any size can be counted.
+    """
+
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')('replace').decode
+    buf, pos, eof, need = u'', 0, False, bufsize
+    started = False
+
+    while True:
+        while pos < len(buf) and (buf[pos] in u' \t\r\n,' or
+                                  (buf[pos] == u'[' and not started)):
+            started = started or buf[pos] == u'['
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == u']':
+            return
+
+        if pos < len(buf):
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                need = bufsize
+                yield record
+                continue
+        elif eof:
+            return
+
+        # Read more: the buffer is used up, or ends inside a record, in
+        # which case read twice as much each time the record is still
+        # incomplete.
+        data = f.read(need)
+        eof = not data
+        buf = buf[pos:] + decode(data, final=eof)
+        pos = 0
+        if len(buf) >= need:
+            need *= 2
+
+
+class _Reader(object):
+    """ Buffered reads of exact lengths from a file. """
+
+    def __init__(self, f, bufsize=65536):
+        """ Initial setup. """
+
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = b''
+        self.pos = 0
+        self.offset = 0
+
+    def fill(self):
+        """ Read more into the buffer; return False at the end. """
+
+        data = self.f.read(self.bufsize)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+        return bool(data)
+
+    def read(self, n):
+        """ Return the next `n` bytes. """
+
+        while len(self.buf) - self.pos < n:
+            if not self.fill():
+                raise EOFError('truncated pack file')
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        self.offset += n
+
+        return data
+
+    def byte(self):
+        """ Return the next byte as an integer. """
+
+        return struct.unpack('B', self.read(1))[0]
+
+    def inflate(self, keep=0):
+        """ Skip a zlib stream; return the first `keep` bytes it holds.
+
+        Output is thrown away as it is inflated, so an object of any size
+        takes a constant amount of memory.
+        """
+
+        d = zlib.decompressobj()
+        head = b''
+        step = 512
+        while True:
+            if self.pos == len(self.buf) and not self.fill():
+                raise EOFError('truncated pack file')
+            chunk = self.buf[self.pos:self.pos + step]
+            out = d.decompress(chunk, 65536)
+            while True:
+                if len(head) < keep:
+                    head += out[:keep - len(head)]
+                # unconsumed_tail is left as it was once the stream ends.
+                ended = d.unused_data or getattr(d, 'eof', False)
+                if ended or not d.unconsumed_tail:
+                    break
+                out = d.decompress(d.unconsumed_tail, 65536)
+            used = len(chunk) - len(d.unused_data)
+            self.pos += used
+            self.offset += used
+            if ended:
+                return head
+            step = min(step * 2, self.bufsize)
+
+
+def _varint(data, pos):
+    # The size varints at the start of delta data: 7 bits a byte, least
+    # significant first.
+    value = shift = 0
+    while pos < len(data):
+        c = struct.unpack('B', data[pos:pos + 1])[0]
+        value |= (c & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not c & 0x80:
+            break
+
+    return value, pos
+
+def scan_pack(f, threshold=LARGE):
+    """ Yield (offset, kind, size) for the objects of a pack over a size.
+
+    The pack is read from start to end without its index. Deltas are
+    reported with the size of the object they rebuild.
+    """
+
+    reader = _Reader(f)
+    header = reader.read(12)
+    if header[:4] != b'PACK':
+        raise ValueError('not a pack file')
+    count = struct.unpack('>I', header[8:12])[0]
+
+    for _ in range(count):
+        offset = reader.offset
+        c = reader.byte()
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = reader.byte()
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        if kind == 6:
+            c = reader.byte()
+            while c & 0x80:
+                c = reader.byte()
+        elif kind == 7:
+            reader.read(20)
+
+        if kind in (6, 7):
+            head = reader.inflate(keep=20)
+            _, pos = _varint(head, 0)
+            size, _ = _varint(head, pos)
+        else:
+            reader.inflate()
+
+        if size >= threshold:
+            yield offset, OBJECT_TYPES.get(kind, 'object'), size
+
+def loose_object(f):
+    """ Return the (kind, size) of a loose git object. """
+
+    d = zlib.decompressobj()
+    head = d.decompress(f.read(64), 64)
+    kind, _, rest = head.partition(b' ')
+    size = rest.split(b'\0', 1)[0]
+
+    return kind.decode('ascii', 'replace'), int(size or 0)
+
+
+class Manifest(object):
+    """ What a migration archive holds, built up one member at a time.
+
+    `repos` maps `owner/repo` to its git and wiki bytes and the number of
+    metadata records of each model that belong to it; `models` counts all
+    records of each model, and `sections` the bytes under each top-level
+    directory. Only the `top` largest outliers are kept.
+    """
+
+    def __init__(self, threshold=LARGE, top=20):
+        """ Initial setup. """
+
+        self.threshold = threshold
+        self.top = top
+        self.bytes = 0
+        self.members = 0
+        self.models = {}
+        self.repos = {}
+        self.sections = {}
+        self.outliers = []
+        self.large = 0
+
+    def repo(self, name):
+        """ The entry of a repository, created on first use. """
+
+        if name not in self.repos:
+            self.repos[name] = {'bytes': 0, 'wiki_bytes': 0, 'records': {}}
+
+        return self.repos[name]
+
+    def outlier(self, size, repo, path, kind):
+        """ Note an object or file over the threshold. """
+
+        # Heap entries are ordered by size, then by arrival.
+        self.large += 1
+        item = (size, -self.large, Outlier(size, repo, path, kind))
+        if len(self.outliers) < self.top:
+            heapq.heappush(self.outliers, item)
+        elif item > self.outliers[0]:
+            heapq.heapreplace(self.outliers, item)
+
+    def largest(self):
+        """ The outliers kept, largest first. """
+
+        return [item[2] for item in sorted(self.outliers, reverse=True)]
+
+    def as_dict(self):
+        """ The manifest as plain data, for JSON. """
+
+        return {
+            'bytes': self.bytes,
+            'members': self.members,
+            'models': self.models,
+            'sections': self.sections,
+            'repos': self.repos,
+            'large': self.large,
+            'outliers': [o._asdict() for o in self.largest()]
+        }
+
+
+def index(fileobj, threshold=LARGE, top=20, objects=True):
+    """ Index a `.tar.gz` migration archive in one pass; return a Manifest.
+
+    The archive is read as a stream, so it can come from a pipe, an SSH
+    channel or an HTTP response, and nothing is extracted. With `objects`,
+    pack files are also scanned for blobs over `threshold`.
+    """
+
+    manifest = Manifest(threshold, top)
+
+    with tracer.span('archive', 'index') as span:
+        tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = _strip(member.name)
+            manifest.members += 1
+            manifest.bytes += member.size
+            section = name.split('/', 1)[0] if '/' in name else 'metadata'
+            manifest.sections[section] = \
+                manifest.sections.get(section, 0) + member.size
+            span.add('bytes', member.size)
+
+            match = REPO_PATH.match(name)
+            if match:
+                _index_git(manifest, tar, member, name, match, objects)
+                continue
+
+            match = MODEL_FILE.match(name)
+            if match:
+                _index_model(manifest, tar.extractfile(member),
+                             match.group(1))
+
+            if member.size >= threshold:
+                manifest.outlier(member.size, None, name, 'file')
+
+    return manifest
+
+def _index_git(manifest, tar, member, where, match, objects):
+    owner, repo, wiki, path = match.groups()
+    name = '%s/%s' % (owner, repo)
+    entry = manifest.repo(name)
+    entry['wiki_bytes' if wiki else 'bytes'] += member.size
+    if not objects:
+        return
+
+    if path.startswith('objects/pack/') and path.endswith('.pack'):
+        for offset, kind, size in scan_pack(
+            tar.extractfile(member), manifest.threshold
+        ):
+            manifest.outlier(size, name, '%s@%d' % (where, offset), kind)
+    elif re.match(r'^objects/[0-9a-f]{2}/[0-9a-f]{38}$', path):
+        kind, size = loose_object(tar.extractfile(member))
+        if size >= manifest.threshold:
+            manifest.outlier(size, name, where, kind)
+
+def _index_model(manifest, f, model):
+    count = 0
+    for record in iter_records(f):
+        count += 1
+        if not isinstance(record, dict):
+            continue
+        repo = record_repo(model, record)
+        if repo is not None:
+            records = manifest.repo(repo)['records']
+            records[model] = records.get(model, 0) + 1
+    manifest.models[model] = manifest.models.get(model, 0) + count
@@ -0,0 +1,225 @@
+import re
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .planner import format_size
+from .ssh import stream
+from .trace import tracer
+
+Sample = namedtuple('Sample', ['load', 'cpus', 'free', 'queue'])
+
+# One command reports everything, so a sample costs a single SSH channel.
+SAMPLE_CMD = (
+    'cat /proc/loadavg; nproc; df -P -B1 %s | tail -n 1; echo "%s"; '
+    'ghe-resque-info 2>/dev/null || true'
+)
+QUEUE_MARKER = '__ghe_queues__'
+QUEUE_LINE = re.compile(r'^\s*(\S+)\s+(\d+)\s*$')
+
+
+def parse_sample(lines):
+    """ Parse the output of SAMPLE_CMD into a Sample.
+
+    Values that could not be read are None.
+    """
+
+    head, queues = [], []
+    target = head
+    for line in lines:
+        if line.strip() == QUEUE_MARKER:
+            target = queues
+        else:
+            target.append(line)
+
+    def field(index, pos, cast):
+        try:
+            return cast(head[index].split()[pos])
+        except (IndexError, ValueError):
+            return None
+
+    depth = [
+        int(match.group(2))
+        for match in (QUEUE_LINE.match(line) for line in queues) if match
+    ]
+
+    return Sample(
+        field(0, 0, float),
+        field(1, 0, int),
+        field(2, 3, int),
+        sum(depth) if depth else None
+    )
+
+def parse_hours(s):
+    """ Parse an `HH-HH` range of hours such as `19-7` into a tuple. """
+
+    start, sep, end = s.partition('-')
+    hours = (int(start), int(end))
+    if not sep or not all(0 <= hour < 24 for hour in hours):
+        raise ValueError('%r is not a range of hours like 19-7' % s)
+
+    return hours
+
+def in_hours(hours, now=None):
+    """ Whether local time `now` is within `hours` or on a weekend. """
+
+    now = time.localtime(now)
+    if now.tm_wday >= 5:
+        return True
+
+    start, end = hours
+    if start <= end:
+        return start <= now.tm_hour < end
+
+    return now.tm_hour >= start or now.tm_hour < end
+
+
+class Backpressure(object):
+    """ Admits heavy migration stages according to the appliance's load.
+
+    The load average per CPU, the free space on `path` and the depth of the
+    background job queues are sampled over SSH at most every `interval`
+    seconds. While any of them is past its threshold, new stages wait; the
+    stages already running carry on. Each sample over a threshold halves
+    the number of stages allowed at once, and each sample under them lets
+    one more in, up to `limit`.
+
+    During `off_hours` (and at weekends) only the disk threshold applies,
+    so the number of stages ramps back up to `limit`. Without any threshold
+    every stage is admitted straight away.
+    """
+
+    def __init__(self, client, max_load=None, min_free=None, max_queue=None,
+                 off_hours=None, limit=1, interval=30,
+                 stages=('prepare', 'import'), path='/data/user'):
+        """ Initial setup. """
+
+        self.client = client
+        self.max_load = max_load
+        self.min_free = min_free
+        self.max_queue = max_queue
+        self.off_hours = off_hours
+        self.limit = max(1, limit)
+        self.interval = interval
+        self.stages = stages
+        self.path = path
+
+        self.allowed = self.limit
+        self.active = 0
+        self.reason = None
+        self.sampled = 0
+        self.cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        """ Whether any threshold is set. """
+
+        return any(value is not None for value in (
+            self.max_load, self.min_free, self.max_queue
+        ))
+
+    @contextmanager
+    def admit(self, stage):
+        """ Wait until a stage may start, and count it while it runs. """
+
+        if not self.enabled or stage not in self.stages:
+            yield
+            return
+
+        start = time.time()
+        with self.cond:
+            while self.check() or self.active >= self.allowed:
+                self.cond.wait(min(self.interval, 5))
+            self.active += 1
+
+        waited = time.time() - start
+        if waited > 1:
+            tracer.count('ghe_backpressure_wait_seconds_total', waited,
+                         stage=stage)
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def check(self):
+        """ Sample the appliance when due; return why stages are held.
+
+        Returns None when new stages may start. Must be called with `cond`
+        held.
+        """
+
+        now = time.time()
+        if now - self.sampled < self.interval:
+            return self.reason
+        self.sampled = now
+
+        try:
+            sample = self.sample()
+        except Exception as err:
+            # An appliance we cannot read is not held back.
+            print('Unable to sample appliance load: %s' % err)
+            sample = Sample(None, None, None, None)
+
+        reason = self.over(sample, now)
+        if reason:
+            self.allowed = max(1, self.allowed // 2)
+        else:
+            self.allowed = min(self.limit, self.allowed + 1)
+
+        if reason and reason != self.reason:
+            print('Appliance busy (%s); holding new %s stages.' % (
+                reason, ' and '.join(self.stages)
+            ))
+        elif self.reason and not reason:
+            print('Appliance load is back under limits; admitting %d %s.' % (
+                self.allowed, 'stage' if self.allowed == 1 else 'stages'
+            ))
+        self.reason = reason
+        tracer.gauge('ghe_backpressure_allowed_stages', self.allowed)
+
+        return reason
+
+    def sample(self):
+        """ Read the load, free disk and queue depth of the appliance. """
+
+        sample = parse_sample(stream(
+            self.client, SAMPLE_CMD % (self.path, QUEUE_MARKER),
+            name='backpressure sample'
+        ))
+
+        for name, value in zip(
+                ('load', 'free_bytes', 'queue_depth'),
+                (sample.load, sample.free, sample.queue)):
+            if value is not None:
+                tracer.gauge('ghe_appliance_%s' % name, value)
+
+        return sample
+
+    def over(self, sample, now=None):
+        """ Describe the first threshold a sample is past, or None. """
+
+        if self.min_free is not None and sample.free is not None and \
+                sample.free < self.min_free:
+            return '%s free on %s, need %s' % (
+                format_size(sample.free), self.path,
+                format_size(self.min_free)
+            )
+
+        if self.off_hours and in_hours(self.off_hours, now):
+            return None
+
+        if self.max_load is not None and sample.load is not None:
+            load = sample.load / (sample.cpus or 1)
+            if load > self.max_load:
+                return 'load %.2f per CPU, limit %.2f' % (load, self.max_load)
+
+        if self.max_queue is not None and sample.queue is not None and \
+                sample.queue > self.max_queue:
+            return '%d queued jobs, limit %d' % (sample.queue, self.max_queue)
+
+        return None
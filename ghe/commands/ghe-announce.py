@@ -2,7 +2,10 @@
 """
 """
 
-import argparse, os, paramiko, sys
+import argparse, os, sys
+
+from ghe.ssh import connect, run_batch, stream, watch
+from ghe.status import StatusCache, format_time
 
 class Announce(object):
 
@@ -14,49 +17,97 @@ class Announce(object):
         self.ghe_ssh_user = kwargs.get('ghe_ssh_user')
         self.debug = kwargs.get('debug', False)
 
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        args = {
-            'username': self.ghe_ssh_user,
-            'port': self.ghe_ssh_port,
-            'look_for_keys': False
-        }
-
-        self.client.connect(self.ghe_host, **args)
+        self.cache = StatusCache(self.ghe_host)
+        self.client = connect(
+            self.ghe_host, self.ghe_ssh_port, self.ghe_ssh_user
+        )
 
     def announce(self, announcement):
         ''' Set an announcement banner on Github Enterprise '''
 
         print('Setting announcement banner...')
-        self.run_ssh('ghe-announce -s "{0!s}"'.format(announcement))
+        return self.change('ghe-announce -s "{0!s}"'.format(announcement))
 
     def clear(self):
         ''' Clear announcement banner on Github Enterprise '''
 
         print('Clearing announcement banner...')
-        res = self.run_ssh('ghe-announce -u')
+        return self.change('ghe-announce -u')
 
     def status(self):
         ''' Get the status of an announcement banner on Github Enterprise '''
 
-        res = self.run_ssh('ghe-announce -g')
+        status = self.parse_status(self.run_ssh('ghe-announce -g'))
+        self.cache.set('announce', status)
+
+        return status
+
+    def watch(self, interval):
+        ''' Print the announcement banner whenever it changes. '''
+
+        def polled(status, ts):
+            self.cache.set('announce', status, ts)
+
+        def changed(status, previous, ts):
+            print('[%s] %s' % (format_time(ts), status))
+
+        watch(self.client, 'ghe-announce -g', interval,
+              self.parse_status, changed, polled)
 
-        return res[0].rstrip()
+    @staticmethod
+    def parse_status(res):
+        ''' Parse the output of `ghe-announce -g`. '''
+
+        return res[0].rstrip() if res else ''
 
     def run_ssh(self, cmd):
         ''' Run the command on the SSH connection to the GHE server. '''
 
         if self.debug: print(' - {0}'.format(cmd))
-        stdin, stdout, stderr = self.client.exec_command(cmd)
 
         ret = []
-        for line in stdout:
-            if self.debug: print(' + {0}'.format(line.encode('utf-8').rstrip()))
+        for line in stream(self.client, cmd):
+            if self.debug: print(' + {0}'.format(line.rstrip()))
             ret.append(line)
 
         return ret
 
+    def run_batch(self, cmds):
+        ''' Run several commands on the SSH connection in one round trip.
+
+        Stops at the first command that fails; returns a BatchResult for
+        each command.
+        '''
+
+        if self.debug:
+            for cmd in cmds: print(' - {0}'.format(cmd))
+
+        results = run_batch(self.client, cmds, stop=True)
+        if self.debug:
+            for res in results:
+                for line in res.output: print(' + {0}'.format(line.rstrip()))
+
+        return results
+
+    def change(self, cmd):
+        ''' Run a change and read the status back in the same round trip.
+
+        Returns the new status, or None if the change failed.
+        '''
+
+        change, query = self.run_batch([cmd, 'ghe-announce -g'])
+        if change.status is None:
+            print('%s did not finish.' % cmd.split(' ', 1)[0])
+            return None
+        if change.status != 0:
+            print('%s exited with %d.' % (cmd.split(' ', 1)[0], change.status))
+            return None
+
+        status = self.parse_status(query.output)
+        self.cache.set('announce', status)
+
+        return status
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Tool to manage Github Enterprises announcement banner.',
@@ -66,7 +117,9 @@ if __name__ == '__main__':
             'To set the announcement banner on the GHE server:\n'
             '	GHE> announce Your announcement message\n\n'
             'To clear the announcement banner on the GHE server:\n'
-            '	$ ghe announce --clear'
+            '	$ ghe announce --clear\n\n'
+            'To watch the announcement banner for changes every 30 seconds:\n'
+            '	$ ghe announce -watch 30'
         ),
         formatter_class=argparse.RawTextHelpFormatter
     )
@@ -79,6 +132,21 @@ if __name__ == '__main__':
         help='clear the announcement banner from the GHE server.',
         action='store_true'
     )
+    parser.add_argument('-watch',
+        help=(
+            'keep polling the announcement banner every SECONDS and print it '
+            'whenever it changes'
+        ),
+        metavar='SECONDS',
+        type=int
+    )
+    parser.add_argument('-cached',
+        help=(
+            'print the last known announcement banner from the local cache '
+            'without connecting to the GHE server'
+        ),
+        action='store_true'
+    )
     parser.add_argument('-ghe-host',
         help=(
             'the hostname to your GitHub Enterprise server '
@@ -122,6 +190,15 @@ if __name__ == '__main__':
             'GitHub Enterprise SSH user not set. Please use -ghe-ssh-user USER.'
         )
 
+    if args.cached:
+        status, updated = StatusCache(args.ghe_host).get('announce')
+        if status is None:
+            print('Announcement banner has not been cached yet.')
+            sys.exit(1)
+
+        print('%s (as of %s)' % (status, format_time(updated)))
+        sys.exit(0)
+
     app = Announce(
         ghe_host=args.ghe_host,
         ghe_ssh_port=args.ghe_ssh_port,
@@ -129,9 +206,20 @@ if __name__ == '__main__':
         debug=args.debug
     )
 
+    status = None
     if args.clear:
-        app.clear()
+        status = app.clear()
     elif len(args.message):
-        app.announce(' '.join(*[args.message]))
+        status = app.announce(' '.join(*[args.message]))
+
+    if args.watch:
+        try:
+            app.watch(args.watch)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if status is None:
+        status = app.status()
 
-    print(app.status())
+    print(status)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+ghe-archive.py - GitHub Migration Archive Inspector
+
+usage: ghe-archive.py [-h] [-ssh] [-gh-org ORG] [-large SIZE] [-top N]
+                      [-no-objects] [-json] [-ghe-host HOST]
+                      [-ghe-ssh-port PORT] [-ghe-ssh-user USER]
+                      [-gh-api-url URL] [-gh-token TOKEN]
+                      ARCHIVE
+
+Tool to list what a migration archive holds, reading it as a stream in one
+pass without extracting it.
+
+positional arguments:
+  ARCHIVE             the .tar.gz migration archive, `-` to read it from
+                      stdin, a path on the GitHub Enterprise server with
+                      -ssh, or a migration id with -gh-org
+
+optional arguments:
+  -h, --help          show this help message and exit
+  -ssh                read ARCHIVE from the GitHub Enterprise server over SSH,
+                      e.g. one left behind by a failed `ghe-migrator prepare`
+  -gh-org ORG         ARCHIVE is the id of a migration of ORG on GitHub;
+                      stream its archive from the API
+  -large SIZE         report git objects and files of at least this size
+                      (default: 100M)
+  -top N              the number of large objects and files to list
+                      (default: 20)
+  -no-objects         don't scan pack files for large objects
+  -json               print the whole manifest as JSON
+  -ghe-host HOST      the hostname to your GitHub Enterprise server (default:
+                      value from `ghe-host` environment variable)
+  -ghe-ssh-port PORT  the port to your GitHub Enterprise SSH server (default:
+                      122, or value from `ghe-ssh-port` environment variable)
+  -ghe-ssh-user USER  the user to use for SSH access to your GitHub Enterprise
+                      server (default: value from `ghe-ssh-user` environment
+                      variable)
+  -gh-api-url URL     the GitHub API endpoint of ORG (default:
+                      https://api.github.com, or value from `gh-api-url`
+                      environment variable)
+  -gh-token TOKEN     GitHub.com access token for an account with admin
+                      priveleges on ORG (default: value from `gh-token`
+                      environment variable)
+
+Repositories are listed largest first, with the issues, pull requests and
+other records that belong to them, to find the repos that make a batch slow
+or fail and move them to a batch of their own.
+"""
+
+import argparse, json, os, requests, sys, tarfile, time, zlib
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from ghe import __title__, __version__
+from ghe.archive import LARGE, index
+from ghe.planner import format_size, parse_size
+from ghe.ratelimit import LOW, govern
+from ghe.ssh import connect
+from ghe.trace import tracer
+
+class Archive(object):
+
+    def __init__(self, **kwargs):
+        ''' Constructor. '''
+
+        self.archive = kwargs.get('archive')
+        self.ssh = kwargs.get('ssh')
+        self.gh_org = kwargs.get('gh_org')
+        self.ghe_host = kwargs.get('ghe_host')
+        self.ghe_ssh_port = kwargs.get('ghe_ssh_port')
+        self.ghe_ssh_user = kwargs.get('ghe_ssh_user')
+        self.gh_api_url = kwargs.get('gh_api_url', 'https://api.github.com')
+        self.gh_token = kwargs.get('gh_token')
+
+        self.errors = None
+
+    def open(self):
+        ''' Open the archive as a stream, wherever it is. '''
+
+        if self.ssh:
+            client = connect(
+                self.ghe_host, self.ghe_ssh_port, self.ghe_ssh_user
+            )
+            stdin, stdout, self.errors = client.exec_command(
+                'cat %s' % quote(self.archive)
+            )
+            return stdout
+
+        if self.gh_org:
+            session = govern(
+                tracer.instrument(requests.Session()), self.gh_token, LOW
+            )
+            session.headers.update({
+                'Authorization': 'token %s' % self.gh_token,
+                'Accept': 'application/vnd.github.wyandotte-preview+json',
+                'User-Agent': '%s/%s' % (__title__, __version__)
+            })
+            # The API redirects to the archive's storage, which gets the
+            # request without the token.
+            res = session.get('%s/orgs/%s/migrations/%s/archive' % (
+                self.gh_api_url, self.gh_org, self.archive
+            ), stream=True)
+            res.raise_for_status()
+            return res.raw
+
+        if self.archive == '-':
+            return getattr(sys.stdin, 'buffer', sys.stdin)
+
+        return open(self.archive, 'rb')
+
+    def inspect(self, large=LARGE, top=20, objects=True):
+        ''' Index the archive in one pass; return its Manifest. '''
+
+        f = self.open()
+        try:
+            return index(f, threshold=large, top=top, objects=objects)
+        finally:
+            f.close()
+
+    @staticmethod
+    def print_manifest(manifest):
+        ''' Print the records, repositories and outliers of an archive. '''
+
+        print('%d files, %s.' % (
+            manifest.members, format_size(manifest.bytes)
+        ))
+        for section, size in sorted(manifest.sections.items()):
+            print('  %-24s %10s' % (section, format_size(size)))
+
+        print('\nRecords:')
+        for model, count in sorted(manifest.models.items()):
+            print('  %-24s %10d' % (model, count))
+
+        print('\n%10s %10s %7s %7s %8s  %s' % (
+            'git', 'wiki', 'issues', 'pulls', 'records', 'repository'
+        ))
+        for name, repo in sorted(manifest.repos.items(),
+                                 key=lambda item: -item[1]['bytes']):
+            records = repo['records']
+            print('%10s %10s %7d %7d %8d  %s' % (
+                format_size(repo['bytes']), format_size(repo['wiki_bytes']),
+                records.get('issues', 0), records.get('pull_requests', 0),
+                sum(records.values()), name
+            ))
+
+        if manifest.large:
+            print('\n%d objects and files of %s or more%s:' % (
+                manifest.large, format_size(manifest.threshold),
+                ', largest first' if manifest.large <= manifest.top else
+                ', the %d largest' % manifest.top
+            ))
+            for outlier in manifest.largest():
+                print('%10s %-6s %s' % (
+                    format_size(outlier.size), outlier.kind, outlier.path
+                ))
+
+
+def _is_valid_size(s):
+    ''' Argparse type helper - is passed value a valid size. '''
+
+    try:
+        return parse_size(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"%s" is not a valid size.' % s)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Tool to list what a migration archive holds, reading it as a '
+            'stream in one pass without extracting it.'
+        )
+    )
+    parser.add_argument('archive',
+        help=(
+            'the .tar.gz migration archive, `-` to read it from stdin, a path '
+            'on the GitHub Enterprise server with -ssh, or a migration id '
+            'with -gh-org'
+        ),
+        metavar='ARCHIVE'
+    )
+    parser.add_argument('-ssh',
+        help=(
+            'read ARCHIVE from the GitHub Enterprise server over SSH, e.g. '
+            'one left behind by a failed `ghe-migrator prepare`'
+        ),
+        action='store_true'
+    )
+    parser.add_argument('-gh-org',
+        help=(
+            'ARCHIVE is the id of a migration of ORG on GitHub; stream its '
+            'archive from the API'
+        ),
+        metavar='ORG'
+    )
+    parser.add_argument('-large',
+        help=(
+            'report git objects and files of at least this size '
+            '(default: 100M)'
+        ),
+        metavar='SIZE',
+        type=_is_valid_size,
+        default=LARGE
+    )
+    parser.add_argument('-top',
+        help='the number of large objects and files to list (default: 20)',
+        metavar='N',
+        type=int,
+        default=20
+    )
+    parser.add_argument('-no-objects',
+        help='don\'t scan pack files for large objects',
+        action='store_true'
+    )
+    parser.add_argument('-json',
+        help='print the whole manifest as JSON',
+        action='store_true'
+    )
+    parser.add_argument('-ghe-host',
+        help=(
+            'the hostname to your GitHub Enterprise server '
+            '(default: value from `ghe-host` environment variable)'
+        ),
+        metavar='HOST',
+        default=os.getenv('ghe-host')
+    )
+    parser.add_argument('-ghe-ssh-port',
+        help=(
+            'the port to your GitHub Enterprise SSH server '
+            '(default: 122, or value from `ghe-ssh-port` environment variable)'
+        ),
+        metavar='PORT',
+        type=int,
+        default=os.getenv('ghe-ssh-port', 122)
+    )
+    parser.add_argument('-ghe-ssh-user',
+        help=(
+            'the user to use for SSH access to your GitHub Enterprise server '
+            '(default: value from `ghe-ssh-user` environment variable)'
+        ),
+        metavar='USER',
+        type=str,
+        default=os.getenv('ghe-ssh-user')
+    )
+    parser.add_argument('-gh-api-url',
+        help=(
+            'the GitHub API endpoint of ORG (default: https://api.github.com, '
+            'or value from `gh-api-url` environment variable)'
+        ),
+        metavar='URL',
+        type=str,
+        default=os.getenv('gh-api-url', 'https://api.github.com')
+    )
+    parser.add_argument('-gh-token',
+        help=(
+            'GitHub.com access token for an account with admin priveleges on '
+            'ORG (default: value from `gh-token` environment variable)'
+        ),
+        metavar='TOKEN',
+        type=str,
+        default=os.getenv('gh-token')
+    )
+
+    args = parser.parse_args()
+
+    if args.ssh and args.gh_org:
+        parser.error('Use either -ssh or -gh-org, not both.')
+
+    if args.ssh and not (args.ghe_host):
+        parser.error(
+            'GitHub Enterprise host not set. Please use -ghe-host HOST.'
+        )
+
+    if args.ssh and not (args.ghe_ssh_user):
+        parser.error(
+            'GitHub Enterprise SSH user not set. Please use -ghe-ssh-user USER.'
+        )
+
+    if args.gh_org and not (args.gh_token):
+        parser.error('GitHub.com token not set. Please use -gh-token TOKEN.')
+
+    if not (args.ssh or args.gh_org or args.archive == '-') and \
+            not os.path.isfile(args.archive):
+        parser.error('%s: no such file.' % args.archive)
+
+    app = Archive(
+        archive=args.archive,
+        ssh=args.ssh,
+        gh_org=args.gh_org,
+        ghe_host=args.ghe_host,
+        ghe_ssh_port=args.ghe_ssh_port,
+        ghe_ssh_user=args.ghe_ssh_user,
+        gh_api_url=args.gh_api_url.rstrip('/'),
+        gh_token=args.gh_token
+    )
+
+    start = time.time()
+    # RequestException subclasses IOError, so it is caught first.
+    try:
+        manifest = app.inspect(args.large, args.top, not args.no_objects)
+    except requests.exceptions.RequestException as err:
+        print('Unable to download migration %s: %s' % (args.archive, err))
+        sys.exit(1)
+    except (EOFError, IOError, OSError, ValueError, tarfile.TarError,
+            zlib.error) as err:
+        # Over SSH, `cat` says why the stream ended, e.g. a missing file.
+        reason = app.errors and app.errors.read().decode('utf-8', 'replace')
+        print('Unable to read %s: %s' % (
+            args.archive, reason.strip() if reason else err
+        ))
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(manifest.as_dict(), indent=2, sort_keys=True))
+    else:
+        app.print_manifest(manifest)
+        print('\nRead in %.1fs.' % (time.time() - start))
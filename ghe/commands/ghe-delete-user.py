@@ -19,9 +19,11 @@ optional arguments:
   -debug          enable debug mode
 """
 
-import argparse, os, pyotp, sys
+import argparse, os, sys
 from builtins import input
-from seleniumrequests import PhantomJS
+
+from ghe.stafftools import LoginError, login
+from ghe.users import UserIndex
 
 class DeleteUser(object):
 
@@ -37,35 +39,13 @@ class DeleteUser(object):
     def delete(self, user):
         ''' Delete the user on Github Enterprise '''
 
-        # Initialize the PhantomJS selenium driver
-        driver = PhantomJS()
-        driver.implicitly_wait(10)
-        driver.set_window_size(1400, 850)
-
-        # Login as the admin user
-        driver.get('https://%s/login' % (self.ghe_host))
-        driver.find_element_by_name('login').send_keys(self.ghe_user)
-        driver.find_element_by_name('password').send_keys(self.ghe_pass)
-        driver.find_element_by_name('commit').click()
-
-        # Check for two-factor auth code request
-        if driver.current_url == 'https://%s/sessions/two-factor' % self.ghe_host:
-            if self.ghe_totp:
-                base = '.auth-form-body input'
-                u = driver.find_element_by_css_selector('%s[name=utf8]' % base)
-                t = driver.find_element_by_css_selector('%s[name=authenticity_token]' % base)
-                otp = pyotp.TOTP(self.ghe_totp)
-
-                driver.request('POST', 'https://%s/sessions/two-factor' % self.ghe_host,
-                    data={
-                        'utf8': u.get_attribute('value'),
-                        'otp': otp.now(),
-                        'authenticity_token': t.get_attribute('value')
-                    }
-                )
-            else:
-                print('Two-Factor authentication required.')
-                sys.exit()
+        try:
+            driver = login(
+                self.ghe_host, self.ghe_user, self.ghe_pass, self.ghe_totp
+            )
+        except LoginError as err:
+            print(err)
+            sys.exit()
 
         # Retrieve the admin page for the designated user to be deleted
         driver.get('https://%s/stafftools/users/%s/admin' % (self.ghe_host, user))
@@ -159,6 +139,14 @@ if __name__ == '__main__':
         debug=args.debug
     )
 
+    # Rule out unknown users before the slow sign in to the web interface.
+    if args.user and UserIndex(args.ghe_host).rules_out(args.user):
+        print(
+            'User "%s" is not in the user index of %s; run `users -refresh` '
+            'if it was created recently.' % (args.user, args.ghe_host)
+        )
+        sys.exit(1)
+
     if args.user:
         if not args.no_confirm:
             answer = input('Are you sure you want to delete the user "%s"? [y/n] ' % args.user)
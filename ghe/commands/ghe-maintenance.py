@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 """
 usage: ghe-maintenance.py [-h] [-ghe-host HOST] [-ghe-ssh-port PORT]
-                          [-ghe-ssh-user USER] [-debug]
+                          [-ghe-ssh-user USER] [-watch SECONDS] [-cached]
+                          [-debug]
                           [value]
 
 Tool to manage Github Enterprises maintenance status.
@@ -19,6 +20,10 @@ optional arguments:
   -ghe-ssh-user USER  the user to use for SSH access to your GitHub Enterprise
                       server (default: value from `ghe-ssh-user` environment
                       variable)
+  -watch SECONDS      keep polling the maintenance status every SECONDS and
+                      print it whenever it changes
+  -cached             print the last known status from the local cache
+                      without connecting to the GHE server
   -debug              enable debug mode
 
 To retrieve the current maintenance status of the GHE server:
@@ -30,10 +35,16 @@ To enable maintenance mode on the GHE server:
 To disable maintenance mode on the GHE server:
 	$ ghe maintenance off
 
+To watch the maintenance status for changes every 30 seconds:
+	$ ghe maintenance -watch 30
+
 Accepted values: 'on'|'off', 'yes'|'no', 'true'|'false', 't'|'f', 'y'|'n, '1'|'0'
 """
 
-import argparse, os, paramiko
+import argparse, os, sys
+
+from ghe.ssh import connect, run_batch, stream, watch
+from ghe.status import StatusCache, format_time
 
 class Maintenance(object):
 
@@ -45,34 +56,50 @@ class Maintenance(object):
         self.ghe_ssh_user = kwargs.get('ghe_ssh_user')
         self.debug = kwargs.get('debug', False)
 
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        args = {
-            'username': self.ghe_ssh_user,
-            'port': self.ghe_ssh_port,
-            'look_for_keys': False
-        }
-
-        self.client.connect(self.ghe_host, **args)
+        self.cache = StatusCache(self.ghe_host)
+        self.client = connect(
+            self.ghe_host, self.ghe_ssh_port, self.ghe_ssh_user
+        )
 
     def enable(self):
         ''' Enable maintenance mode on Github Enterprise '''
 
         print('Enabling maintenance mode...')
-        self.run_ssh('ghe-maintenance -s')
+        return self.change('ghe-maintenance -s')
 
     def disable(self):
         ''' Disable maintenance mode on Github Enterprise '''
 
         print('Disabling maintenance mode...')
-        self.run_ssh('ghe-maintenance -u')
+        return self.change('ghe-maintenance -u')
 
     def status(self):
         ''' Get the status of maintenance mode on Github Enterprise '''
 
-        res = self.run_ssh('ghe-maintenance -q')
-        if 'maintenance mode not set' in res[0]:
+        status = self.parse_status(self.run_ssh('ghe-maintenance -q'))
+        self.cache.set('maintenance', status)
+
+        return status
+
+    def watch(self, interval):
+        ''' Print the maintenance status whenever it changes. '''
+
+        def polled(status, ts):
+            self.cache.set('maintenance', status, ts)
+
+        def changed(status, previous, ts):
+            print('[%s] Maintenance mode is currently: %s' % (
+                format_time(ts), 'ON' if status else 'OFF'
+            ))
+
+        watch(self.client, 'ghe-maintenance -q', interval,
+              self.parse_status, changed, polled)
+
+    @staticmethod
+    def parse_status(res):
+        ''' Parse the output of `ghe-maintenance -q`. '''
+
+        if not res or 'maintenance mode not set' in res[0]:
             return False
         else:
             return True
@@ -81,15 +108,50 @@ class Maintenance(object):
         ''' Run the command on the SSH connection to the GHE server. '''
 
         if self.debug: print(' - {0}'.format(cmd))
-        stdin, stdout, stderr = self.client.exec_command(cmd)
 
         ret = []
-        for line in stdout:
-            if self.debug: print(' + {0}'.format(line.encode('utf-8').rstrip()))
+        for line in stream(self.client, cmd):
+            if self.debug: print(' + {0}'.format(line.rstrip()))
             ret.append(line)
 
         return ret
 
+    def run_batch(self, cmds):
+        ''' Run several commands on the SSH connection in one round trip.
+
+        Stops at the first command that fails; returns a BatchResult for
+        each command.
+        '''
+
+        if self.debug:
+            for cmd in cmds: print(' - {0}'.format(cmd))
+
+        results = run_batch(self.client, cmds, stop=True)
+        if self.debug:
+            for res in results:
+                for line in res.output: print(' + {0}'.format(line.rstrip()))
+
+        return results
+
+    def change(self, cmd):
+        ''' Run a change and read the status back in the same round trip.
+
+        Returns the new status, or None if the change failed.
+        '''
+
+        change, query = self.run_batch([cmd, 'ghe-maintenance -q'])
+        if change.status is None:
+            print('%s did not finish.' % cmd.split(' ', 1)[0])
+            return None
+        if change.status != 0:
+            print('%s exited with %d.' % (cmd.split(' ', 1)[0], change.status))
+            return None
+
+        status = self.parse_status(query.output)
+        self.cache.set('maintenance', status)
+
+        return status
+
 def str2bool(v):
     if v.lower() in ('on', 'yes', 'true', 't', 'y', '1'):
         return True
@@ -142,6 +204,21 @@ if __name__ == '__main__':
         type=str,
         default=os.getenv('ghe-ssh-user')
     )
+    parser.add_argument('-watch',
+        help=(
+            'keep polling the maintenance status every SECONDS and print it '
+            'whenever it changes'
+        ),
+        metavar='SECONDS',
+        type=int
+    )
+    parser.add_argument('-cached',
+        help=(
+            'print the last known status from the local cache without '
+            'connecting to the GHE server'
+        ),
+        action='store_true'
+    )
     parser.add_argument('-debug',
         help='enable debug mode',
         action='store_true'
@@ -159,6 +236,17 @@ if __name__ == '__main__':
             'GitHub Enterprise SSH user not set. Please use -ghe-ssh-user USER.'
         )
 
+    if args.cached:
+        status, updated = StatusCache(args.ghe_host).get('maintenance')
+        if status is None:
+            print('Maintenance mode status has not been cached yet.')
+            sys.exit(1)
+
+        print('Maintenance mode was: %s (as of %s)' % (
+            'ON' if status else 'OFF', format_time(updated)
+        ))
+        sys.exit(0)
+
     app = Maintenance(
         ghe_host=args.ghe_host,
         ghe_ssh_port=args.ghe_ssh_port,
@@ -166,9 +254,20 @@ if __name__ == '__main__':
         debug=args.debug
     )
 
+    status = None
     if args.value is True:
-        app.enable()
+        status = app.enable()
     elif args.value is False:
-        app.disable()
+        status = app.disable()
+
+    if args.watch:
+        try:
+            app.watch(args.watch)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if status is None:
+        status = app.status()
 
-    print('Maintenance mode is currently: %s' % ('ON' if app.status() else 'OFF'))
+    print('Maintenance mode is currently: %s' % ('ON' if status else 'OFF'))
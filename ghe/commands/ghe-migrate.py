@@ -2,14 +2,21 @@
 """
 ghe-migrate.py - GitHub to GitHub Enterprise Migration Helper Tool
 
-usage: ghe-migrate.py [-h] [-repos REPOS] [-file REPOS] [-all] [-batch INT]
+usage: ghe-migrate.py [-h] [-repos REPOS] [-file REPOS] [-all] [-orgs FILE]
+                      [-batch INT]
+                      [-batch-size SIZE] [-concurrency INT]
+                      [-incremental] [-max-load FLOAT] [-min-free SIZE]
+                      [-max-queue INT] [-off-hours HOURS] [-cutover]
+                      [-verify] [-verify-issues] [-plan]
                       [-ghe-host HOST] [-ghe-port PORT] [-ghe-user USER]
-                      source [dest]
+                      [-resolve-all] [-user-map FILE]
+                      [-conflict-rules FILE]
+                      [source] [dest]
 
 Tool to perform GitHub to GitHub Enterprise migrations.
 
 positional arguments:
-  source          the organization to migrate
+  source          the organization to migrate (not used with -orgs)
   dest            the destination organization
 
 optional arguments:
@@ -17,7 +24,34 @@ optional arguments:
   -repos REPOS         comma separated list of repos
   -file REPOS          file with one repo per line
   -all                 use all repos from organization
+  -orgs FILE           CSV file of `source,dest` organization pairs to migrate
+                       all repos of in one run; batches of every org share the
+                       -concurrency and backpressure limits
   -batch INT           number of repos to process per batch (default: 100)
+  -batch-size SIZE     pack repos into batches of at most SIZE bytes (e.g.
+                       500M, 10G), largest repos first
+  -concurrency INT     number of batches to prepare and import on the GHE
+                       server at the same time (default: 1)
+  -incremental         push new commits of repos that already exist on GHE
+                       over git instead of exporting them again
+  -max-load FLOAT      hold new prepare and import stages while the
+                       appliance's load average per CPU is above FLOAT
+  -min-free SIZE       hold new prepare and import stages while /data/user
+                       has less than SIZE free (e.g. 100G)
+  -max-queue INT       hold new prepare and import stages while more than INT
+                       background jobs are queued on the appliance
+  -off-hours HOURS     local hours, such as 19-7, when -max-load and
+                       -max-queue are lifted; weekends are always off-hours
+  -cutover             after the migration, lock the repos pushed to since
+                       they were listed on GitHub and push their final
+                       commits to GHE over git
+  -verify              check each imported repo against GitHub in the
+                       background: default branch, its head and every branch
+                       and tag
+  -verify-issues       with -verify, also compare issue and pull request
+                       totals
+  -plan                list the batches and predict how long each stage
+                       takes from past runs, without migrating anything
   -ghe-host HOST       the hostname to your GitHub Enterprise server (default:
                        value from `ghe-host` environment variable)
   -ghe-ssh-port PORT   the port to your GitHub Enterprise SSH server (default:
@@ -35,8 +69,12 @@ optional arguments:
                        the destination GHE instance (default: value from
                        `ghe-token` environment variable)
   -resolve-all         attempt to automatically resolve all conflicts
+  -user-map FILE       CSV file of `github_login,ghe_login` pairs used to map
+                       users when resolving conflicts
+  -conflict-rules FILE YAML file of user mappings and conflict rewriting rules
+                       applied when resolving conflicts
 
-You must use one of -repos, -file or -all.
+You must use one of -repos, -file, -all or -orgs.
 
 If you are running ghe-migrate.py as a sub-command to ghe, then all environment
 variables will be passed on to it appropriately from the central keyring
@@ -44,9 +82,27 @@ provider (MacOSX Keychain). This method is prefered as all you will need to
 provide are the repos, source and destination organizations.
 """
 
-import argparse, csv, math, os, paramiko, re, requests, sys, tempfile, time
-
-from github import Github
+import argparse, calendar, copy, csv, math, os, re, requests, sys, tempfile
+import threading, time
+import yaml
+
+from ghe import conflicts as conflicts_csv
+from ghe.backpressure import Backpressure, parse_hours
+from ghe.conflicts import ConflictResolver, load_rules, load_user_map
+from ghe.credentials import CredentialPool
+from ghe.history import Estimator, History, format_duration, schedule
+from ghe.inventory import OrgInventory, RepoInfo
+from ghe.mirror import GitError, MirrorCache, check_git, credential, \
+    repo_url
+from ghe.planner import format_size, parse_size, plan_batches
+from ghe.ratelimit import HIGH, LOW, govern
+from ghe.ssh import connect, gather, iter_batch, label, stream
+from ghe.trace import Span, tracer
+from ghe.verify import RepoState, Verifier, compare
+try:
+    from ghe import aio
+except (ImportError, SyntaxError):
+    aio = None
 from subprocess import call
 try:
     from StringIO import StringIO
@@ -54,8 +110,58 @@ except ImportError:
     from io import StringIO
 
 from builtins import input
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
+PROGRESS = re.compile(r'(\d+)% complete')
+
+class MigrationError(Exception):
+    ''' A migration stage failed on the GHE server. '''
+
+
+def export_seconds(migration, span):
+    ''' How long GitHub took to export, from the migration's timestamps. '''
+
+    try:
+        created, updated = [
+            calendar.timegm(time.strptime(
+                migration[key], '%Y-%m-%dT%H:%M:%SZ'
+            ))
+            for key in ('created_at', 'updated_at')
+        ]
+    except (KeyError, TypeError, ValueError):
+        return span.duration
+
+    return max(0, updated - created)
+
+
+class MigrationJob(object):
+    ''' A batch of repositories moving through the migration stages. '''
+
+    def __init__(self, number, repos, org=None):
+        ''' Constructor. '''
+
+        self.number = number
+        self.repos = repos
+        self.org = org
+        self.archive = 'migration_archive_%d.tar.gz' % number
+        self.migration_url = None
+        self.guid = None
+        self.stage = 'queued'
+        self.progress = None
+        self.retries = 0
+        self.error = None
+        self.archive_bytes = None
+
+    def __str__(self):
+        ''' Short label used to prefix output for this batch. '''
+
+        return '[%sbatch %d%s]' % (
+            '%s ' % self.org if self.org else '',
+            self.number, ' %s' % self.guid[:8] if self.guid else ''
+        )
+
+
 class Migrate(object):
 
     def __init__(self, **kwargs): #token, source_org):
@@ -69,31 +175,129 @@ class Migrate(object):
         self.ghe_user = kwargs.get('ghe_user')
         self.ghe_token = kwargs.get('ghe_token')
         self.gh_token = kwargs.get('gh_token')
+        self.gh_api_url = kwargs.get('gh_api_url', 'https://api.github.com')
         self.verbose = kwargs.get('verbose')
+        self.resolve_all = kwargs.get('resolve_all', False)
+        self.user_map = kwargs.get('user_map') or {}
+        self.conflict_rules = kwargs.get('conflict_rules') or []
+        self.concurrency = max(1, kwargs.get('concurrency') or 1)
+        self.verify_issues = kwargs.get('verify_issues', False)
 
         self.repos = []
+        self.repo_info = {}
+        self.pushed = {}
+        self.jobs = []
+        self.threads = []
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.conflict_lock = threading.Lock()
+
+        self.client = connect(
+            self.ghe_host, self.ghe_ssh_port, self.ghe_ssh_user
+        )
 
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        args = {
-            'username': self.ghe_ssh_user,
-            'port': self.ghe_ssh_port,
-            'look_for_keys': False
-        }
+        # Listings and counts draw on every token and app installation in
+        # the keyring; exports stay with gh-token, which owns them.
+        self.gh_pool = CredentialPool.from_env(
+            'gh', self.gh_token, self.gh_api_url
+        )
+        self.ghe_pool = CredentialPool.from_env(
+            'ghe', self.ghe_token, 'https://%s/api/v3' % self.ghe_host
+        )
+        self.inventory = OrgInventory(self.gh_pool, self.gh_api_url)
+
+        # Export requests and polls outrank other users of the token.
+        self.session = govern(
+            tracer.instrument(requests.Session()), self.gh_token, HIGH
+        )
+        self.session.headers.update({
+            'Authorization': 'token %s' % self.gh_token,
+            'Accept': 'application/vnd.github.wyandotte-preview+json'
+        })
+
+        # With asyncio, listings and export polls share one event loop, so
+        # exports of upcoming batches run while earlier ones import.
+        self.loop = None
+        if aio is not None:
+            self.loop = aio.LoopThread()
+            self.lister = aio.Client(self.gh_api_url, self.gh_pool)
+            self.exporter = aio.Client(
+                self.gh_api_url, self.gh_token, priority=HIGH,
+                accept='application/vnd.github.wyandotte-preview+json'
+            )
+
+        self.mirrors = MirrorCache.from_env()
+
+        # Stage durations of past runs, for -plan. Commit counts for it are
+        # fetched in the background, behind every other use of the token.
+        self.history = History(self.ghe_host)
+        self.counter = OrgInventory(
+            self.gh_pool, self.gh_api_url, priority=LOW
+        )
+        self.counting = ThreadPool(1)
+        self.commits = {}
+
+        # Imported repos are checked against GitHub in the background,
+        # while the next batches export and import.
+        self.verifier = None
+        if kwargs.get('verify'):
+            self.verifier = Verifier(workers=max(4, self.concurrency * 2))
+            self.ghe_counter = OrgInventory(
+                self.ghe_pool, 'https://%s/api/v3' % self.ghe_host,
+                priority=LOW
+            )
+
+        self.backpressure = Backpressure(
+            self.client,
+            max_load=kwargs.get('max_load'),
+            min_free=kwargs.get('min_free'),
+            max_queue=kwargs.get('max_queue'),
+            off_hours=kwargs.get('off_hours'),
+            limit=self.concurrency
+        )
+
+        self.resolver = ConflictResolver(
+            source=self.source_org,
+            dest=self.dest_org,
+            ghe_host=self.ghe_host,
+            user_map=self.user_map,
+            rules=self.conflict_rules,
+            resolve_all=self.resolve_all
+        )
+
+    def for_org(self, source, dest=None):
+        ''' A Migrate for another org pair sharing this one's resources.
+
+        The SSH connection, API clients, mirrors, batch slots, backpressure
+        and list of submitted batches are shared, so batches of both orgs
+        are scheduled together.
+        '''
+
+        other = copy.copy(self)
+        other.source_org = source
+        other.dest_org = dest
+        other.repos = []
+        other.repo_info = {}
+        other.pushed = {}
+        other.resolver = ConflictResolver(
+            source=source,
+            dest=dest,
+            ghe_host=self.ghe_host,
+            user_map=self.user_map,
+            rules=self.conflict_rules,
+            resolve_all=self.resolve_all
+        )
 
-        self.client.connect(self.ghe_host, **args)
+        return other
 
     def load_repos(self):
         ''' Retrieve all the repositories in the source organization. '''
 
         print('Retrieving repos from %s.' % self.source_org)
 
-        gh = Github(self.gh_token)
-
         try:
-            for repo in gh.get_organization(self.source_org).get_repos():
-                self.repos.append('%s/%s' % (self.source_org, repo.name))
+            for info in self.iter_repos():
+                self.repo_info[info.full_name] = info
+                self.repos.append(info.full_name)
         except:
             print((
                 'Unable to retrieve the organization. Please confirm you have '
@@ -109,13 +313,14 @@ class Migrate(object):
 
         print('Verifying repos exist in organization.')
 
-        gh = Github(self.gh_token)
-        remote_repos = gh.get_organization(self.source_org).get_repos()
-
-        remote_repos = [ repo_name.full_name for repo_name in remote_repos ]
         repos = [ '%s/%s' % (source, repo_name) for repo_name in repos ]
+        wanted = set(repos)
 
-        diff = set(repos) - set(remote_repos)
+        for info in self.iter_repos():
+            if info.full_name in wanted:
+                self.repo_info[info.full_name] = info
+
+        diff = wanted - set(self.repo_info)
 
         if len(diff):
             print('%d repos could not be found.' % len(diff))
@@ -127,165 +332,686 @@ class Migrate(object):
         print('Found %s repos in %s.' % (len(repos), self.source_org))
         return repos
 
-    def start_repo_export(self, repos):
-        ''' Request an export of the provided repositories from GitHub. '''
+    def iter_repos(self):
+        ''' Yield a RepoInfo record for every repo in the source org. '''
 
-        print('Requesting migration from GitHub for %s repos.' % len(repos))
+        if self.loop is None:
+            return self.inventory.iter_repos(self.source_org)
 
-        url = 'https://api.github.com/orgs/%s/migrations' % (self.source_org)
-        ret = requests.post(url, json={
-            'lock_repositories': False,
-            'repositories': repos
-        }, headers={
-            'Authorization': 'token %s' % self.gh_token,
-            'Accept': 'application/vnd.github.wyandotte-preview+json'
-        })
+        return iter(self.loop.run(aio.org_repos(self.lister, self.source_org)))
 
-        self.migration_url = ret.json()['url']
+    def existing_repos(self):
+        ''' Return the repos to migrate that already exist on GHE. '''
 
-        while ret.json()['state'] != 'exported':
-            time.sleep(5)
-            ret = requests.get(self.migration_url, headers={
-                'Authorization': 'token %s' % self.gh_token,
-                'Accept': 'application/vnd.github.wyandotte-preview+json'
+        inventory = OrgInventory(
+            self.ghe_pool, 'https://%s/api/v3' % self.ghe_host
+        )
+        names = set(
+            info.name
+            for info in inventory.iter_repos(self.dest_org or self.source_org)
+        )
+
+        return [repo for repo in self.repos if repo.split('/')[-1] in names]
+
+    def sync_repos(self, repos):
+        ''' Sync already migrated repos over git; return the failed ones. '''
+
+        print('Syncing %d repos that already exist on %s.' % (
+            len(repos), self.ghe_host
+        ))
+
+        pool = ThreadPool(self.concurrency)
+        try:
+            results = pool.map(self.sync_repo, repos)
+        finally:
+            pool.terminate()
+
+        return [repo for repo, ok in results if not ok]
+
+    def sync_repo(self, repo):
+        ''' Push new commits, branches and tags of a repo straight to GHE.
+
+        The repo is fetched into a local mirror, then only the refs and
+        objects GHE lacks are pushed. Metadata such as issues and pull
+        requests is not synced.
+        '''
+
+        source = repo_url(self.gh_api_url, repo)
+        dest = repo_url(self.ghe_host, '%s/%s' % (
+            self.dest_org or self.source_org, repo.split('/')[-1]
+        ))
+
+        try:
+            refs = self.mirrors.sync(source, dest, [
+                credential(source, self.gh_token),
+                credential(dest, self.ghe_token)
+            ])
+        except GitError as err:
+            print('[sync] %s failed: %s' % (repo, err))
+            return repo, False
+
+        print('[sync] %s: %d refs updated' % (repo, refs))
+        return repo, True
+
+    def snapshot(self):
+        ''' Remember when each repo to migrate was last pushed to. '''
+
+        self.pushed = dict(
+            (name, self.repo_info[name].pushed_at)
+            for name in self.repos if name in self.repo_info
+        )
+
+    def changed_repos(self):
+        ''' Return the repos pushed to since the snapshot was taken. '''
+
+        return [
+            info.full_name for info in self.iter_repos()
+            if info.full_name in self.pushed and
+            info.pushed_at != self.pushed[info.full_name]
+        ]
+
+    def lock_repos(self, repos):
+        ''' Lock repos on GitHub by starting a locking migration export.
+
+        The export itself is not used; the repos stay locked on GitHub.
+        '''
+
+        if self.loop is not None:
+            return self.loop.run(aio.start_migration(
+                self.exporter, self.source_org, repos, lock=True
+            ))
+
+        res = self.session.post(
+            '%s/orgs/%s/migrations' % (self.gh_api_url, self.source_org),
+            json={'lock_repositories': True, 'repositories': repos}
+        )
+        res.raise_for_status()
+
+        return res.json()
+
+    def cutover(self, repos, limit=100):
+        ''' Lock changed repos on GitHub and sync their final commits.
+
+        The repos are synced once while still writable, so the sync made
+        under the lock only moves the last few commits. Returns a dict of
+        each repo's lock duration in seconds and the repos that failed to
+        sync while locked.
+        '''
+
+        print('Catching up %d repos pushed to since they were listed.' % (
+            len(repos)
+        ))
+        self.sync_repos(repos)
+
+        durations = {}
+        failed = []
+        pool = ThreadPool(self.concurrency)
+        try:
+            for i in range(0, len(repos), limit):
+                chunk = repos[i:i + limit]
+                print('Locking %d repos on GitHub.' % len(chunk))
+                self.lock_repos(chunk)
+                locked = time.time()
+
+                for repo, ok in pool.imap_unordered(self.sync_repo, chunk):
+                    span = Span('lock', 'cutover', {'repo': repo})
+                    span.start = locked
+                    span.end = time.time()
+                    tracer.record(span)
+                    durations[repo] = span.duration
+                    if not ok:
+                        failed.append(repo)
+        finally:
+            pool.terminate()
+
+        return durations, failed
+
+    def plan(self, limit, budget=None):
+        ''' Split the repositories to migrate into batches. '''
+
+        repos = [
+            self.repo_info.get(name) or RepoInfo(name) for name in self.repos
+        ]
+        batches = plan_batches(repos, budget, limit)
+
+        if budget:
+            print('Planned %d batches under %s each.' % (
+                len(batches), format_size(budget)
+            ))
+            for i, batch in enumerate(batches):
+                print(' - batch %d: %d repos, %s' % (
+                    i + 1, len(batch),
+                    format_size(sum(repo.bytes for repo in batch))
+                ))
+
+        return [[repo.full_name for repo in batch] for batch in batches]
+
+    def start_repo_export(self, job, span=None):
+        ''' Request an export of the provided repositories from GitHub.
+
+        Returns a function that waits for the export and returns the repos
+        it contains. If GitHub fails to export the batch, it is retried with
+        half of the repos.
+        '''
+
+        repos = job.repos
+        job.stage = 'export'
+        print('%s Requesting migration from GitHub for %s repos.' % (
+            job, len(repos)
+        ))
+
+        if span is None:
+            span = Span('stage', 'export', {
+                'batch': job.number, 'repos': len(repos)
             })
+            self.counting.apply_async(
+                self.counter.commit_counts, (repos,),
+                callback=self.commits.update
+            )
+        pending = self.request_export(repos)
 
-            if ret.json()['state'] == 'failed':
-                print('Migration failed on GitHub. Retrying with less repos.')
-                repos = repos[:int(math.ceil(len(repos)/2))]
-                if len(repos) <= 20:
-                    pprint(repos)
+        def wait():
+            migration = pending()
+            job.migration_url = migration['url']
 
-                return self.start_repo_export(repos)
+            if migration['state'] == 'failed':
+                print('%s Migration failed on GitHub. Retrying with less '
+                      'repos.' % job)
+                job.retries += 1
+                job.repos = repos[:int(math.ceil(len(repos)/2))]
+                if len(job.repos) <= 20:
+                    pprint(job.repos)
 
-        print('Migration archive created.')
-        return repos
+                return self.start_repo_export(job, span)()
+
+            span.end = time.time()
+            span.args['retries'] = job.retries
+            tracer.record(span)
+            self.record('export', export_seconds(migration, span), job)
+
+            print('%s Migration archive created.' % job)
+            return job.repos
+
+        return wait
+
+    def request_export(self, repos):
+        ''' Start a migration export on GitHub.
+
+        Returns a function that waits for the export to finish or fail and
+        returns the migration.
+        '''
+
+        if self.loop is not None:
+            return self.loop.submit(aio.export_migration(
+                self.exporter, self.source_org, repos
+            )).result
+
+        url = '%s/orgs/%s/migrations' % (self.gh_api_url, self.source_org)
+        ret = self.session.post(url, json={
+            'lock_repositories': False,
+            'repositories': repos
+        })
+
+        while ret.json()['state'] not in ('exported', 'failed'):
+            time.sleep(5)
+            ret = self.session.get(ret.json()['url'])
+
+        return ret.json
 
-    def download_archive(self):
+    def download_archive(self, job):
         ''' Download the exported archive of repositories to the GHE server. '''
 
-        print('Downloading migration archive.')
+        job.stage = 'download'
+        print('%s Downloading migration archive.' % job)
 
-        self.run_ssh((
+        cmds = [(
             'ARCHIVE_URL=`curl '
             '-H "Authorization: token %s" '
             '-H "Accept: application/vnd.github.wyandotte-preview+json" '
             '%s/archive`; '
-            'curl "${ARCHIVE_URL}" -o migration_archive.tar.gz'
-        ) % (self.gh_token, self.migration_url))
+            'curl "${ARCHIVE_URL}" -o %s'
+        ) % (self.gh_token, job.migration_url, job.archive),
+            'stat -c %%s %s' % job.archive
+        ]
+        download, size = gather(cmds, self.iter_batch(cmds))
+        if size.status == 0 and size.output:
+            job.archive_bytes = int(size.output[0])
 
-        print('Archive downloaded.')
+        print('%s Archive downloaded.' % job)
 
-    def prepare_migration(self):
+    def prepare_migration(self, job):
         ''' Prepare the exported archive of repositories for migration. '''
 
-        print('Preparing downloaded archive for migration.')
+        job.stage = 'prepare'
+        print('%s Preparing downloaded archive for migration.' % job)
 
-        res = self.run_ssh('ghe-migrator prepare migration_archive.tar.gz')
+        res = self.run_ssh(
+            'ghe-migrator prepare %s' % job.archive, job=job
+        )
 
-        self.guid = None
         for line in res:
             if 'Migration GUID:' in line:
-                self.guid = re.search('Migration GUID: (.*)\n', line).group(1)
+                job.guid = re.search('Migration GUID: (.*)\n', line).group(1)
 
-        if not self.guid:
-            print('An error occured while preparing the migration.')
-            sys.exit()
+        if not job.guid:
+            raise MigrationError(
+                'An error occured while preparing the migration. Inspect '
+                'the archive with `ghe archive -ssh %s`.' % job.archive
+            )
 
-        print('Migration GUID: {0}'.format(self.guid))
+        print('%s Migration GUID: %s' % (job, job.guid))
 
-    def resolve_conflicts(self):
+    def resolve_conflicts(self, job, max_passes=10):
         ''' Resolve any conflicts with the migration. '''
 
+        with self.conflict_lock:
+            job.stage = 'conflicts'
+            self._resolve_conflicts(job.guid, max_passes)
+
+    def _resolve_conflicts(self, guid, max_passes):
+        ''' Resolve conflicts for a migration GUID; not thread safe. '''
+
+        # The command due before each conflicts listing, sent in the same
+        # round trip: the org mapping, then the last pass's resolutions.
+        before = None
         if self.dest_org:
             print('Mapping source organization to destination organization.')
-            self.run_ssh('ghe-migrator map %s %s rename -g %s' % (
+            before = 'ghe-migrator map %s %s rename -g %s' % (
                 'https://github.com/{0}'.format(self.source_org),
                 'https://{0}/{1}'.format(self.ghe_host, self.dest_org),
-                self.guid
-            ))
+                guid
+            )
 
-        print('Checking for conflicts.')
+        resolver = self.resolver
+        resolver.reset()
+        sftp = self.client.open_sftp()
 
-        editor = os.environ.get('EDITOR', 'vim')
-        conflicts = self.run_ssh('ghe-migrator conflicts -g %s' % self.guid)
+        for attempt in range(max_passes):
+            batch = self.iter_batch(
+                ([before] if before else []) +
+                ['ghe-migrator conflicts -g %s' % guid]
+            )
+            try:
+                if before:
+                    res = self.take_output(batch)
+                    if attempt and not any(
+                            'Conflicts still exist' in line for line in res):
+                        break
+                    if attempt:
+                        print('Additional conflicts detected.')
+
+                print('Checking for conflicts.')
+                with tracer.span('sftp', 'conflicts.csv') as span:
+                    with sftp.open('conflicts.csv', 'w') as f, \
+                            tempfile.NamedTemporaryFile(suffix='.tmp',
+                                                        mode='w+t') as tf:
+                        f.set_pipelined(True)
+                        found, resolved, changed, unresolved = \
+                            self.stream_conflicts(
+                                (line for _, line, _ in batch if line), f, tf
+                            )
+
+                        if found:
+                            print('%d conflicts found, %d resolved '
+                                  'automatically.' % (found, resolved))
+
+                        if unresolved:
+                            tf.flush()
+                            self.edit_conflicts(tf.name)
+                            with open(tf.name, 'r') as edited:
+                                changed += self.write_changed(
+                                    conflicts_csv.iter_parse(edited), f
+                                )
+
+                        span.add('bytes', f.tell())
+            finally:
+                batch.close()
+
+            if not found:
+                break
+
+            if not changed:
+                print('No new conflict resolutions to submit.')
+                break
+
+            print('Attempting to resolve %d conflicts.' % changed)
+            before = 'ghe-migrator map -i conflicts.csv -g %s' % guid
+        else:
+            res = self.run_ssh(before)
+            if any('Conflicts still exist' in line for line in res):
+                print('Additional conflicts detected.')
+                print('Conflicts remain after %d attempts.' % max_passes)
 
-        with tempfile.NamedTemporaryFile(suffix='.tmp', mode='wt') as tf:
-            conflict_cnt = 0
+        sftp.close()
 
-            for line in conflicts:
-                conflict_cnt += 1
+    def stream_conflicts(self, lines, upload, unresolved):
+        ''' Resolve conflicts as `ghe-migrator conflicts` streams `lines`.
 
-                if self.dest_org:
-                    orig = line
-                    line = self.resolve_destination_org(line)
-                    if orig is not line:
-                        conflict_cnt -= 1
+        New resolutions are written to the `upload` file and unresolved
+        conflicts to the `unresolved` file as each CSV row arrives, so only
+        the counts are kept in memory. Returns the number of conflicts
+        found, resolved, written to `upload` and written to `unresolved`.
+        '''
 
-                tf.write('%s' % line)
-            tf.flush()
+        out = conflicts_csv.writer(upload)
+        held = conflicts_csv.writer(unresolved)
+        found = resolved = changed = left = 0
 
-            if conflict_cnt > 1:
-                input('Press Enter key to manually edit conflicts...')
-                call([editor, '+set backupcopy=yes', tf.name])
+        for conflict, res in self.resolver.iter_resolve(
+                conflicts_csv.iter_parse(lines)):
+            found += 1
+            if res is None:
+                held.writerow(conflict)
+                left += 1
+                continue
+            resolved += 1
+            if self.resolver.submit(res):
+                out.writerow(res)
+                changed += 1
 
-            tf.seek(0)
-            sftp = self.client.open_sftp()
-            sftp.put(tf.name, 'conflicts.csv')
+        return found, resolved, changed, left
 
-        print('Attempting to resolve conflicts.')
-        res = self.run_ssh('ghe-migrator map -i conflicts.csv -g %s' % self.guid)
-        for line in res:
-            if 'Conflicts still exist' in line:
-                print('Additional conflicts detected.')
-                self.resolve_conflicts()
+    def write_changed(self, conflicts, upload):
+        ''' Write the records not submitted yet to `upload`; count them. '''
 
-    def resolve_destination_org(self, line):
-        ''' Re-map the source organization to the destination organization. '''
+        writerow = csv.writer(upload, lineterminator='\n').writerow
+        changed = 0
+        for conflict in conflicts:
+            if self.resolver.submit(conflict):
+                writerow(conflict)
+                changed += 1
 
-        host = self.ghe_host
-        source = self.source_org
-        dest = self.dest_org
+        return changed
 
-        rx = r'organization,https://github.com/{0},https://{1}/{2},{3},{4}'
-        if re.search(rx.format(source, host, source, 'map', '(.+)?'), line):
-            line = re.sub(
-                rx.format(source, host, source, 'map', '(.+)?'),
-                rx.format(source, host, dest, 'rename', 'ghe-migrate'),
-                line
-            )
+    def edit_conflicts(self, path):
+        ''' Let the user resolve conflicts manually in their editor. '''
+
+        editor = os.environ.get('EDITOR', 'vim')
 
-        return line
+        input('Press Enter key to manually edit conflicts...')
+        call([editor, '+set backupcopy=yes', path])
 
-    def import_migration(self):
+    def import_migration(self, job):
         ''' Perform the migration from the archived data. '''
 
-        print('Importing archive data in to GHE.')
+        job.stage = 'import'
+        print('%s Importing archive data in to GHE.' % job)
+
+        unlock = 'ghe-migrator unlock -g %s' % job.guid
+        cmds = [
+            'ghe-migrator import %s -g %s -u %s -p %s' % (
+                job.archive, job.guid, self.ghe_user, self.ghe_token
+            ),
+            unlock,
+            'rm -f %s' % job.archive
+        ]
+        results = []
+        try:
+            results = gather(cmds, self.iter_batch(cmds, job=job, stop=True))
+        finally:
+            # The repositories stay locked on GHE until they are unlocked,
+            # so unlock them on their own when the import did not get that
+            # far; the archive is left for a look at what went wrong.
+            if not results or results[1].status is None:
+                self.unlock(job, unlock)
+
+        # A status of None means the command never finished, e.g. the SSH
+        # connection dropped during the import.
+        for res in results:
+            if res.status is None:
+                raise MigrationError('%s did not finish.' % label(res.cmd))
+            if res.status != 0:
+                raise MigrationError('%s exited with %d.' % (
+                    label(res.cmd), res.status
+                ))
+
+        job.stage = 'complete'
+        print('%s Migration complete.' % job)
+
+    def unlock(self, job, cmd):
+        ''' Unlock the repositories of a batch after a failed import. '''
+
+        try:
+            status = gather([cmd], self.iter_batch([cmd], job=job))[0].status
+        except Exception:
+            status = None
+        if status != 0:
+            print('%s Unable to unlock the repositories; run `%s` on GHE.' % (
+                job, cmd
+            ))
+
+    def migrate(self, job):
+        ''' Download, prepare, resolve and import an exported batch. '''
 
-        self.run_ssh((
-            'ghe-migrator import migration_archive.tar.gz -g '
-            '%s -u %s -p %s') % (self.guid, self.ghe_user, self.ghe_token)
+        stages = (
+            ('download', self.download_archive),
+            ('prepare', self.prepare_migration),
+            ('conflicts', self.resolve_conflicts),
+            ('import', self.import_migration)
         )
 
-        self.run_ssh('ghe-migrator unlock -g %s' % self.guid)
+        try:
+            for name, stage in stages:
+                with self.backpressure.admit(name):
+                    # Timed from admission: waiting for the appliance to
+                    # settle is not part of the stage.
+                    started = time.time()
+                    with tracer.span('stage', name, batch=job.number,
+                                     repos=len(job.repos)):
+                        stage(job)
+                    self.record(name, time.time() - started, job)
+
+            if self.verifier is not None:
+                print('%s Verifying %d repos.' % (job, len(job.repos)))
+                self.verifier.submit(self.verify_repo, job.repos)
+        except Exception as err:
+            job.error = err
+            print('%s Migration failed during %s: %s' % (job, job.stage, err))
+        finally:
+            self.slots.release()
+
+    def submit(self, job):
+        ''' Start migrating an exported batch once a slot is free. '''
+
+        self.slots.acquire()
+        self.jobs.append(job)
+
+        thread = threading.Thread(target=self.migrate, args=(job,))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def wait(self):
+        ''' Wait for all submitted batches; return the ones that failed. '''
+
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+        return [job for job in self.jobs if job.error]
+
+    def verify_repo(self, repo):
+        ''' Compare a migrated repo with its source; return the problems. '''
+
+        dest = '%s/%s' % (self.dest_org or self.source_org, repo.split('/')[-1])
+
+        source = self.repo_state(
+            repo_url(self.gh_api_url, repo), self.gh_token, self.counter, repo
+        )
+        target = self.repo_state(
+            repo_url(self.ghe_host, dest), self.ghe_token,
+            self.ghe_counter, dest
+        )
+        problems = compare(source, target)
+
+        # Exports don't lock the repos, so a repo pushed to since it was
+        # listed has newer refs than its archive; those are synced by
+        # -cutover, and only its issue totals can be checked now.
+        if problems and self.pushed_since(repo):
+            print('Verifying %s: pushed to since the export; not comparing '
+                  'its refs.' % repo)
+            problems = compare(source, target, refs=False)
+
+        return problems
+
+    def pushed_since(self, repo):
+        ''' Whether a repo was pushed to since the snapshot was taken. '''
+
+        return repo in self.pushed and \
+            self.counter.repo(repo).pushed_at != self.pushed[repo]
 
-        print('Migration complete.')
+    def repo_state(self, url, token, inventory, full_name):
+        ''' The default branch, refs and optionally issue totals of a repo. '''
 
-    def run_ssh(self, cmd):
-        ''' Run the command on the SSH connection to the GHE server. '''
+        head, refs = self.mirrors.remote_state(url, [credential(url, token)])
+        issues = pulls = None
+        if self.verify_issues:
+            issues, pulls = inventory.issue_counts(full_name)
+
+        return RepoState(head, refs, issues, pulls)
+
+    def features(self, repos, commits=None):
+        ''' What is known about a batch of repos, for the history. '''
+
+        commits = self.commits if commits is None else commits
+        info = [
+            self.repo_info[repo] for repo in repos if repo in self.repo_info
+        ]
+
+        return {
+            'repos': len(repos),
+            'bytes': sum(repo.bytes for repo in info),
+            'commits': sum(commits[repo] for repo in repos)
+            if all(repo in commits for repo in repos) else None
+        }
+
+    def record(self, stage, seconds, job):
+        ''' Add a finished stage of a batch to the history. '''
+
+        try:
+            self.history.record(
+                stage, seconds, archive_bytes=job.archive_bytes,
+                **self.features(job.repos)
+            )
+        except (IOError, OSError) as err:
+            print('Unable to record migration history: %s' % err)
+
+    def print_plan(self, batches, start=None):
+        ''' Predict how long each batch takes, without migrating anything.
+
+        `batches` holds (Migrate, repos) pairs in the order they would run.
+        '''
+
+        repos = [repo for org, names in batches for repo in names]
+        print('Counting commits in %d repos.' % len(repos))
+        commits = self.counter.commit_counts(repos)
+
+        entries = self.history.load()
+        estimator = Estimator(entries)
+        features = [org.features(names, commits) for org, names in batches]
+        estimates = [estimator.estimate(f) for f in features]
+        start = start or time.time()
+        times = schedule(estimates, self.concurrency, start)
+
+        print('%5s %5s %8s %7s %6s %6s %6s %6s %6s  %s' % (
+            'batch', 'repos', 'size', 'commits', 'export', 'downl',
+            'prep', 'confl', 'import', 'start-end'
+        ))
+        for number, (f, estimate, (began, ended)) in enumerate(
+                zip(features, estimates, times), 1):
+            print('%5d %5d %8s %7s %6s %6s %6s %6s %6s  %s-%s' % ((
+                number, f['repos'], format_size(f['bytes']),
+                '?' if f['commits'] is None else f['commits']
+            ) + tuple(
+                format_duration(estimate[stage]) for stage in (
+                    'export', 'download', 'prepare', 'conflicts', 'import'
+                )
+            ) + (
+                time.strftime('%H:%M', time.localtime(began)),
+                time.strftime('%H:%M', time.localtime(ended))
+            )))
+
+        end = max([ended for began, ended in times] or [start])
+        print('%d batches of %d repos, %d at a time: %s, finishing around '
+              '%s.' % (
+                  len(batches), len(repos), self.concurrency,
+                  format_duration(end - start),
+                  time.strftime('%Y-%m-%d %H:%M', time.localtime(end))
+              ))
+
+        if not entries:
+            print('No migration history for %s yet, so stage durations are '
+                  'unknown; each migration run adds to it.' % self.ghe_host)
+        else:
+            print('Predictions from %d recorded stages of past runs on %s.' % (
+                len(entries), self.ghe_host
+            ))
+
+    def run_ssh(self, cmd, job=None):
+        ''' Run the command on the SSH connection to the GHE server.
+
+        Each call runs on its own channel, so commands for different batches
+        can run at the same time. If `job` is given, progress lines from
+        `ghe-migrator` are tracked on it as they stream in.
+        '''
+
+        return list(self.iter_ssh(cmd, job))
+
+    def iter_ssh(self, cmd, job=None):
+        ''' Like run_ssh, but yield the output lines as they arrive. '''
 
         if self.verbose:
             print(' - {0}'.format(cmd))
 
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-
-        ret = []
-        for line in stdout:
-            ret.append(line)
+        for line in stream(self.client, cmd):
             if self.verbose:
-                print(' + {0}'.format(line.encode('utf-8').rstrip()))
+                print(' + {0}'.format(line.rstrip()))
+            if job is not None:
+                self.track_progress(job, line)
+            yield line
+
+    def iter_batch(self, cmds, job=None, stop=False):
+        ''' Run several commands on a single channel, in one round trip.
+
+        Yields (index, line, status) events as ghe.ssh.iter_batch does;
+        with `stop`, the commands after a failed one are skipped.
+        '''
+
+        if self.verbose:
+            for cmd in cmds:
+                print(' - {0}'.format(cmd))
+
+        for index, line, status in iter_batch(self.client, cmds, stop):
+            if line is not None:
+                if self.verbose:
+                    print(' + {0}'.format(line.rstrip()))
+                if job is not None:
+                    self.track_progress(job, line)
+            yield index, line, status
+
+    @staticmethod
+    def take_output(batch):
+        ''' Read the output lines of the next command in a batch. '''
+
+        lines = []
+        for index, line, status in batch:
+            if line is None:
+                break
+            lines.append(line)
+
+        return lines
+
+    def track_progress(self, job, line):
+        ''' Record and report `ghe-migrator` progress for a batch. '''
+
+        match = PROGRESS.search(line)
+        if not match:
+            return
 
-        return ret
+        progress = int(match.group(1))
+        if progress != job.progress:
+            job.progress = progress
+            print('%s %s %d%% complete' % (job, job.stage.title(), progress))
 
 
 def _is_valid_repo_name(s):
@@ -329,14 +1055,76 @@ def _is_valid_repo_file(s):
 
     return repos
 
+def _is_valid_org_file(s):
+    ''' Argparse type helper - is passed file a valid list of org pairs. '''
+
+    if not os.path.exists(s):
+        raise argparse.ArgumentTypeError('%s: file not found' % s)
+
+    pairs = []
+    with open(s, 'r') as f:
+        for row in csv.reader(f):
+            row = [col.strip() for col in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            try:
+                pairs.append((
+                    _is_valid_repo_name(row[0]),
+                    _is_valid_repo_name(row[1]) if len(row) > 1 and row[1]
+                    else None
+                ))
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(err)
+
+    if not len(pairs):
+        raise argparse.ArgumentTypeError('%s: no organizations listed' % s)
+
+    return pairs
+
+def _is_valid_size(s):
+    ''' Argparse type helper - is passed value a valid size. '''
+
+    try:
+        return parse_size(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"%s" is not a valid size.' % s)
+
+def _is_valid_hours(s):
+    ''' Argparse type helper - is passed value a valid range of hours. '''
+
+    try:
+        return parse_hours(s)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+def _is_valid_user_map(s):
+    ''' Argparse type helper - is passed file a valid user mapping. '''
+
+    if not os.path.exists(s):
+        raise argparse.ArgumentTypeError('%s: file not found' % s)
+
+    return load_user_map(s)
+
+def _is_valid_rules_file(s):
+    ''' Argparse type helper - is passed file a valid YAML rules file. '''
+
+    if not os.path.exists(s):
+        raise argparse.ArgumentTypeError('%s: file not found' % s)
+
+    try:
+        return load_rules(s)
+    except (ValueError, yaml.YAMLError) as err:
+        raise argparse.ArgumentTypeError(str(err))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Tool to perform GitHub to GitHub Enterprise migrations.',
-        epilog='You must use one of -repos, -file or -all.'
+        epilog='You must use one of -repos, -file, -all or -orgs.'
     )
     parser.add_argument('source',
-        help='the organization to migrate'
+        nargs='?',
+        help='the organization to migrate (not used with -orgs)'
     )
     parser.add_argument('dest',
         nargs='?',
@@ -357,6 +1145,35 @@ if __name__ == '__main__':
         action='store_true',
         help='use all repos from organization'
     )
+    parser.add_argument('-orgs',
+        metavar='FILE',
+        help=(
+            'CSV file of `source,dest` organization pairs to migrate all '
+            'repos of in one run; batches of every org share the '
+            '-concurrency and backpressure limits'
+        ),
+        type=_is_valid_org_file
+    )
+    parser.add_argument('-resolve-all',
+        action='store_true',
+        help='attempt to automatically resolve all conflicts'
+    )
+    parser.add_argument('-user-map',
+        metavar='FILE',
+        help=(
+            'CSV file of `github_login,ghe_login` pairs used to map users '
+            'when resolving conflicts'
+        ),
+        type=_is_valid_user_map
+    )
+    parser.add_argument('-conflict-rules',
+        metavar='FILE',
+        help=(
+            'YAML file of user mappings and conflict rewriting rules applied '
+            'when resolving conflicts'
+        ),
+        type=_is_valid_rules_file
+    )
     parser.add_argument('-verbose',
         action='store_true',
         help='be extra verbose in all communication with the GHE server'
@@ -369,6 +1186,89 @@ if __name__ == '__main__':
         help='number of repos to process per batch (default: 100)',
         type=int
     )
+    parser.add_argument('-batch-size',
+        action='store',
+        metavar='SIZE',
+        help=(
+            'pack repos into batches of at most SIZE bytes (e.g. 500M, 10G), '
+            'largest repos first'
+        ),
+        type=_is_valid_size
+    )
+    parser.add_argument('-concurrency',
+        action='store',
+        default=1,
+        metavar='INT',
+        help=(
+            'number of batches to prepare and import on the GHE server at '
+            'the same time (default: 1)'
+        ),
+        type=int
+    )
+    parser.add_argument('-incremental',
+        help=(
+            'push new commits of repos that already exist on GHE over git '
+            'instead of exporting them again'
+        ),
+        action='store_true'
+    )
+    parser.add_argument('-max-load',
+        metavar='FLOAT',
+        help=(
+            "hold new prepare and import stages while the appliance's load "
+            'average per CPU is above FLOAT'
+        ),
+        type=float
+    )
+    parser.add_argument('-min-free',
+        metavar='SIZE',
+        help=(
+            'hold new prepare and import stages while /data/user has less '
+            'than SIZE free (e.g. 100G)'
+        ),
+        type=_is_valid_size
+    )
+    parser.add_argument('-max-queue',
+        metavar='INT',
+        help=(
+            'hold new prepare and import stages while more than INT '
+            'background jobs are queued on the appliance'
+        ),
+        type=int
+    )
+    parser.add_argument('-off-hours',
+        metavar='HOURS',
+        help=(
+            'local hours, such as 19-7, when -max-load and -max-queue are '
+            'lifted; weekends are always off-hours'
+        ),
+        type=_is_valid_hours
+    )
+    parser.add_argument('-cutover',
+        help=(
+            'after the migration, lock the repos pushed to since they were '
+            'listed on GitHub and push their final commits to GHE over git'
+        ),
+        action='store_true'
+    )
+    parser.add_argument('-verify',
+        help=(
+            'check each imported repo against GitHub in the background: '
+            'default branch, its head and every branch and tag'
+        ),
+        action='store_true'
+    )
+    parser.add_argument('-verify-issues',
+        help='with -verify, also compare issue and pull request totals',
+        action='store_true'
+    )
+    parser.add_argument('-plan',
+        help=(
+            'list the batches and predict how long each stage takes from '
+            'past runs, without migrating anything'
+        ),
+        action='store_true'
+    )
     parser.add_argument('-skip',
         action='store',
         default=0,
@@ -421,6 +1321,16 @@ if __name__ == '__main__':
         type=str,
         default=os.getenv('ghe-token')
     )
+    parser.add_argument('-gh-api-url',
+        help=(
+            'the GitHub API endpoint of the source organization (default: '
+            'https://api.github.com, or value from `gh-api-url` environment '
+            'variable)'
+        ),
+        metavar='URL',
+        type=str,
+        default=os.getenv('gh-api-url', 'https://api.github.com')
+    )
     parser.add_argument('-gh-token',
         help=(
             'GitHub.com access token for an account with admin priveleges on '
@@ -465,45 +1375,195 @@ if __name__ == '__main__':
             'GitHub.com User access token not set. Please use -gh-token TOKEN.'
         )
 
-    if not (args.repos or args.all):
+    if args.orgs and (args.source or args.repos or args.skip):
+        parser.error(
+            '-orgs migrates all repos of each org; it cannot be used with a '
+            'source org, -repos, -file or -skip.'
+        )
+
+    if not (args.orgs or args.source):
+        parser.error('No source organization specified.')
+
+    if not (args.repos or args.all or args.orgs):
         parser.error(
-            'No repos specified. Please select -repos, -file or -all.'
+            'No repos specified. Please select -repos, -file, -all or -orgs.'
         )
 
+    if args.incremental or args.cutover or args.verify or args.verify_issues:
+        try:
+            check_git()
+        except RuntimeError as err:
+            parser.error(str(err))
+
+    user_map, conflict_rules = args.conflict_rules or ({}, [])
+    user_map.update(args.user_map or {})
+
+    pairs = args.orgs or [(args.source, args.dest)]
+
     app = Migrate(
-        source=args.source,
-        dest=args.dest,
+        source=pairs[0][0],
+        dest=pairs[0][1],
         ghe_host=args.ghe_host,
         ghe_ssh_port=args.ghe_ssh_port,
         ghe_ssh_user=args.ghe_ssh_user,
         ghe_user=args.ghe_user,
         ghe_token=args.ghe_token,
         gh_token=args.gh_token,
-        verbose=args.verbose
+        gh_api_url=args.gh_api_url,
+        verbose=args.verbose,
+        concurrency=args.concurrency,
+        max_load=args.max_load,
+        min_free=args.min_free,
+        max_queue=args.max_queue,
+        off_hours=args.off_hours,
+        resolve_all=args.resolve_all,
+        user_map=user_map,
+        conflict_rules=conflict_rules,
+        verify=args.verify or args.verify_issues,
+        verify_issues=args.verify_issues
     )
-
-    if (args.all):
-        app.load_repos()
-    else:
-        app.repos = app.validate_repos(args.source, args.repos)
-
-    if len(app.repos) == 0:
-        print('No repositories available to migrate.')
+    apps = [app] + [app.for_org(source, dest) for source, dest in pairs[1:]]
+
+    sync_failed = []
+    queues = []
+    for org in apps:
+        if (args.all or args.orgs):
+            org.load_repos()
+        else:
+            org.repos = org.validate_repos(org.source_org, args.repos)
+
+        if len(org.repos) == 0:
+            print('No repositories available to migrate from %s.' % (
+                org.source_org
+            ))
+            continue
+
+        if (args.skip > 0):
+            print('Skipping first %d repositories.' % args.skip)
+            org.repos = org.repos[args.skip:]
+
+        org.snapshot()
+
+        if args.incremental:
+            try:
+                existing = org.existing_repos()
+            except requests.RequestException as err:
+                print('Unable to list the repos on %s: %s' % (
+                    org.ghe_host, err
+                ))
+                sys.exit(1)
+
+            if len(existing) and args.plan:
+                print('%d repos already on %s would be synced over git.' % (
+                    len(existing), org.ghe_host
+                ))
+            elif len(existing):
+                sync_failed += org.sync_repos(existing)
+            if len(existing):
+                existing = set(existing)
+                org.repos = [
+                    repo for repo in org.repos if repo not in existing
+                ]
+
+        queues.append([
+            (org, repos) for repos in org.plan(args.batch, args.batch_size)
+        ])
+
+    if not len(queues):
         sys.exit(1)
 
-    repo_limit = args.batch
-    if (args.skip > 0):
-        print('Skipping first %d repositories.' % args.skip)
-        app.repos = app.repos[args.skip:]
+    # Take batches from each org in turn, so every org keeps moving and
+    # the stages of one org overlap with those of the others.
+    batches = []
+    while any(queues):
+        for queue in queues:
+            if len(queue):
+                batches.append(queue.pop(0))
+
+    if args.plan:
+        app.print_plan(batches)
+        sys.exit(0)
+
+    # Exports for the next batches run on GitHub while earlier batches are
+    # imported; without asyncio each export is waited for in turn.
+    lookahead = app.concurrency if app.loop is not None else 0
+    exports = []
+    batch = 0
+    while len(batches) or len(exports):
+        while len(batches) and len(exports) <= lookahead:
+            org, repos = batches.pop(0)
+            batch += 1
+            job = MigrationJob(
+                batch, repos, org.source_org if len(apps) > 1 else None
+            )
+            exports.append((
+                org, job, list(job.repos), org.start_repo_export(job)
+            ))
 
-    while len(app.repos):
-        repos = app.repos[:repo_limit]
+        org, job, repos, wait = exports.pop(0)
+        exported = wait()
+        if len(exported) < len(repos):
+            batches.insert(0, (org, repos[len(exported):]))
+
+        org.submit(job)
+
+    failed = app.wait()
+    if len(failed):
+        print('%d batches failed to migrate:' % len(failed))
+        for job in failed:
+            print(' - %s %s' % (job, ', '.join(job.repos)))
+
+    if len(sync_failed):
+        print('%d repos failed to sync:' % len(sync_failed))
+        for repo in sync_failed:
+            print(' - %s' % repo)
+
+    unverified = {}
+    if app.verifier is not None:
+        unverified = app.verifier.wait()
+        print('%d repos verified.' % app.verifier.verified)
+        if len(unverified):
+            print('%d repos failed verification:' % len(unverified))
+            for repo in sorted(unverified):
+                print(' - %s: %s' % (repo, '; '.join(unverified[repo])))
+
+    lock_failed = []
+    if args.cutover and (len(failed) or len(sync_failed)):
+        print('Skipping cutover; fix the failures above and run it again.')
+    elif args.cutover:
+        if len(unverified):
+            print('Leaving %d repos that failed verification out of the '
+                  'cutover.' % len(unverified))
+
+        durations = {}
+        for org in apps:
+            changed = [
+                repo for repo in org.changed_repos() if repo not in unverified
+            ]
+            if len(changed):
+                locked, unsynced = org.cutover(changed)
+                durations.update(locked)
+                lock_failed += unsynced
+
+        if not len(durations):
+            print('No repos were pushed to during the migration.')
+        else:
+            print('Repos locked on GitHub for the cutover:')
+            for repo in sorted(durations, key=durations.get, reverse=True):
+                print(' - %s %.1fs%s' % (
+                    repo, durations[repo],
+                    ' (sync failed)' if repo in lock_failed else ''
+                ))
+            times = sorted(durations.values())
+            print('Longest lock %.1fs, median %.1fs.' % (
+                times[-1], times[len(times) // 2]
+            ))
 
-        repos = app.start_repo_export(repos)
-        repo_limit = len(repos)
-        app.repos = app.repos[repo_limit:]
+        if len(lock_failed):
+            print('%d locked repos failed to sync and are still locked on '
+                  'GitHub:' % len(lock_failed))
+            for repo in lock_failed:
+                print(' - %s' % repo)
 
-        app.download_archive()
-        app.prepare_migration()
-        app.resolve_conflicts()
-        app.import_migration()
+    if len(failed) or len(sync_failed) or len(unverified) or len(lock_failed):
+        sys.exit(1)
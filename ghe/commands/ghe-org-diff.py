@@ -3,7 +3,7 @@
 ghe-org-diff.py - GitHub.com and GitHub Enterprise Org Diff
 
 usage: ghe-org-diff.py [-h] [-ghe-host HOST] [-ghe-token TOKEN]
-                       [-gh-token TOKEN]
+                       [-gh-token TOKEN] [-gh-api-url URL] [-refs]
                        source [dest]
 
 Tool to determine if the repos on two organizations match on the source
@@ -23,17 +23,35 @@ optional arguments:
   -gh-token TOKEN   GitHub.com access token for an account with admin
                     priveleges on source organization (default: value from
                     `gh-token` environment variable)
+  -gh-api-url URL   the GitHub API endpoint of the source organization
+                    (default: https://api.github.com, or value from
+                    `gh-api-url` environment variable)
+  -refs             compare every branch and tag, fetching the source repos
+                    into the local mirror cache (default: compare the latest
+                    commit only)
+
+The mirror cache lives in ~/.ghe/mirrors, or the directory in the
+`ghe-mirror-dir` environment variable, and is kept under the size in
+`ghe-mirror-quota` (e.g. 200G) by removing the least recently used mirrors.
 """
 
 import argparse, csv, math, os, paramiko, re, requests, sys, tempfile, time
 
 from ghe import get_key
-from github import Github
-from github.GithubException import GithubException
+from ghe.credentials import CredentialPool
+from ghe.inventory import OrgInventory
+from ghe.mirror import MirrorCache, check_git, credential, diff_refs, \
+    repo_url
+from ghe.ratelimit import LOW
+try:
+    from ghe import aio
+except (ImportError, SyntaxError):
+    aio = None
 from subprocess import call
 from io import StringIO
 
 from builtins import input
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
 class OrgDiff(object):
@@ -42,25 +60,55 @@ class OrgDiff(object):
         ''' Constructor. '''
 
         self.source_org = kwargs.get('source')
-        self.dest_org = kwargs.get('dest', self.source_org)
+        self.dest_org = kwargs.get('dest') or self.source_org
         self.ghe_host = kwargs.get('ghe_host')
         self.ghe_token = kwargs.get('ghe_token')
         self.gh_token = kwargs.get('gh_token')
+        self.gh_api_url = kwargs.get('gh_api_url', 'https://api.github.com')
 
         self.gh_repos = []
         self.ghe_repos = []
+        self.errors = []
 
-        self.gh = Github(self.gh_token)
-        self.ghe = Github(self.ghe_token, base_url=self.ghe_host)
+        # Listings are spread over every token and app installation in the
+        # keyring for each side.
+        self.gh_pool = CredentialPool.from_env(
+            'gh', self.gh_token, self.gh_api_url
+        )
+        self.ghe_pool = CredentialPool.from_env(
+            'ghe', self.ghe_token, self.ghe_host
+        )
+
+        # A diff is background work; migrations sharing the token go first.
+        self.gh_inventory = OrgInventory(
+            self.gh_pool, self.gh_api_url, priority=LOW
+        )
+        self.ghe_inventory = OrgInventory(
+            self.ghe_pool, self.ghe_host, priority=LOW
+        )
 
-    def load_repos(self, gh, org):
-        ''' Retrieve all the repositories in the organization. '''
+        self.mirrors = MirrorCache.from_env()
 
-        repos = []
+        # With asyncio, listings and heads are fetched in one event loop.
+        self.clients = ()
+        if aio is not None:
+            self.clients = (
+                aio.Client(self.gh_api_url, self.gh_pool, priority=LOW),
+                aio.Client(self.ghe_host, self.ghe_pool, priority=LOW)
+            )
+
+    def load_all_repos(self):
+        ''' Retrieve the repositories of both organizations at once. '''
 
         try:
-            for repo in gh.get_organization(org).get_repos():
-                repos.append(repo.name)
+            if self.clients:
+                gh, ghe = self.clients
+                gh_repos, ghe_repos = aio.run(aio.gather(
+                    aio.org_repos(gh, self.source_org),
+                    aio.org_repos(ghe, self.dest_org)
+                ), *self.clients)
+            else:
+                gh_repos, ghe_repos = self.list_orgs()
         except:
             print((
                 'Unable to retrieve the organization. Please confirm you have '
@@ -69,31 +117,147 @@ class OrgDiff(object):
             ))
             sys.exit(1)
 
-        return repos
+        self.gh_repos = [repo.name for repo in gh_repos]
+        self.ghe_repos = [repo.name for repo in ghe_repos]
 
-    def get_repo(self, gh, org, name):
-        return gh.get_organization(org).get_repo(name)
+    def list_orgs(self):
+        ''' List both organizations on two threads. '''
+
+        pool = ThreadPool(2)
+        try:
+            gh_repos = pool.apply_async(
+                self.gh_inventory.repos, (self.source_org,)
+            )
+            ghe_repos = pool.apply_async(
+                self.ghe_inventory.repos, (self.dest_org,)
+            )
+            return gh_repos.get(), ghe_repos.get()
+        finally:
+            pool.terminate()
 
     def diff_repos(self, repos):
-        for repo in repos:
-            gh_repo = self.get_repo(self.gh, self.source_org, repo)
-            ghe_repo = self.get_repo(self.ghe, self.dest_org, repo)
+        ''' Print the repositories whose heads differ. '''
+
+        for repo, gh_head, ghe_head in self.get_heads(repos):
+            if isinstance(gh_head, Exception) or \
+                    isinstance(ghe_head, Exception):
+                print('!!! {0}'.format(repo))
+                for err in (gh_head, ghe_head):
+                    if isinstance(err, Exception):
+                        print('--- {0}'.format(err))
+                self.errors.append(repo)
+            elif gh_head != ghe_head:
+                print('??? {0}'.format(repo))
+                print('--- GH SHA: {0}'.format(gh_head))
+                print('--- GHE SHA: {0}'.format(ghe_head))
 
-            if self.get_repo_head(gh_repo) != self.get_repo_head(ghe_repo):
+    def diff_refs(self, repos, workers=8):
+        ''' Print the repositories whose branches or tags differ.
+
+        The source repositories are fetched into the local mirror cache and
+        compared with the refs advertised by GitHub Enterprise.
+        '''
+
+        urls = dict(
+            (repo, (
+                repo_url(self.gh_api_url, '%s/%s' % (self.source_org, repo)),
+                repo_url(self.ghe_host, '%s/%s' % (self.dest_org, repo))
+            ))
+            for repo in repos
+        )
+        if not urls:
+            return
+
+        gh_url, ghe_url = urls[repos[0]]
+        credentials = [
+            credential(gh_url, self.gh_token),
+            credential(ghe_url, self.ghe_token)
+        ]
+
+        mirrors = self.mirrors.fetch_all(
+            [gh for gh, ghe in urls.values()], credentials, workers
+        )
+
+        def compare(repo):
+            gh_url, ghe_url = urls[repo]
+            if isinstance(mirrors[gh_url], Exception):
+                return repo, mirrors[gh_url]
+            try:
+                return repo, diff_refs(
+                    self.mirrors.refs(gh_url),
+                    self.mirrors.remote_refs(ghe_url, credentials)
+                )
+            except Exception as err:
+                return repo, err
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(compare, repos)
+        finally:
+            pool.terminate()
+
+        for repo, result in results:
+            if isinstance(result, Exception):
+                print('!!! {0}'.format(repo))
+                print('--- {0}'.format(result))
+                self.errors.append(repo)
+                continue
+
+            missing, extra, changed = result
+            if missing or extra or changed:
                 print('??? {0}'.format(repo))
-                print('--- GH SHA: {0}'.format(self.get_repo_head(gh_repo)))
-                print('--- GHE SHA: {0}'.format(self.get_repo_head(ghe_repo)))
+            for label, refs in (('missing on GHE', missing),
+                                ('only on GHE', extra),
+                                ('differs', changed)):
+                for ref in refs:
+                    print('--- {0}: {1}'.format(label, ref))
+
+    def get_heads(self, repos):
+        ''' Return (repo, gh_head, ghe_head) for each repository.
+
+        A head that could not be retrieved is given as the exception.
+        '''
+
+        if self.clients:
+            gh, ghe = self.clients
+            heads = aio.run(aio.gather(*[
+                aio.repo_head(client, org, repo)
+                for repo in repos
+                for client, org in ((gh, self.source_org),
+                                    (ghe, self.dest_org))
+            ], return_exceptions=True), *self.clients)
+
+            return [
+                (repo, heads[2 * i], heads[2 * i + 1])
+                for i, repo in enumerate(repos)
+            ]
+
+        return [(
+            repo,
+            self.get_repo_head(self.gh_inventory, self.source_org, repo),
+            self.get_repo_head(self.ghe_inventory, self.dest_org, repo)
+        ) for repo in repos]
+
+    def get_repo_head(self, inventory, org, name):
+        ''' Return the SHA of the latest commit in a repository. '''
 
-    def get_repo_head(self, repo):
         try:
-            return repo.get_commits()[0].sha
-        except GithubException as err:
-            if err.status == 409:
-                return err.data.get('message')
-            else:
-                print('UNKNOWN ERR')
-                pprint(err)
-                sys.exit()
+            res = inventory.session.get(
+                '{0}/repos/{1}/{2}/commits'.format(
+                    inventory.base_url, org, name
+                ),
+                params={'per_page': 1}
+            )
+
+            # Empty repositories have no commits to compare.
+            if res.status_code == 409:
+                return res.json().get('message')
+
+            res.raise_for_status()
+        except requests.RequestException as err:
+            return err
+
+        return res.json()[0]['sha']
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -139,6 +303,25 @@ if __name__ == '__main__':
         default=os.getenv('gh-token')
     )
 
+    parser.add_argument('-gh-api-url',
+        help=(
+            'the GitHub API endpoint of the source organization (default: '
+            'https://api.github.com, or value from `gh-api-url` environment '
+            'variable)'
+        ),
+        metavar='URL',
+        type=str,
+        default=os.getenv('gh-api-url', 'https://api.github.com')
+    )
+
+    parser.add_argument('-refs',
+        help=(
+            'compare every branch and tag, fetching the source repos into '
+            'the local mirror cache (default: compare the latest commit only)'
+        ),
+        action='store_true'
+    )
+
     args, unknown = parser.parse_known_args()
 
     if not (args.ghe_host):
@@ -157,12 +340,22 @@ if __name__ == '__main__':
             'GitHub.com User access token not set. Please use -gh-token TOKEN.'
         )
 
+    if args.refs:
+        try:
+            check_git()
+        except RuntimeError as err:
+            parser.error(str(err))
+
     app = OrgDiff(
         source=args.source,
         dest=args.dest,
-        ghe_host='https://{0}/api/v3'.format(args.ghe_host),
+        ghe_host='{0}/api/v3'.format(
+            args.ghe_host if '://' in args.ghe_host
+            else 'https://{0}'.format(args.ghe_host)
+        ),
         ghe_token=args.ghe_token,
-        gh_token=args.gh_token
+        gh_token=args.gh_token,
+        gh_api_url=args.gh_api_url
     )
 
     print('Comparing https://github.org/{0}/* to {1}/{2}'.format(
@@ -171,8 +364,7 @@ if __name__ == '__main__':
         app.dest_org
     ))
 
-    app.gh_repos = app.load_repos(app.gh, app.source_org)
-    app.ghe_repos = app.load_repos(app.ghe, app.dest_org)
+    app.load_all_repos()
 
     if len(app.gh_repos) == 0:
         print('No repositories found in source org.')
@@ -186,6 +378,12 @@ if __name__ == '__main__':
     # not exist on both!!
     repos = list(set(app.gh_repos).intersection(app.ghe_repos))
 
-    app.diff_repos(repos)
-    sys.exit()
+    if args.refs:
+        app.diff_refs(repos)
+    else:
+        app.diff_repos(repos)
+
+    if app.errors:
+        print('Unable to compare {0} repositories.'.format(len(app.errors)))
+        sys.exit(1)
 
@@ -20,8 +20,10 @@ optional arguments:
   -debug          enable debug mode
 """
 
-import argparse, os, pyotp, re, sys
-from seleniumrequests import PhantomJS
+import argparse, os, re, sys
+
+from ghe.stafftools import LoginError, login
+from ghe.users import UserIndex
 
 class FixUserEmail(object):
 
@@ -37,35 +39,13 @@ class FixUserEmail(object):
     def update(self, user, email):
         ''' Reset the users email address on Github Enterprise '''
 
-        # Initialize the PhantomJS selenium driver
-        driver = PhantomJS()
-        driver.implicitly_wait(10)
-        driver.set_window_size(1400, 850)
-
-        # Login as the admin user
-        driver.get('https://%s/login' % (self.ghe_host))
-        driver.find_element_by_name('login').send_keys(self.ghe_user)
-        driver.find_element_by_name('password').send_keys(self.ghe_pass)
-        driver.find_element_by_name('commit').click()
-
-        # Check for two-factor auth code request
-        if driver.current_url == 'https://%s/sessions/two-factor' % self.ghe_host:
-            if self.ghe_totp:
-                base = '.auth-form-body input'
-                u = driver.find_element_by_css_selector('%s[name=utf8]' % base)
-                t = driver.find_element_by_css_selector('%s[name=authenticity_token]' % base)
-                otp = pyotp.TOTP(self.ghe_totp)
-
-                driver.request('POST', 'https://%s/sessions/two-factor' % self.ghe_host,
-                    data={
-                        'utf8': u.get_attribute('value'),
-                        'otp': otp.now(),
-                        'authenticity_token': t.get_attribute('value')
-                    }
-                )
-            else:
-                print('Two-Factor authentication required.')
-                sys.exit()
+        try:
+            driver = login(
+                self.ghe_host, self.ghe_user, self.ghe_pass, self.ghe_totp
+            )
+        except LoginError as err:
+            print(err)
+            sys.exit()
 
         # Retrieve the email admin page for the designated user to be updated
         driver.get('https://%s/stafftools/users/%s/emails' % (self.ghe_host, user))
@@ -204,5 +184,13 @@ if __name__ == '__main__':
         debug=args.debug
     )
 
+    # Rule out unknown users before the slow sign in to the web interface.
+    if UserIndex(args.ghe_host).rules_out(args.user):
+        print(
+            'User "%s" is not in the user index of %s; run `users -refresh` '
+            'if it was created recently.' % (args.user, args.ghe_host)
+        )
+        sys.exit(1)
+
     print('Setting "%s" email address to "%s"...' % (args.user, args.email))
     app.update(args.user, args.email)
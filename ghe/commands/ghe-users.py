@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+ghe-users.py - GitHub Enterprise User Index
+
+usage: ghe-users.py [-h] [-refresh] [-incremental] [-ghe-host HOST]
+                    [-ghe-ssh-port PORT] [-ghe-ssh-user USER]
+                    [-ghe-token TOKEN]
+                    [LOGIN [LOGIN ...]]
+
+Tool to keep a local index of the users on GitHub Enterprise, and look users
+up in it.
+
+positional arguments:
+  LOGIN               users to look up; exits with 1 if any is missing
+
+optional arguments:
+  -h, --help          show this help message and exit
+  -refresh            reload the whole index with `ghe-user-csv` over SSH
+  -incremental        add the users created since the last refresh, from the
+                      admin API
+  -ghe-host HOST      the hostname to your GitHub Enterprise server (default:
+                      value from `ghe-host` environment variable)
+  -ghe-ssh-port PORT  the port to your GitHub Enterprise SSH server (default:
+                      122, or value from `ghe-ssh-port` environment variable)
+  -ghe-ssh-user USER  the user to use for SSH access to your GitHub Enterprise
+                      server (default: value from `ghe-ssh-user` environment
+                      variable)
+  -ghe-token TOKEN    GitHub Enterprise access token, used by -incremental
+                      (default: value from `ghe-token` environment variable)
+
+The index lives in ~/.ghe/users/<host>.db. While it is less than an hour
+old, delete-user, reset-user-email and `ghe run` scripts refuse logins it
+does not know before signing in, and the GHE shell completes logins from it.
+"""
+
+import argparse, os, requests, sys, time
+
+from ghe import __title__, __version__
+from ghe.ratelimit import LOW, govern
+from ghe.ssh import connect, stream
+from ghe.trace import tracer
+from ghe.users import UserIndex
+
+class Users(object):
+
+    def __init__(self, **kwargs):
+        ''' Constructor. '''
+
+        self.ghe_host = kwargs.get('ghe_host')
+        self.ghe_ssh_port = kwargs.get('ghe_ssh_port')
+        self.ghe_ssh_user = kwargs.get('ghe_ssh_user')
+        self.ghe_token = kwargs.get('ghe_token')
+
+        self.index = UserIndex(self.ghe_host)
+
+    def refresh(self):
+        ''' Reload the index from the CSV report of every user. '''
+
+        client = connect(
+            self.ghe_host, self.ghe_ssh_port, self.ghe_ssh_user
+        )
+
+        return self.index.load_csv(
+            stream(client, 'ghe-user-csv -o', name='ghe-user-csv')
+        )
+
+    def incremental(self):
+        ''' Add the users created since the highest id in the index. '''
+
+        session = govern(
+            tracer.instrument(requests.Session()), self.ghe_token, LOW
+        )
+        session.headers.update({
+            'Authorization': 'token %s' % self.ghe_token,
+            'Accept': 'application/vnd.github.v3+json',
+            'User-Agent': '%s/%s' % (__title__, __version__)
+        })
+
+        return self.index.add_users(self.iter_users(session))
+
+    def iter_users(self, session):
+        ''' Yield the users after `since`, following the `next` links. '''
+
+        url = 'https://%s/api/v3/users' % self.ghe_host
+        params = {'since': self.index.since, 'per_page': 100}
+        while url:
+            res = session.get(url, params=params)
+            res.raise_for_status()
+            for user in res.json():
+                yield user
+            url = res.links.get('next', {}).get('url')
+            params = None
+
+    def lookup(self, logins):
+        ''' Print what the index knows of each login; return the missing. '''
+
+        missing = []
+        for login in logins:
+            user = self.index.get(login)
+            if user is None:
+                print('%s: not found' % login)
+                missing.append(login)
+                continue
+
+            print('%s: %s%s%s' % (
+                user['login'],
+                user['email'] or 'no email on record',
+                ', %s' % user['role'] if user['role'] else '',
+                ', suspended' if user['suspended'] else ''
+            ))
+
+        return missing
+
+    def summary(self):
+        ''' Describe the size and age of the index. '''
+
+        refreshed = self.index.refreshed
+        if refreshed is None:
+            return 'No user index for %s yet; run `users -refresh`.' % (
+                self.ghe_host
+            )
+
+        return '%d users on %s, refreshed %s%s.' % (
+            self.index.count(), self.ghe_host,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(refreshed)),
+            '' if self.index.fresh() else ' (stale)'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Tool to keep a local index of the users on GitHub Enterprise, '
+            'and look users up in it.'
+        )
+    )
+    parser.add_argument('logins',
+        help='users to look up; exits with 1 if any is missing',
+        metavar='LOGIN',
+        nargs='*'
+    )
+    parser.add_argument('-refresh',
+        help='reload the whole index with `ghe-user-csv` over SSH',
+        action='store_true'
+    )
+    parser.add_argument('-incremental',
+        help=(
+            'add the users created since the last refresh, from the admin '
+            'API'
+        ),
+        action='store_true'
+    )
+    parser.add_argument('-ghe-host',
+        help=(
+            'the hostname to your GitHub Enterprise server '
+            '(default: value from `ghe-host` environment variable)'
+        ),
+        metavar='HOST',
+        default=os.getenv('ghe-host')
+    )
+    parser.add_argument('-ghe-ssh-port',
+        help=(
+            'the port to your GitHub Enterprise SSH server '
+            '(default: 122, or value from `ghe-ssh-port` environment variable)'
+        ),
+        metavar='PORT',
+        type=int,
+        default=os.getenv('ghe-ssh-port', 122)
+    )
+    parser.add_argument('-ghe-ssh-user',
+        help=(
+            'the user to use for SSH access to your GitHub Enterprise server '
+            '(default: value from `ghe-ssh-user` environment variable)'
+        ),
+        metavar='USER',
+        type=str,
+        default=os.getenv('ghe-ssh-user')
+    )
+    parser.add_argument('-ghe-token',
+        help=(
+            'GitHub Enterprise access token, used by -incremental '
+            '(default: value from `ghe-token` environment variable)'
+        ),
+        metavar='TOKEN',
+        type=str,
+        default=os.getenv('ghe-token')
+    )
+
+    args = parser.parse_args()
+
+    if not (args.ghe_host):
+        parser.error(
+            'GitHub Enterprise host not set. Please use -ghe-host HOST.'
+        )
+
+    if args.refresh and not (args.ghe_ssh_user):
+        parser.error(
+            'GitHub Enterprise SSH user not set. Please use -ghe-ssh-user USER.'
+        )
+
+    if args.incremental and not (args.ghe_token):
+        parser.error(
+            'GitHub Enterprise token not set. Please use -ghe-token TOKEN.'
+        )
+
+    app = Users(
+        ghe_host=args.ghe_host,
+        ghe_ssh_port=args.ghe_ssh_port,
+        ghe_ssh_user=args.ghe_ssh_user,
+        ghe_token=args.ghe_token
+    )
+
+    if args.refresh:
+        start = time.time()
+        count = app.refresh()
+        print('Loaded %d users in %.1fs.' % (count, time.time() - start))
+
+    if args.incremental:
+        count = app.incremental()
+        print('Added %d new %s.' % (count, 'user' if count == 1 else 'users'))
+
+    if args.logins:
+        sys.exit(1 if app.lookup(args.logins) else 0)
+
+    if not (args.refresh or args.incremental):
+        print(app.summary())
@@ -0,0 +1,315 @@
+import csv
+import hashlib
+import re
+import yaml
+
+from collections import namedtuple
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+FIELDS = ('model_name', 'source_url', 'target_url', 'recommended_action',
+          'notes')
+
+Conflict = namedtuple('Conflict', FIELDS)
+
+GROUP_REF = re.compile(r'\\(\d+)')
+
+
+def iter_parse(lines):
+    """ Yield Conflict records from `ghe-migrator conflicts` CSV output. """
+
+    width = len(FIELDS)
+    for row in csv.reader(line.rstrip('\r\n') for line in lines):
+        if not row or row[0] == FIELDS[0]:
+            continue
+        if len(row) != width:
+            row = (row + [''] * width)[:width]
+        yield Conflict(*row)
+
+def parse(lines):
+    """ Parse `ghe-migrator conflicts` CSV output into Conflict records. """
+
+    return list(iter_parse(lines))
+
+def writer(f):
+    """ Return a csv writer for Conflict records, with the header written.
+
+    Rows go straight to `f`, so records can be written one at a time as
+    they are resolved.
+    """
+
+    out = csv.writer(f, lineterminator='\n')
+    out.writerow(FIELDS)
+
+    return out
+
+def dump(conflicts, f):
+    """ Write Conflict records to a file object in `ghe-migrator` format. """
+
+    writerow = writer(f).writerow
+    for conflict in conflicts:
+        writerow(conflict)
+
+def dumps(conflicts):
+    """ Return Conflict records as a `ghe-migrator` CSV string. """
+
+    f = StringIO()
+    dump(conflicts, f)
+
+    return f.getvalue()
+
+def load_user_map(path):
+    """ Read a CSV file of `source_login,dest_login` pairs. """
+
+    users = {}
+    with open(path, 'r') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith('#'):
+                continue
+            users[row[0].strip().lower()] = row[1].strip()
+
+    return users
+
+
+def load_rules(path):
+    """ Read mapping rules from a YAML file.
+
+    The file may contain a `users` mapping of GitHub.com logins to GHE
+    logins and a list of `rules`, each with a `model` (or `*`), a `source`
+    regex matched against the conflict's source URL, a `target` template and
+    an optional `action` and `notes`:
+
+        users:
+          octocat: octo-admin
+        rules:
+          - model: team
+            source: https://github.com/{source_org}/teams/(.+)
+            target: https://{ghe_host}/{dest_org}/teams/\\1
+            action: rename
+    """
+
+    with open(path, 'r') as f:
+        data = yaml.safe_load(f) or {}
+
+    if not isinstance(data, dict):
+        raise ValueError('%s: expected a mapping of `users` and `rules`' % path)
+
+    if not isinstance(data.get('users') or {}, dict):
+        raise ValueError('%s: `users` must map GitHub.com logins to GHE '
+                         'logins' % path)
+
+    rules = data.get('rules') or []
+    if not isinstance(rules, list):
+        raise ValueError('%s: `rules` must be a list' % path)
+
+    for number, rule in enumerate(rules, 1):
+        # Strings may be unicode under Python 2.
+        if not isinstance(rule, dict) or \
+                not hasattr(rule.get('source'), 'startswith') or \
+                not hasattr(rule.get('target'), 'startswith'):
+            raise ValueError('%s: rule %d needs a `source` and a `target`' % (
+                path, number
+            ))
+        # Compile the rule as it will be used, to report bad patterns now.
+        try:
+            MappingRule(
+                rule.get('model'), rule['source'], rule['target'],
+                source_org='org', dest_org='org', ghe_host='host'
+            )
+        except re.error as err:
+            raise ValueError('%s: rule %d: invalid `source` pattern: %s' % (
+                path, number, err
+            ))
+
+    users = dict(
+        (str(k).lower(), str(v)) for k, v in (data.get('users') or {}).items()
+    )
+
+    return users, list(rules)
+
+
+def _expand(template, context):
+    """ Substitute `{name}` placeholders, leaving regex braces untouched. """
+
+    for key, value in context.items():
+        template = template.replace('{%s}' % key, value or '')
+
+    return template
+
+
+def _compile_template(template):
+    """ Split a `\\1` style replacement template into literals and groups.
+
+    Returns None if the template has no group references.
+    """
+
+    parts = GROUP_REF.split(template)
+    if len(parts) == 1:
+        return None
+
+    return [
+        int(part) if i % 2 else part
+        for i, part in enumerate(parts) if part or i % 2
+    ]
+
+
+class MappingRule(object):
+    """ A precompiled conflict rewriting rule. """
+
+    __slots__ = ('model', 'source', 'target', 'groups', 'action', 'notes')
+
+    def __init__(self, model, source, target, action='map',
+                 notes='ghe-migrate', **context):
+        """ Compile the rule, substituting `context` into its patterns. """
+
+        escaped = dict((k, re.escape(v or '')) for k, v in context.items())
+
+        self.model = model or '*'
+        self.source = re.compile(_expand(source, escaped) + '/?$', re.I)
+        self.target = _expand(target, context)
+        self.groups = _compile_template(self.target)
+        self.action = action
+        self.notes = notes
+
+    def apply(self, conflict):
+        """ Return the rewritten conflict, or None if it doesn't match. """
+
+        match = self.source.match(conflict.source_url)
+        if not match:
+            return None
+
+        if self.groups:
+            groups = match.groups('')
+            target = ''.join(
+                groups[part - 1] if isinstance(part, int) else part
+                for part in self.groups
+            )
+        else:
+            target = self.target
+
+        return Conflict(
+            conflict.model_name,
+            conflict.source_url,
+            target,
+            self.action,
+            self.notes
+        )
+
+
+class ConflictResolver(object):
+    """ Rule based resolution of `ghe-migrator` conflicts.
+
+    Rules are compiled once per migration and indexed by model name, so each
+    conflict is only checked against the rules for its own model. User
+    mappings are a plain dictionary lookup. Records that were handed to
+    `ghe-migrator map -i` are remembered so that later passes only upload
+    mappings that changed.
+    """
+
+    def __init__(self, **kwargs):
+        """ Initial setup. """
+
+        self.source_org = kwargs.get('source')
+        self.dest_org = kwargs.get('dest')
+        self.ghe_host = kwargs.get('ghe_host')
+        self.user_map = kwargs.get('user_map') or {}
+        self.resolve_all = kwargs.get('resolve_all', False)
+
+        self.submitted = {}
+        self.rules = {}
+
+        context = {
+            'source_org': self.source_org,
+            'dest_org': self.dest_org or self.source_org,
+            'ghe_host': self.ghe_host
+        }
+
+        if self.dest_org:
+            self.add_rule(MappingRule(
+                'organization',
+                'https://github.com/{source_org}',
+                'https://{ghe_host}/{dest_org}',
+                action='rename',
+                **context
+            ))
+
+        for rule in kwargs.get('rules') or []:
+            self.add_rule(MappingRule(
+                rule.get('model'),
+                rule['source'],
+                rule['target'],
+                action=rule.get('action', 'map'),
+                notes=rule.get('notes', 'ghe-migrate'),
+                **context
+            ))
+
+    def reset(self):
+        """ Forget submitted mappings before resolving a new migration. """
+
+        self.submitted = {}
+
+    def add_rule(self, rule):
+        """ Register a compiled rule for its model. """
+
+        self.rules.setdefault(rule.model, []).append(rule)
+
+    def resolve_one(self, conflict):
+        """ Return the resolved conflict, or None if no rule applies. """
+
+        if conflict.model_name == 'user' and self.user_map:
+            login = conflict.source_url.rstrip('/').rsplit('/', 1)[-1].lower()
+            if login in self.user_map:
+                return Conflict(
+                    conflict.model_name,
+                    conflict.source_url,
+                    'https://%s/%s' % (self.ghe_host, self.user_map[login]),
+                    'map',
+                    'ghe-migrate'
+                )
+
+        for key in (conflict.model_name, '*'):
+            for rule in self.rules.get(key, ()):
+                res = rule.apply(conflict)
+                if res is not None:
+                    return res
+
+        if self.resolve_all:
+            return conflict
+
+        return None
+
+    def iter_resolve(self, conflicts):
+        """ Yield (conflict, resolved) pairs; resolved is None if unhandled. """
+
+        resolve_one = self.resolve_one
+        for conflict in conflicts:
+            yield conflict, resolve_one(conflict)
+
+    def submit(self, conflict):
+        """ Remember a record; return False if it was submitted already. """
+
+        key, value = _digests(conflict)
+        if self.submitted.get(key) == value:
+            return False
+        self.submitted[key] = value
+
+        return True
+
+
+def _digests(conflict):
+    """ Short digests of a record's identity and of its whole mapping.
+
+    Only these are remembered between passes, so the memory held for a
+    migration does not grow with the length of its URLs and notes.
+    """
+
+    def digest(fields):
+        data = '\0'.join(fields)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return hashlib.md5(data).digest()[:12]
+
+    return digest(conflict[:2]), digest(conflict)
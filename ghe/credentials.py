@@ -0,0 +1,342 @@
+import calendar
+import os
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from . import __title__, __version__
+from .ratelimit import NORMAL, Governor
+from .trace import tracer
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+# Installation tokens are replaced this long before they expire, so no
+# request is sent with a token about to lapse.
+REFRESH_MARGIN = 300
+
+# GitHub rejects app JWTs valid for longer than ten minutes, or issued in
+# the future by a clock running ahead.
+JWT_LIFETIME = 540
+JWT_SKEW = 60
+
+# Installation tokens minted by this process, shared by every pool using
+# the same installation.
+_installations = {}
+_installations_lock = threading.Lock()
+
+
+class Token(object):
+    """ A personal access token, with the rate limit governor it draws on. """
+
+    def __init__(self, token):
+        """ Initial setup. """
+
+        self.token = token
+        self.key = token
+        self.governor = Governor(token)
+
+    @property
+    def fresh(self):
+        """ Whether the token can be used without minting it first. """
+
+        return True
+
+    def expire(self):
+        """ Drop a rejected token; return False as it cannot be renewed. """
+
+        return False
+
+
+class Installation(object):
+    """ A GitHub App installation, used through its installation tokens.
+
+    A token is minted with a JWT signed by the app's private key and kept
+    until shortly before it expires; the next use then mints a new one.
+    The rate limit of an installation outlives its tokens, so it has one
+    governor for all of them.
+    """
+
+    def __init__(self, app_id, key, installation,
+                 base_url='https://api.github.com'):
+        """ Initial setup. """
+
+        if jwt is None:
+            raise RuntimeError(
+                'PyJWT is required to authenticate as a GitHub App.'
+            )
+
+        # The key is stored in the keyring as a path or as the PEM itself.
+        if os.path.isfile(os.path.expanduser(key)):
+            with open(os.path.expanduser(key)) as f:
+                key = f.read()
+
+        self.app_id = app_id
+        self.private_key = key
+        self.installation = installation
+        self.base_url = base_url.rstrip('/')
+        self.key = 'app:%s:%s:%s' % (self.base_url, app_id, installation)
+        self.governor = Governor(self.key)
+
+        self.lock = threading.Lock()
+        self._token = None
+        self.expires = 0
+
+    @classmethod
+    def shared(cls, app_id, key, installation,
+               base_url='https://api.github.com'):
+        """ The process-wide Installation, so tokens are minted once. """
+
+        with _installations_lock:
+            ident = (base_url.rstrip('/'), str(app_id), str(installation))
+            if ident not in _installations:
+                _installations[ident] = cls(app_id, key, installation,
+                                            base_url)
+
+            return _installations[ident]
+
+    @property
+    def fresh(self):
+        """ Whether the current token is good for a while yet. """
+
+        return self._token is not None and \
+            self.expires - time.time() > REFRESH_MARGIN
+
+    @property
+    def token(self):
+        """ An installation token, minted again when close to expiry. """
+
+        with self.lock:
+            if not self.fresh:
+                self._token, self.expires = self.mint()
+
+            return self._token
+
+    def expire(self):
+        """ Drop a rejected token; return True as the next use renews it. """
+
+        with self.lock:
+            self._token = None
+
+        return True
+
+    def app_jwt(self):
+        """ A short-lived JWT identifying the app. """
+
+        now = int(time.time())
+        token = jwt.encode({
+            'iat': now - JWT_SKEW,
+            'exp': now + JWT_LIFETIME,
+            'iss': str(self.app_id)
+        }, self.private_key, algorithm='RS256')
+
+        # PyJWT 1.x returns bytes.
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+    def mint(self):
+        """ Create an installation token; return it with its expiry time. """
+
+        session = tracer.instrument(requests.Session())
+        res = session.post(
+            '%s/app/installations/%s/access_tokens' % (
+                self.base_url, self.installation
+            ),
+            headers={
+                'Authorization': 'Bearer %s' % self.app_jwt(),
+                'Accept': 'application/vnd.github.machine-man-preview+json',
+                'User-Agent': '%s/%s' % (__title__, __version__)
+            }
+        )
+        res.raise_for_status()
+        data = res.json()
+
+        expires = calendar.timegm(
+            time.strptime(data['expires_at'], '%Y-%m-%dT%H:%M:%SZ')
+        )
+
+        return data['token'], expires
+
+
+class CredentialPool(object):
+    """ Several credentials for one API, used as one larger budget.
+
+    Each request goes to the credential with the most requests left in its
+    rate limit window, as recorded by its governor; credentials tied on
+    headroom, or not used yet, take turns. A request waits only when every
+    credential would make it wait.
+    """
+
+    def __init__(self, credentials):
+        """ Initial setup. """
+
+        if not credentials:
+            raise ValueError('A credential pool needs a credential.')
+
+        self.credentials = list(credentials)
+        self.key = tuple(c.key for c in self.credentials)
+        self.lock = threading.Lock()
+        self.turn = 0
+
+    @classmethod
+    def from_env(cls, prefix, token=None, base_url='https://api.github.com',
+                 env=None):
+        """ Build a pool from environment values such as `gh-token`.
+
+        Besides `token`, the pool holds the tokens in `<prefix>-token-1`,
+        `<prefix>-token-2` and so on up to the first one missing, and, when
+        `<prefix>-app-id`, `<prefix>-app-key` and `<prefix>-app-installation`
+        are all set, each of the app's installations (separated by commas).
+        """
+
+        env = os.environ if env is None else env
+        tokens = [token] if token else []
+        number = 1
+        while env.get('%s-token-%d' % (prefix, number)):
+            tokens.append(env['%s-token-%d' % (prefix, number)])
+            number += 1
+
+        credentials = []
+        for value in tokens:
+            if value not in [c.token for c in credentials]:
+                credentials.append(Token(value))
+
+        app_id = env.get('%s-app-id' % prefix)
+        key = env.get('%s-app-key' % prefix)
+        installations = env.get('%s-app-installation' % prefix)
+        if app_id and key and installations:
+            for installation in installations.split(','):
+                if installation.strip():
+                    credentials.append(Installation.shared(
+                        app_id, key, installation.strip(), base_url
+                    ))
+
+        return cls(credentials)
+
+    @property
+    def token(self):
+        """ The token of the first credential. """
+
+        return self.credentials[0].token
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def candidates(self):
+        """ The credentials, most headroom first. """
+
+        with self.lock:
+            start = self.turn
+            self.turn = (self.turn + 1) % len(self.credentials)
+        order = self.credentials[start:] + self.credentials[:start]
+        if len(order) == 1:
+            return order
+
+        # Unknown budgets come first, so each credential gets measured;
+        # the sort is stable, so ties keep their turn.
+        now = time.time()
+        headroom = dict(
+            (c.key, c.governor.headroom(now)) for c in order
+        )
+
+        return sorted(order, key=lambda c: -(
+            float('inf') if headroom[c.key] is None else headroom[c.key]
+        ))
+
+    def pin(self):
+        """ A pool of just the credential with the most headroom now.
+
+        The pages of a listing are all fetched with the pinned credential:
+        the accounts behind a pool may not see the same private repos, so
+        pages fetched with different ones could leave repos out.
+        """
+
+        if len(self.credentials) == 1:
+            return self
+
+        return CredentialPool(self.candidates()[:1])
+
+    def take(self, priority, waiter):
+        """ Take a request from the best credential that allows it now.
+
+        Returns the credential and 0, or None and the number of seconds to
+        wait before asking again.
+        """
+
+        tried = []
+        delays = []
+        for credential in self.candidates():
+            delay = credential.governor.take(priority, waiter)
+            if delay <= 0:
+                for other in tried:
+                    other.governor.cancel(waiter)
+                return credential, 0
+            tried.append(credential)
+            delays.append(delay)
+
+        return None, min(delays)
+
+    def acquire(self, priority=NORMAL):
+        """ Block until a credential may send a request; return it. """
+
+        waiter = '%d:%d' % (os.getpid(), threading.current_thread().ident)
+        waited = 0
+
+        while True:
+            credential, delay = self.take(priority, waiter)
+            if credential is not None:
+                break
+            waited += delay
+            time.sleep(delay)
+
+        if waited:
+            tracer.count('ghe_api_throttled_seconds_total', waited,
+                         priority=str(priority))
+
+        return credential
+
+    def adapter(self, priority=NORMAL, **kwargs):
+        """ A requests transport adapter drawing on the pool. """
+
+        return PooledAdapter(self, priority, **kwargs)
+
+
+class PooledAdapter(HTTPAdapter):
+    """ Transport adapter that sends each request with a pooled credential.
+
+    The `Authorization` header set on the session is replaced with the
+    token of the credential chosen for the request; requests without one,
+    such as redirects to archive storage, are sent as they are, without
+    drawing on the pool. Requests rejected by a rate limit, or with an
+    expired installation token, are retried, up to `retries` times.
+    """
+
+    def __init__(self, pool, priority=NORMAL, retries=5, **kwargs):
+        """ Initial setup. """
+
+        self.pool = pool
+        self.priority = priority
+        self.retries = retries
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        # Unauthenticated requests don't count against any rate limit.
+        if 'Authorization' not in request.headers:
+            return HTTPAdapter.send(self, request, **kwargs)
+
+        for attempt in range(self.retries + 1):
+            credential = self.pool.acquire(self.priority)
+            request.headers['Authorization'] = 'token %s' % credential.token
+            response = HTTPAdapter.send(self, request, **kwargs)
+            retry = credential.governor.update(response) or (
+                response.status_code == 401 and credential.expire()
+            )
+            if not retry or attempt == self.retries:
+                break
+            response.close()
+
+        return response
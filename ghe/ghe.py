@@ -8,6 +8,7 @@ import logging
 import keyring
 import pyparsing
 import shlex
+import signal
 
 # Fix OS X Tab completion due to libedit not being fully readline compatible.
 import readline, rlcompleter
@@ -21,6 +22,11 @@ from cmd2 import Cmd, ParsedString
 logger = logging.getLogger(__name__)
 
 from . import __title__, __desc__, __version__
+from . import server
+from .jobs import INTERACTIVE, JobTable, needs_terminal
+from .script import ScriptRunner, argument_parser
+from .trace import tracer
+from .users import USER_ARGS, UserIndex, user_arg
 
 keyring_keys = [
     'ghe-host',     # The hostname to the GHE server
@@ -33,6 +39,20 @@ keyring_keys = [
     'ghe-totp'      # A base32 seed for the OTP two-factor code generation
 ]
 
+optional_keys = [
+    'ghe-trace',        # A file to export timings to (.json: Chrome trace)
+    'ghe-mirror-dir',   # Where to keep local repo mirrors (~/.ghe/mirrors)
+    'ghe-mirror-quota', # Disk space the mirrors may use, e.g. 200G
+    'ghe-socket',       # The `ghe serve` socket (~/.ghe/ghe.sock)
+    'gh-app-id',        # A GitHub App adding to the gh-token rate limit
+    'gh-app-key',       # The app's private key, or the path to it
+    'gh-app-installation' # The app's installation id(s), comma separated
+]
+
+# Keys that may be followed by numbered extras (gh-token-1, gh-token-2, ...)
+# pooled with them for a larger API rate limit.
+numbered_keys = ['gh-token', 'ghe-token']
+
 class GHE(Cmd):
 
     def __init__(self):
@@ -58,6 +78,9 @@ class GHE(Cmd):
                        '<value>` to save to keyring.').format(key))
 
         self.env = os.environ.copy()
+        self.jobs = JobTable()
+        self.users = None
+        self._exit_warned = False
 
     def set_logger(self, logger=None):
         """ Set the logger. """
@@ -95,41 +118,181 @@ class GHE(Cmd):
 
         return commands
 
-    def _run_command(self, cmd, opts):
-        """ Run a subcommand. """
+    def _command_env(self):
+        """ Environment for subcommands, with the keyring values set. """
 
         env = os.environ.copy()
         for key in keyring_keys:
             env[key] = get_key(key)
+        for key in optional_keys:
+            if key not in env and get_key(key):
+                env[key] = get_key(key)
+        for base in numbered_keys:
+            number = 1
+            while get_key('%s-%d' % (base, number)):
+                key = '%s-%d' % (base, number)
+                env.setdefault(key, get_key(key))
+                number += 1
+
+        tracer.path = tracer.path or env.get('ghe-trace')
+
+        return env
+
+    def _run_command(self, cmd, opts):
+        """ Run a subcommand, in the `ghe serve` daemon if one is running. """
 
         if type(opts) == str:
             opts = shlex.split(opts)
 
-        subprocess.call([cmd] + opts, env=env)
+        name = os.path.splitext(os.path.basename(cmd).split('-', 1)[1])[0]
+        if server.call(name, opts) is not None:
+            return
+
+        env = self._command_env()
+
+        with tracer.span('command', os.path.basename(cmd)) as span:
+            span.args['status'] = subprocess.call([cmd] + opts, env=env)
+        tracer.flush()
+
+    def _start_job(self, name, cmd, opts):
+        """ Run a subcommand in the background. """
+
+        job = self.jobs.start(
+            name, [cmd] + shlex.split(opts), self._command_env()
+        )
+        print('[%d] %d' % (job.number, job.proc.pid))
+
+    def _get_job(self, args):
+        """ Find the job named by `args` (`N` or `%N`; default: latest). """
+
+        args = args.strip().lstrip('%')
+        if args and not args.isdigit():
+            print('%s: no such job' % args)
+            return
+
+        job = self.jobs.get(int(args) if args else None)
+        if job is None:
+            print('%s: no such job' % (args or 'current'))
+
+        return job
+
+    def _report_jobs(self):
+        """ Report background jobs that finished since the last prompt. """
+
+        for job in self.jobs.reap():
+            print('[%d]  %-10s %s' % (job.number, job.status, job.name))
+
+    def do_jobs(self, args):
+        """ List background jobs. """
+
+        for job in self.jobs.jobs:
+            print('[%d]  %-10s %s' % (job.number, job.status, job.name))
+            if '-l' in args.split():
+                print('      pid %d, log %s' % (job.proc.pid, job.log_path))
+
+    def do_fg(self, args):
+        """ Follow the output of a job until it finishes; Ctrl-C detaches. """
+
+        job = self._get_job(args)
+        if job is None:
+            return
+
+        print(job.name)
+        job.attach()
+        try:
+            while not job.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            print('\n[%d] %d still running in the background' % (
+                job.number, job.proc.pid
+            ))
+        finally:
+            job.detach()
+
+        self._report_jobs()
+
+    def do_kill(self, args):
+        """ Stop a job: `kill [-9] [N]`. """
+
+        args = args.split()
+        sig = signal.SIGTERM
+        if args and args[0].startswith('-'):
+            name = args.pop(0)[1:].upper()
+            sig = int(name) if name.isdigit() else getattr(
+                signal, name if name.startswith('SIG') else 'SIG' + name, None
+            )
+            if sig is None:
+                print('%s: invalid signal' % name)
+                return
+
+        job = self._get_job(' '.join(args))
+        if job is not None:
+            job.kill(sig)
+
+    def do_run(self, args):
+        """ Run a file of commands: `run FILE [-parallel INT]`. """
+
+        try:
+            opts = argument_parser().parse_args(shlex.split(args))
+        except SystemExit:
+            return
+
+        self.run_script(opts.script, opts.parallel, opts.keep_going)
+
+    def run_script(self, path, parallel=1, keep_going=False):
+        """ Run a file of commands; return the lines that failed. """
+
+        try:
+            return ScriptRunner(self, parallel, keep_going).run(path)
+        except (IOError, OSError) as err:
+            print('run: %s' % err)
+            return [path]
+        finally:
+            tracer.flush()
 
     def onecmd(self, line):
         """ Override cmd2's command line parsing for interactive shell. """
 
+        self._report_jobs()
+
         statement = self.parsed(line)
-        cmd = statement.parsed.raw
+        cmd = statement.parsed.raw.strip()
+        background = cmd.endswith('&')
+        if background:
+            cmd = cmd[:-1].rstrip()
+
         args = ''
         if ' ' in cmd:
             cmd, args = cmd.split(' ', 1)
 
         if cmd == 'exit' or cmd == 'quit':
+            running = self.jobs.running()
+            if running and not self._exit_warned:
+                print(('There are %d running jobs. Exit again to stop them.'
+                       ) % len(running))
+                self._exit_warned = True
+                return
+            for job in running:
+                job.kill()
             self._should_quit = True
             return self._STOP_AND_EXIT
+        self._exit_warned = False
 
         if cmd == 'help':
             print('Available %s commands are:' % __title__)
             for command in self.commands.keys():
                 print('  %s' % command)
+            print('Append & to run a command in the background, then use '
+                  '`jobs`, `fg [N]` and `kill [-9] [N]`.')
+            print('Use `run FILE [-parallel INT] [-keep-going]` to run a '
+                  'file of commands.')
             return
 
         if cmd == 'set':
             key, val = args.split(' ', 1)
             if key and val:
                 set_key(key, val)
+                server.reload()
             return
 
         if cmd == 'get':
@@ -138,12 +301,28 @@ class GHE(Cmd):
 
         if cmd == 'unset':
             unset_key(args.split(' ')[0])
+            server.reload()
             return
 
+        if cmd in ('jobs', 'fg', 'kill', 'run'):
+            return getattr(self, 'do_%s' % cmd)(args)
+
         if cmd not in self.commands:
             print('%s: command not found' % cmd)
             return
 
+        if background and needs_terminal(cmd, shlex.split(args)):
+            print('%s may prompt for input, which a background job cannot '
+                  'answer; run it in the foreground or add %s.' % (
+                      cmd, ' or '.join(INTERACTIVE[cmd])
+                  ))
+            return
+
+        if background:
+            return self._start_job(
+                ' '.join([cmd, args]).strip(), self.commands.get(cmd), args
+            )
+
         return self._run_command(self.commands.get(cmd), args)
 
     def completenames(self, text, *ignored):
@@ -156,6 +335,30 @@ class GHE(Cmd):
 
         return self.commands.keys()
 
+    def completedefault(self, text, line, begidx, endidx):
+        """ Complete logins for commands acting on a user. """
+
+        # Readline splits words on '-', which logins may contain.
+        before = line[:begidx]
+        words = before.split()
+        partial = ''
+        if words and not before[-1:].isspace():
+            partial = words.pop()
+        prefix = partial + text
+
+        if not words or words[0] not in USER_ARGS or prefix.startswith('-'):
+            return []
+        if user_arg(words[0], words[1:]) is not None:
+            return []
+
+        host = get_key('ghe-host')
+        if not host:
+            return []
+        if self.users is None or self.users.host != host:
+            self.users = UserIndex(host)
+
+        return [login[len(partial):] for login in self.users.logins(prefix)]
+
 
 class GHECLI(GHE):
 
@@ -205,8 +408,29 @@ class GHECLI(GHE):
             cmd = subparsers.add_parser(command)
             cmd.set_defaults(action=command)
 
+        subparsers.add_parser('run', add_help=False)
+        subparsers.add_parser('serve', add_help=False)
+
         args, opts = parser.parse_known_args()
 
+        if args.cmd == 'run':
+            opts = argument_parser().parse_args(opts)
+            failed = self.run_script(
+                opts.script, opts.parallel, opts.keep_going
+            )
+            exit(1 if failed else 0)
+
+        if args.cmd == 'serve':
+            opts = server.argument_parser().parse_args(opts)
+            try:
+                server.Server(self, opts.socket).serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except RuntimeError as err:
+                print(err)
+                exit(1)
+            exit(0)
+
         if args.cmd not in self.commands:
             self.cmdloop()
             exit(1)
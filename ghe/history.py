@@ -0,0 +1,274 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HISTORY_DIR = os.path.join(os.path.expanduser('~'), '.ghe', 'history')
+
+# Migration stages, in the order a batch goes through them.
+STAGES = ('export', 'download', 'prepare', 'conflicts', 'import')
+
+# What is known about a batch, most telling first; when the history is too
+# short to fit them all, the last ones are left out first.
+FEATURES = ('bytes', 'repos', 'commits', 'archive_bytes')
+
+
+class History(object):
+    """ Durations of past migration stages, kept in a JSON lines file.
+
+    Each line records one stage of one batch: how long it took and the
+    size of the batch (repos, bytes, commits and archive bytes, as far as
+    they were known). The file is per GHE server, at
+    ~/.ghe/history/<host>.jsonl.
+    """
+
+    def __init__(self, host, path=None):
+        """ Initial setup. """
+
+        self.host = host
+        self.path = path or os.path.join(HISTORY_DIR, '%s.jsonl' % host)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, **features):
+        """ Append the duration of a stage and the batch's features. """
+
+        entry = dict(
+            (key, value) for key, value in features.items()
+            if value is not None
+        )
+        entry.update(stage=stage, seconds=round(seconds, 3), time=time.time())
+
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def load(self):
+        """ Return all recorded entries, skipping unreadable lines. """
+
+        entries = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except (IOError, OSError):
+            pass
+
+        return entries
+
+
+class Model(object):
+    """ A least squares fit of a target against batch features.
+
+    Features are standardized before fitting, so repo counts and byte
+    counts of very different magnitude can be solved for together.
+    """
+
+    def __init__(self, features, rows, target='seconds'):
+        """ Fit the model to the rows that have every feature. """
+
+        self.features = features
+        n = len(rows)
+        columns = [[float(row[f]) for row in rows] for f in features]
+        self.means = [sum(c) / n for c in columns]
+        self.scales = [
+            (sum((x - m) ** 2 for x in c) / n) ** 0.5 or 1.0
+            for c, m in zip(columns, self.means)
+        ]
+
+        X = [
+            [1.0] + [
+                (float(row[f]) - m) / s
+                for f, m, s in zip(features, self.means, self.scales)
+            ]
+            for row in rows
+        ]
+        y = [float(row[target]) for row in rows]
+
+        self.coef = solve(X, y)
+        self.samples = n
+
+    def predict(self, features):
+        """ Predict the target for a dict of features; never negative. """
+
+        x = [1.0] + [
+            (float(features[f]) - m) / s
+            for f, m, s in zip(self.features, self.means, self.scales)
+        ]
+
+        return max(0.0, sum(c * v for c, v in zip(self.coef, x)))
+
+
+def solve(X, y, ridge=1e-6):
+    """ Least squares coefficients b for X b = y, by the normal equations.
+
+    A small ridge term keeps the system solvable when features move
+    together, e.g. when every batch had the same number of repos.
+    """
+
+    k = len(X[0])
+    A = [
+        [sum(row[i] * row[j] for row in X) for j in range(k)]
+        for i in range(k)
+    ]
+    b = [sum(row[i] * v for row, v in zip(X, y)) for i in range(k)]
+    for i in range(1, k):
+        A[i][i] += ridge * len(X)
+
+    # Gaussian elimination with partial pivoting.
+    for col in range(k):
+        pivot = max(range(col, k), key=lambda r: abs(A[r][col]))
+        A[col], A[pivot] = A[pivot], A[col]
+        b[col], b[pivot] = b[pivot], b[col]
+        if abs(A[col][col]) < 1e-12:
+            continue
+        for r in range(col + 1, k):
+            factor = A[r][col] / A[col][col]
+            for c in range(col, k):
+                A[r][c] -= factor * A[col][c]
+            b[r] -= factor * b[col]
+
+    coef = [0.0] * k
+    for i in reversed(range(k)):
+        if abs(A[i][i]) < 1e-12:
+            continue
+        coef[i] = (b[i] - sum(A[i][j] * coef[j] for j in range(i + 1, k))) \
+            / A[i][i]
+
+    return coef
+
+
+class Estimator(object):
+    """ Predicts stage durations of new batches from a History.
+
+    For each stage, the model uses as many of the features known for the
+    batch as the history supports: a fit needs at least two more samples
+    than it has features, so short histories fall back to fewer features
+    and finally to the mean duration. Missing archive sizes are predicted
+    from past downloads first.
+    """
+
+    def __init__(self, entries):
+        """ Initial setup. """
+
+        self.entries = entries
+        self.models = {}
+
+    def model(self, stage, known, target='seconds'):
+        """ The best model of a stage for the features in `known`. """
+
+        key = (stage, tuple(known), target)
+        if key not in self.models:
+            rows = [
+                e for e in self.entries
+                if e.get('stage') == stage and e.get(target) is not None
+            ]
+            self.models[key] = None
+            candidates = [f for f in FEATURES if f in known and f != target]
+            while True:
+                usable = [
+                    e for e in rows
+                    if all(e.get(f) is not None for f in candidates)
+                ]
+                if len(usable) >= len(candidates) + 2 or \
+                        (not candidates and usable):
+                    self.models[key] = Model(candidates, usable, target)
+                    break
+                if not candidates:
+                    break
+                candidates.pop()
+
+        return self.models[key]
+
+    def estimate(self, features):
+        """ Predict each stage of a batch: {stage: seconds or None}. """
+
+        features = dict(
+            (key, value) for key, value in features.items()
+            if value is not None
+        )
+        if 'archive_bytes' not in features:
+            model = self.model('download', sorted(features), 'archive_bytes')
+            if model is not None:
+                features['archive_bytes'] = model.predict(features)
+
+        known = sorted(features)
+        estimates = {}
+        for stage in STAGES:
+            model = self.model(stage, known)
+            estimates[stage] = None if model is None else \
+                model.predict(features)
+
+        return estimates
+
+    def samples(self, stage):
+        """ Number of recorded runs of a stage. """
+
+        return sum(1 for e in self.entries if e.get('stage') == stage)
+
+
+def schedule(estimates, concurrency=1, start=None):
+    """ Lay out predicted batches the way ghe-migrate runs them.
+
+    `estimates` holds the output of Estimator.estimate() for each batch, in
+    order. Exports run on GitHub up to `concurrency` batches ahead, at most
+    `concurrency` batches are downloaded, prepared and imported at once, and
+    conflict resolution runs for one batch at a time. Unknown durations
+    count as zero. Returns a (start, end) pair of times for each batch.
+    """
+
+    now = start if start is not None else time.time()
+    slots = [now] * max(1, concurrency)
+    conflicts_free = now
+    submitted = []
+    times = []
+
+    def stage(estimate, name):
+        return estimate.get(name) or 0.0
+
+    for i, estimate in enumerate(estimates):
+        # An export is requested once the batch `concurrency` places ahead
+        # of it has been handed to a slot.
+        ahead = i - concurrency - 1
+        began = submitted[ahead] if ahead >= 0 else now
+        exported = began + stage(estimate, 'export')
+
+        slot = min(range(len(slots)), key=slots.__getitem__)
+        at = max(exported, slots[slot], submitted[-1] if submitted else now)
+        submitted.append(at)
+
+        at += stage(estimate, 'download') + stage(estimate, 'prepare')
+        at = max(at, conflicts_free) + stage(estimate, 'conflicts')
+        conflicts_free = at
+        at += stage(estimate, 'import')
+
+        slots[slot] = at
+        times.append((began, at))
+
+    return times
+
+def format_duration(seconds):
+    """ Format a predicted duration such as `1h05m`, or `?` if unknown. """
+
+    if seconds is None:
+        return '?'
+
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % divmod(seconds, 60)
+
+    return '%dh%02dm' % divmod(seconds // 60, 60)
@@ -0,0 +1,219 @@
+import re
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from . import __title__, __version__
+from .ratelimit import NORMAL, govern
+from .trace import tracer
+
+LAST_PAGE = re.compile(r'[?&]page=(\d+)')
+
+
+class RepoInfo(object):
+    """ The parts of an organization repository listing that ghe uses. """
+
+    __slots__ = ('full_name', 'size', 'pushed_at', 'archived')
+
+    def __init__(self, full_name, size=0, pushed_at=None, archived=False):
+        """ Initial setup. """
+
+        self.full_name = full_name
+        self.size = size or 0
+        self.pushed_at = pushed_at
+        self.archived = archived
+
+    @property
+    def name(self):
+        """ The repository name without its owner. """
+
+        return self.full_name.split('/', 1)[-1]
+
+    @property
+    def bytes(self):
+        """ Repository size in bytes; the API reports kilobytes. """
+
+        return self.size * 1024
+
+    @classmethod
+    def from_api(cls, data):
+        """ Build a record from a repository JSON object. """
+
+        return cls(
+            data['full_name'],
+            data.get('size'),
+            data.get('pushed_at'),
+            data.get('archived', False)
+        )
+
+    def __repr__(self):
+        return '<RepoInfo %s %dKB>' % (self.full_name, self.size)
+
+
+class OrgInventory(object):
+    """ Streams the repository listing of an organization.
+
+    The first page is fetched on its own; if its `Link` header names the
+    last page, the remaining pages are fetched concurrently (keeping at most
+    `workers` pages in flight) and yielded in order. Otherwise the `next`
+    links are followed one by one. Only RepoInfo records are kept, not the
+    full API objects. Requests go through the rate limit governor of the
+    token with the given `priority`. With a CredentialPool for `token`,
+    every page of a listing is fetched with the same credential, pinned
+    when the listing starts, while independent requests such as commit
+    counts are spread over the pool.
+    """
+
+    def __init__(self, token, base_url='https://api.github.com', workers=8,
+                 per_page=100, priority=NORMAL):
+        """ Initial setup. """
+
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.per_page = per_page
+        self.token = token
+        self.priority = priority
+
+        self.session = self._session(token)
+
+    def iter_repos(self, org):
+        """ Yield a RepoInfo record for every repository in `org`. """
+
+        url = '%s/orgs/%s/repos' % (self.base_url, org)
+
+        session = self.session
+        if hasattr(self.token, 'pin'):
+            session = self._session(self.token.pin())
+
+        res = self._get(url, 1, session)
+        for repo in res.json():
+            yield RepoInfo.from_api(repo)
+
+        last = res.links.get('last', {}).get('url')
+        match = LAST_PAGE.search(last or '')
+
+        if match:
+            for page in self._iter_pages(url, 2, int(match.group(1)),
+                                         session):
+                for repo in page:
+                    yield RepoInfo.from_api(repo)
+            return
+
+        while 'next' in res.links:
+            res = self._get(res.links['next']['url'], session=session)
+            for repo in res.json():
+                yield RepoInfo.from_api(repo)
+
+    def repos(self, org):
+        """ Return all repositories in `org` as a list of RepoInfo. """
+
+        return list(self.iter_repos(org))
+
+    def repo(self, full_name):
+        """ Return the RepoInfo of a single repository. """
+
+        return RepoInfo.from_api(
+            self._get('%s/repos/%s' % (self.base_url, full_name)).json()
+        )
+
+    def count(self, path, **params):
+        """ Number of items in a listing such as `repos/:owner/:repo/pulls`.
+
+        Only one item is fetched; the count is read from the page number of
+        the `last` link.
+        """
+
+        params['per_page'] = 1
+        res = self.session.get(
+            '%s/%s' % (self.base_url, path), params=params
+        )
+        # Git data of empty repositories answers 409 Conflict.
+        if res.status_code == 409:
+            return 0
+        res.raise_for_status()
+
+        match = LAST_PAGE.search(res.links.get('last', {}).get('url', ''))
+
+        return int(match.group(1)) if match else len(res.json())
+
+    def commit_count(self, full_name):
+        """ Number of commits on the default branch of a repository. """
+
+        return self.count('repos/%s/commits' % full_name)
+
+    def issue_counts(self, full_name):
+        """ Return the numbers of issues and of pull requests of a repo. """
+
+        # The issues listing includes pull requests.
+        issues = self.count('repos/%s/issues' % full_name, state='all')
+        pulls = self.count('repos/%s/pulls' % full_name, state='all')
+
+        return issues - pulls, pulls
+
+    def commit_counts(self, full_names):
+        """ Count the commits of many repositories concurrently.
+
+        Returns {full_name: count}; repositories that could not be counted
+        are left out.
+        """
+
+        def count(full_name):
+            try:
+                return full_name, self.commit_count(full_name)
+            except (requests.RequestException, ValueError):
+                return full_name, None
+
+        pool = ThreadPool(self.workers)
+        try:
+            return dict(
+                (name, n) for name, n in pool.imap_unordered(count, full_names)
+                if n is not None
+            )
+        finally:
+            pool.terminate()
+
+    def _iter_pages(self, url, first, last, session=None):
+        """ Fetch pages `first`..`last` concurrently; yield them in order. """
+
+        pool = ThreadPool(self.workers)
+        try:
+            pending = []
+            page = first
+            while page <= last or len(pending):
+                while page <= last and len(pending) < self.workers:
+                    pending.append(pool.apply_async(
+                        self._get, (url, page, session)
+                    ))
+                    page += 1
+
+                yield pending.pop(0).get().json()
+        finally:
+            pool.terminate()
+
+    def _session(self, token):
+        """ A session drawing on the rate limit of `token`. """
+
+        session = govern(
+            tracer.instrument(requests.Session()), token, self.priority,
+            pool_maxsize=max(10, self.workers)
+        )
+        session.headers.update({
+            'Authorization': 'token %s' % getattr(token, 'token', token),
+            'Accept': 'application/vnd.github.v3+json',
+            'User-Agent': '%s/%s' % (__title__, __version__)
+        })
+
+        return session
+
+    def _get(self, url, page=None, session=None):
+        """ GET a page of results, raising on HTTP errors. """
+
+        params = None
+        if page is not None:
+            params = {'per_page': self.per_page, 'page': page}
+
+        res = (session or self.session).get(url, params=params)
+        res.raise_for_status()
+
+        return res
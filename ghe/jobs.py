@@ -0,0 +1,215 @@
+import io
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from collections import deque
+
+from .trace import Span, tracer
+
+# Commands that prompt on the terminal or open an editor, with the options
+# that stop them from doing so. Jobs have no terminal, so these commands
+# only run in the background with one of the options.
+INTERACTIVE = {
+    'migrate': ('-resolve-all', '-plan'),
+    'delete-user': ('-no-confirm',)
+}
+
+
+def needs_terminal(cmd, words):
+    """ Whether a command run with `words` would read from the terminal. """
+
+    options = INTERACTIVE.get(cmd)
+    if options is None:
+        return False
+
+    return not any(
+        word in options or word in ('-h', '--help') for word in words
+    )
+
+
+class Job(object):
+    """ A sub-command running in the background of the shell.
+
+    Its output is read on a thread into a ring buffer of the last `lines`
+    lines and appended to a log file. While the job is attached (`fg`), the
+    output is also echoed to the terminal.
+    """
+
+    def __init__(self, number, name, args, env, log_dir, lines=1000):
+        """ Start the sub-command; `name` is the command line as typed. """
+
+        self.number = number
+        self.name = name
+        self.args = args
+        self.buffer = deque(maxlen=lines)
+        self.lock = threading.Lock()
+        self.attached = False
+        self.started = time.time()
+        self.ended = None
+        self.returncode = None
+        self.notified = False
+
+        self.log_path = os.path.join(log_dir, '%d-%s-%s.log' % (
+            number,
+            os.path.basename(args[0]).split('.')[0],
+            time.strftime('%Y%m%d%H%M%S', time.localtime(self.started))
+        ))
+        self.log = io.open(self.log_path, 'ab')
+
+        # Sub-commands flush each line so the buffer keeps up with them.
+        env = dict(env, PYTHONUNBUFFERED='1')
+
+        kwargs = {}
+        if os.name == 'posix':
+            # Its own session, so Ctrl-C in the shell does not reach it.
+            kwargs['preexec_fn'] = os.setsid
+
+        with open(os.devnull) as devnull:
+            self.proc = subprocess.Popen(
+                args,
+                env=env,
+                stdin=devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                **kwargs
+            )
+
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def running(self):
+        """ Whether the sub-command is still running. """
+
+        return self.returncode is None
+
+    @property
+    def status(self):
+        """ A shell style status: Running, Done, Exit N or Killed. """
+
+        if self.running:
+            return 'Running'
+        if self.returncode == 0:
+            return 'Done'
+        if self.returncode < 0:
+            return 'Killed'
+
+        return 'Exit %d' % self.returncode
+
+    def _read(self):
+        span = Span('command', os.path.basename(self.args[0]), {
+            'job': self.number
+        })
+
+        for data in iter(self.proc.stdout.readline, b''):
+            self.log.write(data)
+            self.log.flush()
+            line = data.decode('utf-8', 'replace')
+            with self.lock:
+                self.buffer.append(line)
+                if self.attached:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+
+        self.returncode = self.proc.wait()
+        self.ended = time.time()
+        self.log.close()
+
+        span.end = self.ended
+        span.args['status'] = self.returncode
+        tracer.record(span)
+        tracer.flush()
+
+    def attach(self):
+        """ Show the buffered output, then echo output as it arrives. """
+
+        with self.lock:
+            for line in self.buffer:
+                sys.stdout.write(line)
+            sys.stdout.flush()
+            self.attached = True
+
+    def detach(self):
+        """ Stop echoing output. """
+
+        with self.lock:
+            self.attached = False
+
+    def wait(self, timeout=None):
+        """ Wait for the output to be read; return whether it finished. """
+
+        self.thread.join(timeout)
+
+        return not self.thread.is_alive()
+
+    def kill(self, sig=signal.SIGTERM):
+        """ Send a signal to the sub-command and anything it started. """
+
+        if not self.running:
+            return
+
+        try:
+            if os.name == 'posix':
+                os.killpg(self.proc.pid, sig)
+            else:
+                self.proc.send_signal(sig)
+        except OSError:
+            pass
+
+
+class JobTable(object):
+    """ Background jobs of the shell, numbered from 1 like a Unix shell. """
+
+    def __init__(self, log_dir=None, lines=1000):
+        """ Initial setup. """
+
+        self.log_dir = log_dir or os.path.join(
+            os.path.expanduser('~'), '.ghe', 'jobs'
+        )
+        self.lines = lines
+        self.jobs = []
+
+    def start(self, name, args, env):
+        """ Start `args` as a background job and return it. """
+
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        number = max([job.number for job in self.jobs] or [0]) + 1
+        job = Job(number, name, args, env, self.log_dir, self.lines)
+        self.jobs.append(job)
+
+        return job
+
+    def get(self, number=None):
+        """ Return job `number`, or the latest one; None if there is none. """
+
+        if number is None:
+            return self.jobs[-1] if self.jobs else None
+
+        for job in self.jobs:
+            if job.number == number:
+                return job
+
+    def running(self):
+        """ Return the jobs that are still running. """
+
+        return [job for job in self.jobs if job.running]
+
+    def reap(self):
+        """ Return finished jobs not reported yet and forget them. """
+
+        done = [
+            job for job in self.jobs
+            if not job.running and not job.notified
+        ]
+        for job in done:
+            job.notified = True
+            self.jobs.remove(job)
+
+        return done
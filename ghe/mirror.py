@@ -0,0 +1,431 @@
+import base64
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from .planner import parse_size
+from .trace import tracer
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Only branches and tags are synced. GitHub also advertises read-only refs
+# such as refs/pull/*, which GitHub Enterprise refuses to accept on a push.
+REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+# Credentials are passed to git with GIT_CONFIG_COUNT, which older
+# releases silently ignore.
+GIT_MIN_VERSION = (2, 31)
+
+# The version of each git executable, once asked.
+_git_versions = {}
+
+
+class GitError(Exception):
+    """ A git command failed. """
+
+    def __init__(self, args, status, output):
+        """ Initial setup. """
+
+        lines = output.strip().splitlines()
+        Exception.__init__(self, 'git %s exited with %d: %s' % (
+            args[0], status, lines[-1] if lines else ''
+        ))
+        self.status = status
+        self.output = output
+
+
+def repo_url(base_url, full_name):
+    """ The HTTPS git URL of `owner/name` on the server of `base_url`.
+
+    `base_url` may be an API endpoint (https://api.github.com or
+    https://ghe.example.com/api/v3) or the web address of the server.
+    """
+
+    if '://' not in base_url:
+        base_url = 'https://%s' % base_url
+    scheme, rest = base_url.split('://', 1)
+    host = rest.split('/', 1)[0]
+    if host.startswith('api.'):
+        host = host[len('api.'):]
+
+    return '%s://%s/%s.git' % (scheme, host, full_name)
+
+def check_git(git='git'):
+    """ Raise RuntimeError unless `git` can take credentials from mirrors.
+
+    The version is asked once per process.
+    """
+
+    if git not in _git_versions:
+        try:
+            output = subprocess.check_output([git, '--version'])
+        except (OSError, subprocess.CalledProcessError):
+            raise RuntimeError('Syncing and comparing repos needs git %d.%d '
+                               'or later; %s was not found.' % (
+                                   GIT_MIN_VERSION + (git,)
+                               ))
+        match = re.search(r'(\d+)\.(\d+)', output.decode('utf-8', 'replace'))
+        _git_versions[git] = \
+            (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+    if _git_versions[git] < GIT_MIN_VERSION:
+        raise RuntimeError('Syncing and comparing repos needs git %d.%d or '
+                           'later; %s is %d.%d.' % (
+                               GIT_MIN_VERSION + (git,) + _git_versions[git]
+                           ))
+
+def credential(url, token):
+    """ A git config entry sending `token` to the server of `url`.
+
+    The token goes into an HTTP header scoped to that server, so it never
+    appears in a URL, the command line or the mirror's config.
+    """
+
+    scheme, rest = url.split('://', 1)
+    prefix = '%s://%s/' % (scheme, rest.split('/', 1)[0])
+    basic = base64.b64encode(
+        ('x-access-token:%s' % token).encode('utf-8')
+    ).decode('ascii')
+
+    return ('http.%s.extraheader' % prefix, 'Authorization: Basic %s' % basic)
+
+
+class MirrorCache(object):
+    """ Local bare mirrors used to sync and compare repositories.
+
+    Each repository is mirrored once under `root`; later syncs fetch only
+    new objects into the mirror and push only what the destination lacks,
+    instead of moving the full history through a migration archive.
+
+    The size and last use of every mirror are kept in `index.json`. When
+    the mirrors outgrow `quota` bytes, the least recently used ones are
+    removed; a mirror that another process is using is never removed.
+    """
+
+    def __init__(self, root=None, quota=None, git='git'):
+        """ Initial setup. """
+
+        self.root = root or os.path.join(
+            os.path.expanduser('~'), '.ghe', 'mirrors'
+        )
+        self.quota = quota
+        self.git = git
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """ Build a cache from the `ghe-mirror-dir` and `ghe-mirror-quota`
+        environment variables, e.g. to keep mirrors on a fast local disk.
+        """
+
+        quota = os.environ.get('ghe-mirror-quota')
+
+        return cls(
+            os.environ.get('ghe-mirror-dir') or None,
+            parse_size(quota) if quota else None
+        )
+
+    def path(self, url):
+        """ Location of the mirror of a git URL. """
+
+        rest = url.split('://', 1)[-1]
+        if not rest.endswith('.git'):
+            rest += '.git'
+
+        return os.path.join(self.root, *rest.split('/'))
+
+    def sync(self, source, dest, credentials=()):
+        """ Bring the branches and tags of `dest` in line with `source`.
+
+        Returns the number of refs that were created, updated or deleted
+        on `dest`. `credentials` are git config entries from credential().
+        """
+
+        path = self.path(source)
+        with self.locked(path):
+            self.fetch(source, path, credentials)
+            return self.push(path, dest, credentials)
+
+    def fetch(self, url, path=None, credentials=(), keep=()):
+        """ Create or update the mirror of `url`; return its path.
+
+        Making room for it never removes the mirrors at the paths in `keep`.
+        """
+
+        path = path or self.path(url)
+        created = not os.path.isdir(path)
+        if created:
+            self._git(['init', '--quiet', '--bare', path], credentials)
+            self._git(['remote', 'add', 'origin', url], credentials, path)
+            self._git(['config', '--unset-all', 'remote.origin.fetch'],
+                      credentials, path, check=False)
+            for refspec in REFSPECS:
+                self._git(['config', '--add', 'remote.origin.fetch', refspec],
+                          credentials, path)
+
+        try:
+            with tracer.span('git', 'fetch') as span:
+                self._git(['fetch', '--quiet', '--prune', 'origin'],
+                          credentials, path)
+                span.args['repo'] = url
+        except GitError:
+            # Don't leave an empty mirror behind for a repo never fetched.
+            if created:
+                shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        self.touch(path, size=True)
+        self.evict(keep=set(keep) | set([path]))
+
+        return path
+
+    def fetch_all(self, urls, credentials=(), workers=4):
+        """ Fetch many mirrors at once.
+
+        Returns a dict mapping each URL to its mirror path, or to the
+        GitError raised while fetching it. Fetching one never removes
+        another of `urls` to make room, so all of them can be read after.
+        """
+
+        keep = set(self.path(url) for url in urls)
+
+        def fetch(url):
+            try:
+                with self.locked(self.path(url)):
+                    return url, self.fetch(
+                        url, credentials=credentials, keep=keep
+                    )
+            except GitError as err:
+                return url, err
+
+        pool = ThreadPool(max(1, min(workers, len(urls))))
+        try:
+            return dict(pool.map(fetch, urls))
+        finally:
+            pool.terminate()
+
+    def refs(self, url):
+        """ Return the branches and tags of a mirror as {ref: sha}. """
+
+        path = self.path(url)
+        self.touch(path)
+
+        return parse_refs(self._git(
+            ['for-each-ref', '--format=%(objectname)\t%(refname)'],
+            cwd=path
+        ))
+
+    def remote_refs(self, url, credentials=()):
+        """ Return the branches and tags of a remote as {ref: sha}. """
+
+        with tracer.span('git', 'ls-remote') as span:
+            output = self._git(
+                ['ls-remote', '--refs', url, 'refs/heads/*', 'refs/tags/*'],
+                credentials
+            )
+            span.args['repo'] = url
+
+        return parse_refs(output)
+
+    def remote_state(self, url, credentials=()):
+        """ Return the default branch of a remote and its refs.
+
+        A single `ls-remote` returns (head, {ref: sha}), where `head` is the
+        ref HEAD points at, or None for an empty repository.
+        """
+
+        with tracer.span('git', 'ls-remote') as span:
+            output = self._git(
+                ['ls-remote', '--symref', url, 'HEAD', 'refs/heads/*',
+                 'refs/tags/*'],
+                credentials
+            )
+            span.args['repo'] = url
+
+        head = None
+        for line in output.splitlines():
+            if line.startswith('ref: ') and line.endswith('\tHEAD'):
+                head = line[len('ref: '):-len('\tHEAD')]
+
+        refs = parse_refs(output)
+        for ref in list(refs):
+            if ref == 'HEAD' or ref.endswith('^{}'):
+                del refs[ref]
+
+        return head, refs
+
+    def push(self, path, url, credentials=()):
+        """ Push the mirror's branches and tags, pruning stale ones. """
+
+        with tracer.span('git', 'push') as span:
+            output = self._git(
+                ['push', '--porcelain', '--prune', url] + REFSPECS,
+                credentials, path
+            )
+
+            # Porcelain lines start with a flag; '=' marks current refs.
+            changed = [
+                line for line in output.splitlines()
+                if line[:1] in (' ', '+', '-', '*') and '\t' in line
+            ]
+            span.args['repo'] = url
+            span.args['refs'] = len(changed)
+
+        return len(changed)
+
+    @contextmanager
+    def locked(self, path, blocking=True):
+        """ Hold a lock on a mirror, shared with other ghe processes.
+
+        With `blocking` False, yields False instead of waiting when the
+        mirror is already locked.
+        """
+
+        parent = os.path.dirname(path)
+        with self.lock:
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+        with open(path + '.lock', 'a') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | (
+                        0 if blocking else fcntl.LOCK_NB
+                    ))
+                except (IOError, OSError):
+                    yield False
+                    return
+            yield True
+
+    @contextmanager
+    def index(self):
+        """ Lock the mirror index and yield it; changes are written back. """
+
+        with self.locked(os.path.join(self.root, 'index')):
+            path = os.path.join(self.root, 'index.json')
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (IOError, OSError, ValueError):
+                index = {}
+
+            yield index
+
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.rename(tmp, path)
+
+    def touch(self, path, size=False):
+        """ Mark a mirror as used now, measuring it again if `size`. """
+
+        key = os.path.relpath(path, self.root)
+        with self.index() as index:
+            entry = index.setdefault(key, {'size': 0})
+            entry['used'] = time.time()
+            if size or not entry['size']:
+                entry['size'] = disk_usage(path)
+
+    def evict(self, keep=()):
+        """ Remove least recently used mirrors until under the quota.
+
+        The mirrors at the paths in `keep` are left in place.
+        """
+
+        if not self.quota:
+            return []
+
+        removed = []
+        with self.index() as index:
+            total = sum(entry['size'] for entry in index.values())
+            lru = sorted(index.items(), key=lambda item: item[1]['used'])
+            for key, entry in lru:
+                if total <= self.quota:
+                    break
+                path = os.path.join(self.root, key)
+                if path in keep:
+                    continue
+                with self.locked(path, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    shutil.rmtree(path, ignore_errors=True)
+                del index[key]
+                total -= entry['size']
+                removed.append(path)
+
+        return removed
+
+    def _git(self, args, credentials=(), cwd=None, check=True):
+        if credentials:
+            check_git(self.git)
+
+        env = os.environ.copy()
+        env['GIT_TERMINAL_PROMPT'] = '0'
+        env['GIT_CONFIG_COUNT'] = str(len(credentials))
+        for i, (key, value) in enumerate(credentials):
+            env['GIT_CONFIG_KEY_%d' % i] = key
+            env['GIT_CONFIG_VALUE_%d' % i] = value
+
+        proc = subprocess.Popen(
+            [self.git] + args,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+
+        if check and proc.returncode:
+            raise GitError(args, proc.returncode, output)
+
+        return output
+
+
+def parse_refs(output):
+    """ Parse `sha<TAB>ref` lines into {ref: sha}. """
+
+    refs = {}
+    for line in output.splitlines():
+        if '\t' in line:
+            sha, ref = line.split('\t', 1)
+            refs[ref] = sha
+
+    return refs
+
+def diff_refs(source, dest):
+    """ Compare two {ref: sha} maps.
+
+    Returns (missing, extra, changed): refs only in `source`, refs only in
+    `dest`, and refs whose commits differ.
+    """
+
+    missing = sorted(set(source) - set(dest))
+    extra = sorted(set(dest) - set(source))
+    changed = sorted(
+        ref for ref in set(source) & set(dest) if source[ref] != dest[ref]
+    )
+
+    return missing, extra, changed
+
+def disk_usage(path):
+    """ Total size in bytes of the files under `path`. """
+
+    total = 0
+    for parent, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(parent, name))
+            except OSError:
+                pass
+
+    return total
@@ -0,0 +1,65 @@
+def plan_batches(repos, budget=None, limit=None):
+    """ Group RepoInfo records into migration batches.
+
+    Repositories are packed first-fit, largest first, into batches whose
+    total size stays under `budget` bytes and whose length stays under
+    `limit` repos. A repository larger than the budget gets a batch of its
+    own. Batches holding the largest repositories come first; among equally
+    sized repositories, the ones pushed to least recently go first.
+
+    Without a budget, repositories are sliced into batches of `limit` in
+    their original order.
+
+    Archived repositories are read-only, so they are batched apart from the
+    others and migrated after them.
+    """
+
+    repos = list(repos)
+    limit = limit or len(repos) or 1
+
+    active = [repo for repo in repos if not repo.archived]
+    archived = [repo for repo in repos if repo.archived]
+
+    return _pack(active, budget, limit) + _pack(archived, budget, limit)
+
+def _pack(repos, budget, limit):
+    if not budget:
+        return [repos[i:i + limit] for i in range(0, len(repos), limit)]
+
+    repos.sort(key=lambda r: r.pushed_at or '')
+    repos.sort(key=lambda r: r.bytes, reverse=True)
+
+    batches = []
+    totals = []
+    for repo in repos:
+        for i, batch in enumerate(batches):
+            if len(batch) < limit and totals[i] + repo.bytes <= budget:
+                batch.append(repo)
+                totals[i] += repo.bytes
+                break
+        else:
+            batches.append([repo])
+            totals.append(repo.bytes)
+
+    return batches
+
+def parse_size(s):
+    """ Parse a size such as `500M` or `10G` into bytes. """
+
+    s = s.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+
+    return int(s)
+
+def format_size(n):
+    """ Format a byte count for display. """
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+
+    return '%.1fTB' % n
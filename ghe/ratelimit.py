@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from requests.adapters import HTTPAdapter
+
+from .trace import tracer
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Request priorities; lower numbers are served first when the budget is low.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# Fraction of the hourly budget that requests of each priority leave for
+# higher priorities.
+RESERVE = {HIGH: 0.0, NORMAL: 0.05, LOW: 0.2}
+
+# Waiters that have not checked in for this long are assumed to be gone.
+WAITER_TIMEOUT = 30
+
+# Adapters kept between commands by `ghe serve`; None when every session
+# gets its own.
+_adapters = None
+_adapters_lock = threading.Lock()
+
+
+class Governor(object):
+    """ A token bucket for one API token, shared by every ghe process.
+
+    The bucket mirrors the `X-RateLimit-*` headers of the latest responses
+    and is kept in `~/.ghe/ratelimit/<token hash>.json`, guarded by a lock
+    file, so concurrent commands using the same token draw from one budget.
+    Each request takes a token before it is sent. Once the budget runs down
+    to the reserve of its priority, a request queues until the limit resets;
+    while a higher priority request is queued, lower priorities hold off.
+    """
+
+    def __init__(self, token, path=None, poll=1.0):
+        """ Initial setup. """
+
+        digest = hashlib.sha1((token or '').encode('utf-8')).hexdigest()
+        self.path = path or os.path.join(
+            os.path.expanduser('~'), '.ghe', 'ratelimit', digest[:16] + '.json'
+        )
+        self.poll = poll
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def state(self):
+        """ Lock the shared state and yield it; changes are written back. """
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        with self.lock, open(self.path + '.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                state = {}
+
+            yield state
+
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.path)
+
+    def acquire(self, priority=NORMAL):
+        """ Block until a request of `priority` may be sent, then take it. """
+
+        waiter = '%d:%d' % (os.getpid(), threading.current_thread().ident)
+        waited = 0
+
+        while True:
+            delay = self.take(priority, waiter)
+            if delay <= 0:
+                break
+            waited += delay
+            time.sleep(delay)
+
+        if waited:
+            tracer.count('ghe_api_throttled_seconds_total', waited,
+                         priority=str(priority))
+
+    def take(self, priority, waiter):
+        """ Take a token if a request of `priority` may be sent now.
+
+        Returns 0 once the token is taken. Otherwise `waiter` is queued and
+        the number of seconds to sleep before asking again is returned.
+        """
+
+        with self.state() as state:
+            now = time.time()
+            delay = self._delay(state, priority, waiter, now)
+            waiters = state.setdefault('waiting', {})
+            if delay <= 0:
+                waiters.pop(waiter, None)
+                if state.get('remaining') is not None:
+                    state['remaining'] -= 1
+                return 0
+            waiters[waiter] = [priority, now]
+
+        return min(delay, self.poll)
+
+    def cancel(self, waiter):
+        """ Stop queueing `waiter`, e.g. once it was served elsewhere. """
+
+        with self.state() as state:
+            state.get('waiting', {}).pop(waiter, None)
+
+    def headroom(self, now=None):
+        """ Requests left in the budget as last seen, without locking.
+
+        Returns None while the budget is unknown, and 0 while requests are
+        blocked.
+        """
+
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        now = now or time.time()
+        if (state.get('blocked_until') or 0) > now:
+            return 0
+        if state.get('reset') and now >= state['reset']:
+            return state.get('limit')
+
+        return state.get('remaining')
+
+    def _delay(self, state, priority, waiter, now):
+        """ Seconds to wait before a request of `priority` may be sent. """
+
+        if state.get('reset') and now >= state['reset']:
+            state['remaining'] = state.get('limit')
+            state['reset'] = None
+
+        blocked = state.get('blocked_until') or 0
+        if blocked > now:
+            return blocked - now
+
+        waiters = state.get('waiting', {})
+        for key, (other, seen) in list(waiters.items()):
+            if now - seen > WAITER_TIMEOUT:
+                del waiters[key]
+
+        remaining = state.get('remaining')
+        if remaining is None:
+            return 0
+
+        reserve = RESERVE[priority] * (state.get('limit') or 0)
+        ahead = any(
+            other < priority for key, (other, seen) in waiters.items()
+            if key != waiter
+        )
+        if remaining > reserve and not ahead:
+            return 0
+
+        return max((state.get('reset') or now) - now, self.poll)
+
+    def update(self, response):
+        """ Fold the rate limit headers of a response into the bucket.
+
+        Returns True when the response was rejected by a rate limit and the
+        request should be retried.
+        """
+
+        headers = response.headers
+        limited = response.status_code in (403, 429) and (
+            headers.get('X-RateLimit-Remaining') == '0' or
+            'Retry-After' in headers
+        )
+
+        if 'X-RateLimit-Remaining' not in headers and not limited:
+            return False
+
+        with self.state() as state:
+            if 'X-RateLimit-Remaining' in headers:
+                remaining = int(headers['X-RateLimit-Remaining'])
+                reset = int(headers.get('X-RateLimit-Reset') or 0)
+                if reset == state.get('reset') and \
+                        state.get('remaining') is not None:
+                    remaining = min(state['remaining'], remaining)
+                state['remaining'] = remaining
+                state['reset'] = reset or None
+                state['limit'] = int(headers.get('X-RateLimit-Limit') or 0)
+
+            # Secondary limits name their own wait; otherwise wait for the
+            # reset, plus a second as the header is rounded down.
+            if 'Retry-After' in headers:
+                state['blocked_until'] = (
+                    time.time() + int(headers['Retry-After'])
+                )
+            elif limited:
+                state['blocked_until'] = max(
+                    state.get('reset') or 0, time.time()
+                ) + 1
+
+        return limited
+
+
+class GovernedAdapter(HTTPAdapter):
+    """ Transport adapter that sends every request through a Governor.
+
+    Requests rejected by a rate limit are retried, up to `retries` times,
+    once the governor allows it. Requests without an `Authorization`
+    header, such as redirects to archive storage, bypass the governor.
+    """
+
+    def __init__(self, governor, priority=NORMAL, retries=5, **kwargs):
+        """ Initial setup. """
+
+        self.governor = governor
+        self.priority = priority
+        self.retries = retries
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        # Unauthenticated requests don't count against the token's limit.
+        if 'Authorization' not in request.headers:
+            return HTTPAdapter.send(self, request, **kwargs)
+
+        for attempt in range(self.retries + 1):
+            self.governor.acquire(self.priority)
+            response = HTTPAdapter.send(self, request, **kwargs)
+            if not self.governor.update(response) or attempt == self.retries:
+                break
+            response.close()
+
+        return response
+
+
+def share_adapters():
+    """ Keep adapters, and their pooled connections, for later sessions. """
+
+    global _adapters
+
+    if _adapters is None:
+        _adapters = {}
+
+def govern(session, token, priority=NORMAL, **kwargs):
+    """ Route the requests of a session through the governor of `token`.
+
+    `token` may also be a CredentialPool, whose adapter sends each request
+    with the credential that has the most budget left. With adapters
+    shared, sessions for the same token and priority reuse one adapter, so
+    its keep-alive connections outlive each command.
+    """
+
+    key = (getattr(token, 'key', token), priority,
+           tuple(sorted(kwargs.items())))
+    with _adapters_lock:
+        adapter = _adapters.get(key) if _adapters is not None else None
+        if adapter is None:
+            if hasattr(token, 'adapter'):
+                adapter = token.adapter(priority, **kwargs)
+            else:
+                adapter = GovernedAdapter(Governor(token), priority, **kwargs)
+            if _adapters is not None:
+                _adapters[key] = adapter
+
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
@@ -0,0 +1,285 @@
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from . import server
+from .trace import tracer
+from .users import UserIndex, user_arg
+
+Step = namedtuple('Step', ['line', 'cmd', 'args'])
+
+# Script lines handled by the runner itself. They change shared state, so
+# the commands on either side of them never run at the same time.
+BUILTINS = ('set', 'get', 'unset', 'wait')
+
+
+def parse(lines):
+    """ Yield a Step for each command in a script, skipping comments. """
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        cmd, _, args = line.partition(' ')
+        yield Step(number, cmd, args.strip())
+
+def groups(steps):
+    """ Split steps into builtins and runs of consecutive sub-commands. """
+
+    group = []
+    for step in steps:
+        if step.cmd in BUILTINS:
+            if group:
+                yield group
+                group = []
+            yield [step]
+        else:
+            group.append(step)
+
+    if group:
+        yield group
+
+def argument_parser():
+    """ Arguments of `ghe run`, shared by the command line and the shell. """
+
+    parser = argparse.ArgumentParser(
+        prog='run',
+        description='Run a file of ghe commands.'
+    )
+    parser.add_argument('script',
+        help='file with one ghe command per line'
+    )
+    parser.add_argument('-parallel',
+        help=(
+            'number of commands to run at the same time; set, get, unset and '
+            'wait lines are run on their own (default: 1)'
+        ),
+        metavar='INT',
+        type=int,
+        default=1
+    )
+    parser.add_argument('-keep-going',
+        help='carry on after a command fails',
+        action='store_true'
+    )
+
+    return parser
+
+
+class Output(object):
+    """ Captured output of a command run inside the runner. """
+
+    encoding = 'utf-8'
+
+    def __init__(self):
+        """ Initial setup. """
+
+        self.parts = []
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        self.parts.append(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class ScriptRunner(object):
+    """ Runs a script of shell commands for a GHE shell.
+
+    The keyring is read once for the whole script; `set` and `unset` lines
+    update both the keyring and the environment passed to later commands.
+    With `parallel` above 1, consecutive sub-commands run concurrently and
+    the output of each is printed, in script order, once it finishes.
+
+    The commands that `ghe serve` runs inline also run inside the runner,
+    one at a time, sharing one set of SSH connections, API connections
+    and stafftools logins across the script; other commands, and inline
+    ones while another is running, run as processes.
+    """
+
+    def __init__(self, shell, parallel=1, keep_going=False):
+        """ Initial setup. """
+
+        self.shell = shell
+        self.parallel = max(1, parallel)
+        self.keep_going = keep_going
+        self.env = None
+        self.inline = server.InlineRunner()
+
+    def run(self, path):
+        """ Run the script at `path`; return the steps that failed. """
+
+        with open(path) as f:
+            steps = list(parse(f))
+
+        unknown = [
+            step for step in steps
+            if step.cmd not in BUILTINS and step.cmd not in self.shell.commands
+        ]
+        for step in unknown:
+            print('%s:%d: %s: command not found' % (path, step.line, step.cmd))
+        if unknown:
+            return unknown
+
+        self.env = self.shell._command_env()
+        server.share_sessions()
+
+        missing = self.missing_users(steps)
+        for step, login in missing:
+            print('%s:%d: %s: no such user %s' % (
+                path, step.line, step.cmd, login
+            ))
+        if missing:
+            return [step for step, login in missing]
+
+        failed = []
+        for group in groups(steps):
+            if group[0].cmd in BUILTINS:
+                self.builtin(group[0])
+                continue
+
+            failed.extend(
+                step for step, status in self.run_group(group) if status
+            )
+            if failed and not self.keep_going:
+                break
+
+        for step in failed:
+            print('%s:%d: %s %s failed' % (
+                path, step.line, step.cmd, step.args
+            ))
+
+        return failed
+
+    def missing_users(self, steps):
+        """ Return (step, login) for logins the user index does not have.
+
+        Logins are only ruled out while the index is fresh; otherwise every
+        step is left for the command itself to check.
+        """
+
+        index = UserIndex(self.env.get('ghe-host'))
+        if not index.fresh():
+            return []
+
+        missing = []
+        try:
+            for step in steps:
+                login = user_arg(step.cmd, shlex.split(step.args))
+                if login is not None and not index.exists(login):
+                    missing.append((step, login))
+        finally:
+            index.close()
+
+        return missing
+
+    def builtin(self, step):
+        """ Run a set, get, unset or wait line. """
+
+        if step.cmd == 'wait':
+            return
+
+        self.shell.onecmd('%s %s' % (step.cmd, step.args))
+
+        key, _, val = step.args.partition(' ')
+        if step.cmd == 'set' and key and val:
+            self.env[key] = val
+        elif step.cmd == 'unset':
+            self.env.pop(key, None)
+
+    def run_group(self, group):
+        """ Run sub-commands; yield (step, exit status) in script order.
+
+        Commands run one at a time stop at the first failure unless
+        `keep_going` is set; concurrent ones always run to completion.
+        """
+
+        if self.parallel == 1 or len(group) == 1:
+            for step in group:
+                status = self.call(step)
+                yield step, status
+                if status and not self.keep_going:
+                    return
+            return
+
+        pool = ThreadPool(min(self.parallel, len(group)))
+        try:
+            for step, status, output in pool.imap(self.capture, group):
+                print('--- %d: %s %s' % (step.line, step.cmd, step.args))
+                sys.stdout.write(output.decode('utf-8', 'replace'))
+                sys.stdout.flush()
+                yield step, status
+        finally:
+            pool.terminate()
+
+    def call(self, step):
+        """ Run a sub-command attached to the terminal. """
+
+        with tracer.span('command', step.cmd, line=step.line) as span:
+            status = None
+            if self.runs_inline(step):
+                status = self.inline.run(
+                    self.shell.commands[step.cmd], shlex.split(step.args),
+                    self.env, sys.stdin, sys.stdout
+                )
+            if status is None:
+                status = subprocess.call(self.command(step), env=self.env)
+            span.args['status'] = status
+
+        return status
+
+    def capture(self, step):
+        """ Run a sub-command with its output captured. """
+
+        with tracer.span('command', step.cmd, line=step.line) as span:
+            status = None
+            if self.runs_inline(step):
+                output = Output()
+                with open(os.devnull) as devnull:
+                    status = self.inline.run(
+                        self.shell.commands[step.cmd], shlex.split(step.args),
+                        self.env, devnull, output, blocking=False
+                    )
+                output = output.getvalue().encode('utf-8')
+            if status is None:
+                with open(os.devnull) as devnull:
+                    proc = subprocess.Popen(
+                        self.command(step),
+                        env=self.env,
+                        stdin=devnull,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT
+                    )
+                output = proc.communicate()[0]
+                status = proc.returncode
+            span.args['status'] = status
+
+        return step, status, output
+
+    def runs_inline(self, step):
+        """ Whether a step can run inside the runner. """
+
+        return step.cmd in server.INLINE and \
+            self.shell.commands[step.cmd].endswith('.py')
+
+    def command(self, step):
+        """ The argument list of a sub-command step. """
+
+        return [self.shell.commands[step.cmd]] + shlex.split(step.args)
@@ -0,0 +1,420 @@
+import argparse
+import codecs
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+from .jobs import needs_terminal
+from .trace import tracer
+
+# Commands run inside the daemon, reusing its connections and logins. Other
+# commands, such as long migrations, run as processes of the daemon.
+INLINE = ('announce', 'maintenance', 'delete-user', 'reset-user-email')
+
+# Command names the CLI handles itself rather than passing to the daemon.
+LOCAL = ('serve', 'run', 'help')
+
+# The socket path, once looked up.
+_socket_path = None
+
+# Inline commands swap sys.argv, the standard streams and os.environ of the
+# whole process, so only one of them runs at a time.
+_inline_lock = threading.Lock()
+
+
+def socket_path():
+    """ Where the daemon listens: `ghe-socket`, or ~/.ghe/ghe.sock.
+
+    The key is taken from the environment, or else from the keyring; the
+    path is looked up once per process.
+    """
+
+    global _socket_path
+
+    if _socket_path is None:
+        # ghe.ghe imports this module, so get_key is imported when used.
+        from .ghe import get_key
+
+        _socket_path = os.environ.get('ghe-socket') or \
+            get_key('ghe-socket') or \
+            os.path.join(os.path.expanduser('~'), '.ghe', 'ghe.sock')
+
+    return _socket_path
+
+def argument_parser():
+    """ Arguments of `ghe serve`. """
+
+    parser = argparse.ArgumentParser(
+        prog='serve',
+        description=(
+            'Keep the keyring values, connections and logins of ghe '
+            'commands warm, and run commands for `ghe` and the GHE shell '
+            'over a Unix domain socket.'
+        )
+    )
+    parser.add_argument('-socket',
+        help=(
+            'the socket to listen on (default: value from `ghe-socket` '
+            'environment variable or key, or ~/.ghe/ghe.sock)'
+        ),
+        metavar='PATH'
+    )
+
+    return parser
+
+def share_sessions():
+    """ Keep SSH connections, API adapters and web logins for reuse. """
+
+    from . import ratelimit, ssh
+    ssh.share_connections()
+    ratelimit.share_adapters()
+    try:
+        from . import stafftools
+        stafftools.share_sessions()
+    except ImportError:
+        pass
+
+def connect(path=None):
+    """ Connect to a running daemon; return None if there is none. """
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except (IOError, OSError):
+        sock.close()
+        return None
+
+    return sock
+
+def call(cmd, args, path=None):
+    """ Run a command in the daemon, relaying its input and output.
+
+    Returns the exit status, or None when no daemon is running or the
+    command needs the client's terminal and should be run locally.
+    """
+
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    channel = Channel(sock)
+    try:
+        channel.send(op='run', cmd=cmd, args=list(args))
+        for message in channel:
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'read' in message:
+                line = sys.stdin.readline()
+                channel.send(line=line)
+            elif 'local' in message:
+                return None
+            elif 'status' in message:
+                return message['status']
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        sock.close()
+
+    return 1
+
+def reload(path=None):
+    """ Ask a running daemon to read the keyring again. """
+
+    sock = connect(path)
+    if sock is not None:
+        try:
+            Channel(sock).send(op='reload')
+        finally:
+            sock.close()
+
+
+class Channel(object):
+    """ JSON messages, one per line, over a socket. """
+
+    def __init__(self, sock):
+        """ Initial setup. """
+
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        """ Send a message. """
+
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        """ Return the next message, or None once the peer hangs up. """
+
+        line = self.reader.readline()
+        if not line:
+            return None
+
+        return json.loads(line.decode('utf-8'))
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+
+class ChannelWriter(object):
+    """ File-like stdout and stderr of a command run for a client. """
+
+    encoding = 'utf-8'
+
+    def __init__(self, channel):
+        """ Initial setup. """
+
+        self.channel = channel
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if data:
+            self.channel.send(out=data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ChannelReader(object):
+    """ File-like stdin of a command, read from the client's terminal. """
+
+    def __init__(self, channel):
+        """ Initial setup. """
+
+        self.channel = channel
+
+    def readline(self, *args):
+        self.channel.send(read=True)
+        message = self.channel.receive()
+
+        return (message or {}).get('line', '')
+
+    def read(self, *args):
+        return self.readline()
+
+    def isatty(self):
+        return False
+
+
+class InlineRunner(object):
+    """ Runs Python command scripts inside this process.
+
+    Each script is compiled once and run with its own argv, environment and
+    standard streams, so the SSH connections, API adapters and web logins
+    shared by this process are reused from one command to the next.
+    """
+
+    def __init__(self):
+        """ Initial setup. """
+
+        self.code = {}
+
+    def compile(self, path):
+        """ The code of a command script, compiled again when it changes. """
+
+        mtime = os.path.getmtime(path)
+        if self.code.get(path, (None,))[0] != mtime:
+            with open(path) as f:
+                self.code[path] = (mtime, compile(f.read(), path, 'exec'))
+
+        return self.code[path][1]
+
+    def run(self, path, args, env, stdin, stdout, blocking=True):
+        """ Run a command script; return its exit status.
+
+        Returns None without running it when another inline command is
+        running and `blocking` is False.
+        """
+
+        if not _inline_lock.acquire(blocking):
+            return None
+
+        try:
+            code = self.compile(path)
+            saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr,
+                     dict(os.environ))
+
+            sys.argv = [path] + list(args)
+            sys.stdin = stdin
+            sys.stdout = sys.stderr = stdout
+            os.environ.clear()
+            os.environ.update(env)
+            try:
+                exec(code, {'__name__': '__main__', '__file__': path})
+                status = 0
+            except SystemExit as err:
+                status = err.code
+                if status is not None and not isinstance(status, int):
+                    stdout.write('%s\n' % status)
+                    status = 1
+            except Exception:
+                stdout.write(traceback.format_exc())
+                status = 1
+            finally:
+                sys.argv, sys.stdin, sys.stdout, sys.stderr = saved[:4]
+                os.environ.clear()
+                os.environ.update(saved[4])
+        finally:
+            _inline_lock.release()
+
+        return status or 0
+
+
+class Server(object):
+    """ Runs ghe commands for thin clients over a Unix domain socket.
+
+    The keyring is read once, and the commands in INLINE run inside the
+    daemon, so their imports, SSH connections, API connections and web
+    logins stay warm from one command to the next. Only one inline command
+    runs at a time; a command arriving meanwhile, and every other command,
+    runs as a process of the daemon instead, unless it would prompt for
+    input: the client runs those itself, on its own terminal.
+    """
+
+    def __init__(self, shell, path=None):
+        """ Initial setup. """
+
+        self.shell = shell
+        self.path = path or socket_path()
+        self.env = None
+        self.inline = InlineRunner()
+        self.sock = None
+
+    def serve_forever(self):
+        """ Listen on the socket and serve clients until interrupted. """
+
+        if connect(self.path) is not None:
+            raise RuntimeError('A daemon is already listening on %s' %
+                               self.path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        share_sessions()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(64)
+
+        print('Serving %s commands on %s' % (len(self.shell.commands),
+                                             self.path))
+        try:
+            while True:
+                conn, _ = self.sock.accept()
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.sock.close()
+            os.remove(self.path)
+
+    def handle(self, conn):
+        """ Serve the requests of one client connection. """
+
+        channel = Channel(conn)
+        try:
+            for message in channel:
+                op = message.get('op')
+                if op == 'run':
+                    status = self.run(message.get('cmd'),
+                                      message.get('args') or [], channel)
+                    if status is None:
+                        channel.send(local=True)
+                    else:
+                        channel.send(status=status)
+                elif op == 'reload':
+                    self.env = None
+                elif op == 'ping':
+                    channel.send(status=0, pid=os.getpid())
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def command_env(self):
+        """ Environment for commands, read from the keyring once. """
+
+        # Not while an inline command has os.environ swapped out.
+        if self.env is None:
+            with _inline_lock:
+                self.env = self.shell._command_env()
+
+        return self.env
+
+    def run(self, name, args, channel):
+        """ Run a command for a client; return its exit status.
+
+        Returns None for a command that would prompt for input outside the
+        daemon: processes of the daemon have no terminal, so the client
+        runs those itself.
+        """
+
+        path = self.shell.commands.get(name)
+        if path is None:
+            channel.send(out='%s: command not found\n' % name)
+            return 127
+
+        with tracer.span('command', name) as span:
+            status = None
+            if name in INLINE and path.endswith('.py'):
+                status = self.inline.run(
+                    path, args, self.command_env(), ChannelReader(channel),
+                    ChannelWriter(channel), blocking=False
+                )
+            if status is None and not needs_terminal(name, args):
+                status = self.run_process(path, args, channel)
+            span.args['status'] = status
+        tracer.flush()
+
+        return status
+
+    def run_process(self, path, args, channel):
+        """ Run a command as a process, relaying its output. """
+
+        with open(os.devnull) as devnull:
+            proc = subprocess.Popen(
+                [path] + args,
+                env=dict(self.command_env(), PYTHONUNBUFFERED='1'),
+                stdin=devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        try:
+            for data in iter(proc.stdout.readline, b''):
+                channel.send(out=decoder.decode(data))
+        except (IOError, OSError):
+            # The client went away; don't leave the command running.
+            proc.kill()
+
+        return proc.wait()
@@ -0,0 +1,203 @@
+import codecs
+import re
+import threading
+import time
+import uuid
+
+from collections import namedtuple
+
+import paramiko
+
+from .trace import tracer
+
+NEWLINE = re.compile(r'\r\n|\r|\n')
+
+BatchResult = namedtuple('BatchResult', ['cmd', 'status', 'output'])
+
+# Connections kept open between commands by `ghe serve`; None when every
+# command opens its own.
+_clients = None
+_lock = threading.Lock()
+
+
+def share_connections():
+    """ Keep SSH connections open for reuse by later commands. """
+
+    global _clients
+
+    if _clients is None:
+        _clients = {}
+
+def connect(host, port=122, user='admin'):
+    """ Open an SSH connection to the GHE server.
+
+    With connections shared, an open connection to the same server and user
+    is returned instead.
+    """
+
+    key = (host, int(port or 122), user)
+    with _lock:
+        if _clients is not None:
+            client = _clients.get(key)
+            transport = client and client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, username=user, port=port, look_for_keys=False)
+
+        if _clients is not None:
+            _clients[key] = client
+
+    return client
+
+def label(cmd):
+    """ Name a command for tracing without exposing its arguments. """
+
+    words = []
+    for word in cmd.split():
+        if word.startswith('-') or '/' in word or '.' in word or '=' in word:
+            break
+        words.append(word)
+        if len(words) == 2:
+            break
+
+    return ' '.join(words) or cmd.split(' ', 1)[0]
+
+def stream(client, cmd, bufsize=32768, name=None):
+    """ Run a command and yield its output line by line as it arrives.
+
+    Carriage returns are treated as line breaks so progress meters that
+    redraw a single line are seen as they update.
+    """
+
+    with tracer.span('ssh', name or label(cmd)) as span:
+        for line in _stream(client, cmd, bufsize, span):
+            yield line
+
+def _stream(client, cmd, bufsize, span):
+    stdin, stdout, stderr = client.exec_command(cmd)
+    channel = stdout.channel
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    try:
+        pending = ''
+        while True:
+            data = channel.recv(bufsize)
+            span.add('bytes', len(data))
+            pending += decoder.decode(data, final=not data)
+
+            # Hold back a trailing \r in case its \n is in the next chunk.
+            tail = '\r' if data and pending.endswith('\r') else ''
+            lines = NEWLINE.split(pending[:-1] if tail else pending)
+            pending = lines.pop() + tail
+            for line in lines:
+                yield line + '\n'
+
+            if not data:
+                break
+
+        if pending:
+            yield pending
+    finally:
+        channel.close()
+
+def poll(client, cmd, interval):
+    """ Re-run a command every `interval` seconds on a single channel.
+
+    The loop runs on the GHE server so only one channel is opened for the
+    lifetime of the poll. Each yielded value is the list of output lines of
+    one run of `cmd`.
+    """
+
+    marker = '__ghe_poll_%s__' % uuid.uuid4().hex
+    script = 'while true; do %s 2>&1; echo "%s"; sleep %d; done' % (
+        cmd, marker, max(1, int(interval))
+    )
+
+    lines = []
+    for line in stream(client, script, name='poll %s' % label(cmd)):
+        if line.rstrip() == marker:
+            yield lines
+            lines = []
+        else:
+            lines.append(line)
+
+def watch(client, cmd, interval, parse, on_change, on_poll=None):
+    """ Poll a status command and call `on_change` whenever it changes.
+
+    `on_poll`, if given, is called with the value and time of every poll,
+    changed or not, e.g. to record when the status was last read.
+    """
+
+    last = None
+    first = True
+    for lines in poll(client, cmd, interval):
+        value = parse(lines)
+        now = time.time()
+        if on_poll:
+            on_poll(value, now)
+        if first or value != last:
+            on_change(value, last, now)
+        first = False
+        last = value
+
+def iter_batch(client, cmds, stop=False, name=None):
+    """ Run several commands as one script on a single channel.
+
+    Each command runs in its own subshell, followed by a marker line that
+    carries its index and exit status, so the output is split back apart
+    here. Yields (index, line, None) for each output line and
+    (index, None, status) once a command has finished. With `stop`, the
+    script exits at the first command that fails.
+    """
+
+    marker = '__ghe_batch_%s__' % uuid.uuid4().hex
+    script = '; '.join(
+        '(%s) </dev/null; s=$?; printf "%s %d %%d\\n" $s%s' % (
+            cmd, marker, index, '; [ $s -eq 0 ] || exit $s' if stop else ''
+        )
+        for index, cmd in enumerate(cmds)
+    )
+
+    index = 0
+    for line in stream(client, script, name=name or 'batch %s' % ', '.join(
+            label(cmd) for cmd in cmds)):
+        pos = line.find(marker)
+        if pos < 0:
+            yield index, line, None
+            continue
+
+        # Output without a final newline runs into the marker.
+        if pos:
+            yield index, line[:pos], None
+        done, status = line[pos + len(marker):].split()
+        yield int(done), None, int(status)
+        index = int(done) + 1
+
+def run_batch(client, cmds, stop=False, name=None):
+    """ Run several commands in one round trip; see iter_batch().
+
+    Returns a BatchResult for each command, in order. Commands skipped
+    after a failure with `stop` have a status of None.
+    """
+
+    return gather(cmds, iter_batch(client, cmds, stop, name))
+
+def gather(cmds, events):
+    """ Collect the events of iter_batch() into a BatchResult per command. """
+
+    output = [[] for cmd in cmds]
+    status = [None for cmd in cmds]
+    for index, line, code in events:
+        if line is None:
+            status[index] = code
+        else:
+            output[index].append(line)
+
+    return [
+        BatchResult(cmd, code, lines)
+        for cmd, code, lines in zip(cmds, status, output)
+    ]
@@ -0,0 +1,89 @@
+import threading
+
+import pyotp
+
+from seleniumrequests import PhantomJS
+
+# Logged in drivers kept between commands by `ghe serve`; None when every
+# command logs in afresh.
+_drivers = None
+_lock = threading.Lock()
+
+
+class LoginError(Exception):
+    """ Signing in to the GHE web interface failed. """
+
+
+def share_sessions():
+    """ Keep logged in drivers for reuse by later commands. """
+
+    global _drivers
+
+    if _drivers is None:
+        _drivers = {}
+
+def login(host, user, password, totp=None):
+    """ Return a PhantomJS driver signed in to GHE as an admin user.
+
+    With sessions shared, a driver that is still signed in is reused
+    instead of logging in again.
+    """
+
+    key = (host, user)
+    with _lock:
+        if _drivers is not None and key in _drivers:
+            driver = _drivers[key]
+            try:
+                driver.get('https://%s/stafftools' % host)
+                if '/login' not in driver.current_url and \
+                        '/sessions' not in driver.current_url:
+                    return driver
+            except Exception:
+                pass
+            _drivers.pop(key)
+            _quit(driver)
+
+        driver = _login(host, user, password, totp)
+        if _drivers is not None:
+            _drivers[key] = driver
+
+    return driver
+
+def _login(host, user, password, totp):
+    driver = PhantomJS()
+    driver.implicitly_wait(10)
+    driver.set_window_size(1400, 850)
+
+    # Login as the admin user
+    driver.get('https://%s/login' % host)
+    driver.find_element_by_name('login').send_keys(user)
+    driver.find_element_by_name('password').send_keys(password)
+    driver.find_element_by_name('commit').click()
+
+    # Check for two-factor auth code request
+    if driver.current_url == 'https://%s/sessions/two-factor' % host:
+        if not totp:
+            _quit(driver)
+            raise LoginError('Two-Factor authentication required.')
+
+        base = '.auth-form-body input'
+        u = driver.find_element_by_css_selector('%s[name=utf8]' % base)
+        t = driver.find_element_by_css_selector(
+            '%s[name=authenticity_token]' % base
+        )
+
+        driver.request('POST', 'https://%s/sessions/two-factor' % host,
+            data={
+                'utf8': u.get_attribute('value'),
+                'otp': pyotp.TOTP(totp).now(),
+                'authenticity_token': t.get_attribute('value')
+            }
+        )
+
+    return driver
+
+def _quit(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
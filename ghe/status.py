@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import time
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ghe', 'status')
+
+
+class StatusCache(object):
+    """ Last known appliance status, kept in a local JSON file.
+
+    The file lives at ~/.ghe/status/<host>.json and maps a status name
+    (e.g. `maintenance`, `announce`) to its value and the time it was last
+    read from the GHE server, so dashboards and shell prompts can use it
+    without connecting to the appliance.
+    """
+
+    def __init__(self, host, path=None):
+        """ Initial setup. """
+
+        self.host = host
+        self.path = path or os.path.join(CACHE_DIR, '%s.json' % host)
+
+    def load(self):
+        """ Return the full cache contents, or an empty dict. """
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, name):
+        """ Return the cached entry for `name` as (value, updated). """
+
+        entry = self.load().get(name)
+        if not entry:
+            return None, None
+
+        return entry.get('value'), entry.get('updated')
+
+    def set(self, name, value, updated=None):
+        """ Store `value` for `name`, replacing the cache file atomically. """
+
+        data = self.load()
+        data[name] = {
+            'value': value,
+            'updated': updated or time.time()
+        }
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def format_time(ts):
+    """ Format a cache timestamp for display. """
+
+    if not ts:
+        return 'never'
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
@@ -0,0 +1,324 @@
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+METRIC = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+TYPE = re.compile(r'^# TYPE (\S+) (\S+)$')
+ESCAPE = re.compile(r'\\(.)')
+
+# Path segments kept verbatim when naming API endpoints; others are ids.
+ENDPOINT_SEGMENTS = set([
+    'orgs', 'repos', 'users', 'migrations', 'archive', 'lock', 'commits',
+    'branches', 'git', 'refs', 'issues', 'pulls', 'search', 'rate_limit',
+    'installations', 'access_tokens', 'app'
+])
+
+
+class Span(object):
+    """ A timed operation; `args` are exported with it. """
+
+    __slots__ = ('category', 'name', 'args', 'start', 'end', 'tid')
+
+    def __init__(self, category, name, args):
+        """ Initial setup. """
+
+        self.category = category
+        self.name = name
+        self.args = args
+        self.start = time.time()
+        self.end = None
+        self.tid = threading.current_thread().ident
+
+    def add(self, key, value):
+        """ Add `value` to a numeric argument such as `bytes`. """
+
+        self.args[key] = self.args.get(key, 0) + value
+
+    @property
+    def duration(self):
+        """ Duration in seconds. """
+
+        return (self.end or time.time()) - self.start
+
+
+class _SpanContext(object):
+    """ Context manager that records a span on the tracer when it exits. """
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+
+    def __enter__(self):
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.end = time.time()
+        if exc_type is not None:
+            self.span.args['error'] = exc_type.__name__
+        self.tracer.record(self.span)
+
+
+class Tracer(object):
+    """ Records spans and metrics and exports them when the process exits.
+
+    Tracing is enabled by pointing the `ghe-trace` environment variable (or
+    keyring entry) at an output file. A `.json` file receives Chrome trace
+    events (load it in chrome://tracing or Perfetto); anything else receives
+    OpenMetrics text. Every ghe process of a run appends to the same file:
+    trace events are appended, metrics are merged with the ones already in
+    the file.
+    """
+
+    def __init__(self, path=None, process=None):
+        """ Initial setup. """
+
+        self.path = path
+        self.process = process or os.path.basename(sys.argv[0] or 'ghe')
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.events = []
+        self.counters = {}
+        self.gauges = {}
+
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_env(cls):
+        """ Build a tracer from the `ghe-trace` environment variable. """
+
+        return cls(os.environ.get('ghe-trace') or None)
+
+    @property
+    def enabled(self):
+        """ Whether anything is being recorded. """
+
+        return bool(self.path)
+
+    def span(self, category, name, **args):
+        """ Time a block of code: `with tracer.span('ssh', cmd) as span:`. """
+
+        return _SpanContext(self, Span(category, name, args))
+
+    def record(self, span):
+        """ Store a finished span and fold it into the metrics. """
+
+        if not self.enabled:
+            return
+
+        labels = (('name', span.name),)
+        with self.lock:
+            self.events.append(span)
+            self._inc('ghe_%s_seconds_sum' % span.category, labels,
+                      span.duration)
+            self._inc('ghe_%s_seconds_count' % span.category, labels, 1)
+            for key in ('bytes', 'retries'):
+                if span.args.get(key):
+                    self._inc('ghe_%s_%s_total' % (span.category, key),
+                              labels, span.args[key])
+            if 'error' in span.args:
+                self._inc('ghe_%s_errors_total' % span.category, labels, 1)
+
+    def count(self, name, value=1, **labels):
+        """ Increment a counter. """
+
+        if self.enabled:
+            with self.lock:
+                self._inc(name, tuple(sorted(labels.items())), value)
+
+    def gauge(self, name, value, **labels):
+        """ Set a gauge to its latest value. """
+
+        if self.enabled:
+            with self.lock:
+                self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe_response(self, res, *args, **kwargs):
+        """ requests response hook recording API calls and rate limits. """
+
+        if self.enabled:
+            end = time.time()
+            self.observe_api(
+                res.request.method, res.request.url, res.status_code,
+                res.headers, end - res.elapsed.total_seconds(), end
+            )
+
+        return res
+
+    def observe_api(self, method, url, status, headers, start, end):
+        """ Record an API call and the rate limit it reported. """
+
+        if not self.enabled:
+            return
+
+        span = Span('api', '%s %s' % (method, endpoint(url)), {
+            'status': status,
+            'bytes': int(headers.get('Content-Length') or 0)
+        })
+        span.start = start
+        span.end = end
+        self.record(span)
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.gauge('ghe_api_ratelimit_remaining', int(remaining))
+        self.count('ghe_api_responses_total', status=str(status))
+
+    def instrument(self, session):
+        """ Record every request made through a requests session. """
+
+        session.hooks.setdefault('response', []).append(
+            self.observe_response
+        )
+
+        return session
+
+    def _inc(self, name, labels, value):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def flush(self):
+        """ Export everything recorded so far and start afresh. """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            events, self.events = self.events, []
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+
+        if not (events or counters or gauges):
+            return
+
+        with open(self.path, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            if self.path.endswith('.json'):
+                self._write_trace(f, events)
+            else:
+                self._write_metrics(f, counters, gauges)
+
+    def _write_trace(self, f, events):
+        """ Append events in the Chrome trace JSON array format. """
+
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            f.write('[\n')
+
+        lines = [json.dumps({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': '%s (%d)' % (self.process, self.pid)}
+        }, sort_keys=True)]
+        for span in events:
+            lines.append(json.dumps({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': self.pid,
+                'tid': span.tid,
+                'args': span.args
+            }, sort_keys=True, default=str))
+
+        f.write(',\n'.join(lines) + ',\n')
+
+    def _write_metrics(self, f, counters, gauges):
+        """ Merge metrics with the file contents and rewrite it. """
+
+        f.seek(0)
+        kind = None
+        for line in f:
+            line = line.strip()
+            match = TYPE.match(line)
+            if match:
+                kind = match.group(2)
+                continue
+            match = METRIC.match(line)
+            if not match:
+                continue
+            name, labels, value = match.groups()
+            key = (name, tuple(
+                (k, _unescape(v)) for k, v in LABEL.findall(labels or '')
+            ))
+            if kind == 'gauge':
+                gauges.setdefault(key, float(value))
+            else:
+                counters[key] = counters.get(key, 0) + float(value)
+
+        families = {}
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in metrics.items():
+                family = re.sub(r'_(total|sum|count)$', '', name)
+                if kind == 'counter' and name.endswith(('_sum', '_count')):
+                    kind_ = 'summary'
+                else:
+                    kind_ = kind
+                families.setdefault((family, kind_), []).append(
+                    (name, labels, value)
+                )
+
+        out = []
+        for (family, kind), samples in sorted(families.items()):
+            out.append('# TYPE %s %s' % (family, kind))
+            for name, labels, value in sorted(samples):
+                label = ','.join(
+                    '%s="%s"' % (k, _escape(str(v)))
+                    for k, v in labels
+                )
+                out.append('%s%s %s' % (
+                    name, '{%s}' % label if label else '', _number(value)
+                ))
+        out.append('# EOF')
+
+        f.seek(0)
+        f.truncate()
+        f.write('\n'.join(out) + '\n')
+
+
+def endpoint(url):
+    """ Name an API URL by its path with ids replaced, e.g. `/orgs/:/repos`. """
+
+    path = url.split('://', 1)[-1].split('/', 1)[-1].split('?', 1)[0]
+    parts = [p for p in path.split('/') if p]
+    if parts[:2] == ['api', 'v3']:
+        parts = parts[2:]
+
+    return '/' + '/'.join(p if p in ENDPOINT_SEGMENTS else ':' for p in parts)
+
+
+def _escape(value):
+    """ Escape a label value as OpenMetrics requires. """
+
+    return value.replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+def _unescape(value):
+    """ Read back a label value escaped by _escape. """
+
+    return ESCAPE.sub(
+        lambda m: '\n' if m.group(1) == 'n' else m.group(1), value
+    )
+
+def _number(value):
+    """ Format a sample value without a needless fraction. """
+
+    if float(value).is_integer():
+        return '%d' % value
+
+    return '%.6f' % value
+
+
+tracer = Tracer.from_env()
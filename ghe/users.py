@@ -0,0 +1,267 @@
+import csv
+import os
+import sqlite3
+import time
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.ghe', 'users')
+
+# Commands acting on one user, and the position of the login among their
+# arguments once options are left out.
+USER_ARGS = {'delete-user': 0, 'reset-user-email': 0}
+
+# Options of those commands that take a value.
+VALUE_OPTIONS = ('-ghe-host', '-ghe-user', '-ghe-pass', '-ghe-totp')
+
+# An index refreshed longer ago than this is not trusted to say that a user
+# does not exist, as the user may have signed up since.
+MAX_AGE = 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    login TEXT PRIMARY KEY COLLATE NOCASE,
+    id INTEGER,
+    email TEXT COLLATE NOCASE,
+    role TEXT,
+    suspended INTEGER NOT NULL DEFAULT 0,
+    seen REAL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_id ON users (id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+def user_arg(cmd, words):
+    """ The login in the arguments of a USER_ARGS command, or None. """
+
+    position = USER_ARGS.get(cmd)
+    if position is None:
+        return None
+
+    values = []
+    skip = False
+    for word in words:
+        if skip:
+            skip = False
+        elif word in VALUE_OPTIONS:
+            skip = True
+        elif not word.startswith('-'):
+            values.append(word)
+
+    return values[position] if len(values) > position else None
+
+
+class UserIndex(object):
+    """ Local SQLite index of the users on a GHE server.
+
+    The index lives at ~/.ghe/users/<host>.db. It is loaded in bulk from
+    `ghe-user-csv` and topped up with users created since, from the admin
+    API, so commands and scripts can check logins and the shell can complete
+    them without a round trip to the appliance.
+    """
+
+    def __init__(self, host, path=None):
+        """ Initial setup. """
+
+        self.host = host
+        self.path = path or os.path.join(INDEX_DIR, '%s.db' % host)
+        self._db = None
+
+    @property
+    def db(self):
+        """ The SQLite connection, opened and set up on first use. """
+
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path)
+            self._db.row_factory = sqlite3.Row
+            self._db.executescript(SCHEMA)
+
+        return self._db
+
+    def close(self):
+        """ Close the SQLite connection. """
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def meta(self, key, default=None):
+        """ Return a stored setting such as `refreshed` or `since`. """
+
+        row = self.db.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)
+        ).fetchone()
+
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, str(value))
+        )
+
+    @property
+    def refreshed(self):
+        """ When the index was last loaded or topped up, or None. """
+
+        if not os.path.exists(self.path):
+            return None
+
+        value = self.meta('refreshed')
+
+        return float(value) if value else None
+
+    def fresh(self, max_age=MAX_AGE):
+        """ Whether the index is recent enough to rule users out. """
+
+        refreshed = self.refreshed
+
+        return refreshed is not None and time.time() - refreshed < max_age
+
+    def load_csv(self, lines):
+        """ Replace the index with the output of `ghe-user-csv -o`.
+
+        Rows are read as they arrive; users missing from the output are
+        removed. The highest user id becomes `since`, so an incremental
+        update picks up where the export ended. Returns the number of users
+        loaded.
+        """
+
+        stamp = time.time()
+        reader = csv.reader(lines)
+        header = [name.strip().lower() for name in next(reader, [])]
+
+        count = 0
+        since = None
+        with self.db:
+            for row in reader:
+                record = dict(zip(header, row))
+                if not record.get('login'):
+                    continue
+                suspended = (
+                    record.get('suspension_status') or
+                    record.get('suspended') or ''
+                ).strip().lower()
+                fields = {
+                    'email': (record.get('email') or '').strip() or None,
+                    'role': (record.get('role') or '').strip() or None,
+                    'suspended': int(
+                        suspended in ('suspended', 'true', 'yes', '1')
+                    ),
+                    'seen': stamp
+                }
+                if (record.get('id') or '').strip().isdigit():
+                    fields['id'] = int(record['id'])
+                    since = max(since or 0, fields['id'])
+                self._upsert(record['login'].strip(), fields)
+                count += 1
+            self.db.execute('DELETE FROM users WHERE seen < ?', (stamp,))
+            if since is not None:
+                self._set_meta('since', since)
+            self._set_meta('refreshed', stamp)
+
+        return count
+
+    def add_users(self, users):
+        """ Add user objects from the admin API's `/users` listing.
+
+        Existing users keep their email address. Returns the number of
+        users added or updated.
+        """
+
+        stamp = time.time()
+        since = self.since
+
+        count = 0
+        with self.db:
+            for user in users:
+                if user.get('type', 'User') != 'User':
+                    continue
+                self._upsert(user['login'], {'id': user['id'], 'seen': stamp})
+                since = max(since, user['id'])
+                count += 1
+            self._set_meta('since', since)
+            self._set_meta('refreshed', stamp)
+
+        return count
+
+    def _upsert(self, login, fields):
+        # UPDATE then INSERT rather than an UPSERT clause, which older
+        # SQLite releases lack.
+        names = sorted(fields)
+        values = [fields[name] for name in names]
+        updated = self.db.execute(
+            'UPDATE users SET %s WHERE login = ?' % ', '.join(
+                '%s = ?' % name for name in names
+            ), values + [login]
+        ).rowcount
+        if not updated:
+            self.db.execute(
+                'INSERT INTO users (login, %s) VALUES (?%s)' % (
+                    ', '.join(names), ', ?' * len(names)
+                ), [login] + values
+            )
+
+    @property
+    def since(self):
+        """ The highest user id seen in the admin API listing. """
+
+        return int(self.meta('since') or 0)
+
+    def get(self, login):
+        """ Return a user as a dict, or None if the index lacks it. """
+
+        row = self.db.execute(
+            'SELECT login, id, email, role, suspended FROM users '
+            'WHERE login = ?', (login,)
+        ).fetchone()
+
+        return dict(zip(row.keys(), row)) if row else None
+
+    def exists(self, login):
+        """ Whether the index has a user. """
+
+        return self.db.execute(
+            'SELECT 1 FROM users WHERE login = ?', (login,)
+        ).fetchone() is not None
+
+    def rules_out(self, login):
+        """ Whether the index is fresh and does not have a user. """
+
+        return self.fresh() and not self.exists(login)
+
+    def missing(self, logins):
+        """ Return the logins the index does not have. """
+
+        return [login for login in logins if not self.exists(login)]
+
+    def by_email(self, email):
+        """ Return the login using an email address, or None. """
+
+        row = self.db.execute(
+            'SELECT login FROM users WHERE email = ?', (email,)
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def logins(self, prefix='', limit=200):
+        """ Return logins starting with `prefix`, in order. """
+
+        if not os.path.exists(self.path):
+            return []
+
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+
+        return [row[0] for row in self.db.execute(
+            "SELECT login FROM users WHERE login LIKE ? ESCAPE '\\' "
+            'ORDER BY login LIMIT ?', (escaped + '%', limit)
+        )]
+
+    def count(self):
+        """ Number of users in the index. """
+
+        return self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
@@ -0,0 +1,128 @@
+import threading
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from .mirror import diff_refs
+from .trace import tracer
+
+# What is compared between a source repository and its migrated copy. The
+# issue and pull request totals are None when they were not counted.
+RepoState = namedtuple('RepoState', ['head', 'refs', 'issues', 'pulls'])
+
+
+def compare(source, dest, refs=True):
+    """ Describe how a migrated repository differs from its source.
+
+    Returns a list of problems; an empty list means the copy matches.
+    Without `refs`, the default branch and refs are not compared.
+    """
+
+    problems = _compare_refs(source, dest) if refs else []
+
+    for name in ('issues', 'pulls'):
+        expected = getattr(source, name)
+        found = getattr(dest, name)
+        if expected is not None and found != expected:
+            problems.append('%s %s, expected %s' % (
+                found, 'pull requests' if name == 'pulls' else name, expected
+            ))
+
+    return problems
+
+def _compare_refs(source, dest):
+    problems = []
+
+    if source.head != dest.head:
+        problems.append('default branch is %s, expected %s' % (
+            _short(dest.head), _short(source.head)
+        ))
+    elif source.head and \
+            source.refs.get(source.head) != dest.refs.get(source.head):
+        problems.append('%s is at %s, expected %s' % (
+            _short(source.head),
+            (dest.refs.get(source.head) or 'nothing')[:7],
+            (source.refs.get(source.head) or 'nothing')[:7]
+        ))
+
+    missing, extra, changed = diff_refs(source.refs, dest.refs)
+    if missing or extra or changed:
+        problems.append('%d refs, expected %d (%d missing, %d extra, %d '
+                        'changed)' % (len(dest.refs), len(source.refs),
+                                      len(missing), len(extra), len(changed)))
+
+    return problems
+
+def _short(ref):
+    return ref[len('refs/heads/'):] if ref and \
+        ref.startswith('refs/heads/') else ref or 'none'
+
+
+class Verifier(object):
+    """ Checks migrated repositories in the background.
+
+    Repositories are checked by up to `workers` threads, so verifying one
+    batch overlaps with exporting and importing the next. A repository that
+    fails its check, or cannot be checked, is queued again after `delay`
+    seconds (doubling each time), as GHE may still be settling after an
+    import; after `retries` more attempts it is reported as failed.
+    """
+
+    def __init__(self, workers=4, retries=3, delay=30):
+        """ Initial setup. """
+
+        self.pool = ThreadPool(max(1, workers))
+        self.retries = retries
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.failed = {}
+        self.verified = 0
+
+    def submit(self, check, repos):
+        """ Queue repositories for `check`, which returns their problems. """
+
+        with self.cond:
+            self.pending += len(repos)
+        for repo in repos:
+            self._queue(check, repo, 0)
+
+    def _queue(self, check, repo, attempt):
+        self.pool.apply_async(self._check, (check, repo, attempt))
+
+    def _check(self, check, repo, attempt):
+        with tracer.span('verify', 'repo', repo=repo, attempt=attempt):
+            try:
+                problems = check(repo)
+            except Exception as err:
+                problems = ['unable to check: %s' % err]
+
+        if problems and attempt < self.retries:
+            delay = self.delay * 2 ** attempt
+            print('Verifying %s: %s; checking again in %ds.' % (
+                repo, '; '.join(problems), delay
+            ))
+            timer = threading.Timer(
+                delay, self._queue, (check, repo, attempt + 1)
+            )
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self.cond:
+            if problems:
+                print('Verifying %s failed: %s' % (repo, '; '.join(problems)))
+                self.failed[repo] = problems
+            else:
+                self.verified += 1
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def wait(self):
+        """ Wait for every queued check; return {repo: problems}. """
+
+        with self.cond:
+            while self.pending:
+                self.cond.wait(1)
+
+        return dict(self.failed)
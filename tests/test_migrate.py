@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+import pytest
+
+
+def load_command(name):
+    """ Import a `ghe-<name>.py` command script as a module. """
+
+    loader = SourceFileLoader('ghe_%s' % name.replace('-', '_'), os.path.join(
+        os.path.dirname(__file__), '..', 'ghe', 'commands', 'ghe-%s.py' % name
+    ))
+    module = module_from_spec(spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+
+    return module
+
+ghe_migrate = load_command('migrate')
+
+
+class Admit(object):
+
+    @contextmanager
+    def admit(self, stage):
+        yield
+
+
+def test_import_stage_is_timed():
+    """ The import stage is recorded with the time it took, not 0s. """
+
+    def iter_batch(cmds, job=None, stop=False):
+        time.sleep(0.2)
+        for index in range(len(cmds)):
+            yield index, None, 0
+
+    app = object.__new__(ghe_migrate.Migrate)
+    app.ghe_user = 'admin'
+    app.ghe_token = 'token'
+    app.backpressure = Admit()
+    app.slots = threading.Semaphore(0)
+    app.verifier = None
+    app.iter_batch = iter_batch
+    app.download_archive = app.prepare_migration = \
+        app.resolve_conflicts = lambda job: None
+
+    recorded = {}
+    app.record = lambda stage, seconds, job: recorded.update({stage: seconds})
+
+    job = ghe_migrate.MigrationJob(1, ['org/repo'])
+    app.migrate(job)
+
+    assert job.error is None
+    assert job.stage == 'complete'
+    assert recorded['import'] >= 0.2
+
+def test_failed_import_unlocks():
+    """ A failed import still unlocks the repositories of its batch. """
+
+    ran = []
+
+    def iter_batch(cmds, job=None, stop=False):
+        for index, cmd in enumerate(cmds):
+            ran.append(cmd.split(' -')[0])
+            status = 1 if cmd.startswith('ghe-migrator import') else 0
+            yield index, None, status
+            if stop and status:
+                return
+
+    app = object.__new__(ghe_migrate.Migrate)
+    app.ghe_user = 'admin'
+    app.ghe_token = 'token'
+    app.iter_batch = iter_batch
+
+    job = ghe_migrate.MigrationJob(1, ['org/repo'])
+    job.guid = 'guid'
+    with pytest.raises(ghe_migrate.MigrationError):
+        app.import_migration(job)
+
+    assert ran == ['ghe-migrator import %s' % job.archive,
+                   'ghe-migrator unlock']
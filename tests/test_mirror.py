@@ -0,0 +1,30 @@
+import os
+import subprocess
+
+from ghe.mirror import MirrorCache
+
+
+def make_repo(path):
+    """ Create a repository at `path` with one commit on master. """
+
+    subprocess.check_call(['git', 'init', '--quiet', path])
+    subprocess.check_call(['git', '-C', path, '-c', 'user.name=ghe', '-c',
+                           'user.email=ghe@example.com', 'commit', '--quiet',
+                           '--allow-empty', '-m', 'initial'])
+
+def test_fetch_all_keeps_the_batch(tmpdir):
+    """ Over quota, fetching a batch never evicts a mirror of that batch. """
+
+    urls = []
+    for name in ('one', 'two', 'three'):
+        path = str(tmpdir.join('src', name))
+        make_repo(path)
+        urls.append(path)
+
+    mirrors = MirrorCache(str(tmpdir.join('mirrors')), quota=1)
+    fetched = mirrors.fetch_all(urls, workers=1)
+
+    for url in urls:
+        assert fetched[url] == mirrors.path(url)
+        assert os.path.isdir(fetched[url])
+        assert len(mirrors.refs(url)) == 1
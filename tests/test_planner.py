@@ -0,0 +1,21 @@
+from ghe.inventory import RepoInfo
+from ghe.planner import plan_batches
+
+
+def names(batches):
+    return [[repo.full_name for repo in batch] for batch in batches]
+
+def test_archived_repos_are_batched_last():
+    """ Archived repos get batches of their own after the active ones. """
+
+    repos = [
+        RepoInfo('org/a', 10),
+        RepoInfo('org/b', 20, archived=True),
+        RepoInfo('org/c', 5),
+        RepoInfo('org/d', 1, archived=True)
+    ]
+
+    assert names(plan_batches(repos, limit=3)) == \
+        [['org/a', 'org/c'], ['org/b', 'org/d']]
+    assert names(plan_batches(repos, budget=1024 ** 3, limit=3)) == \
+        [['org/a', 'org/c'], ['org/b', 'org/d']]
@@ -0,0 +1,17 @@
+from ghe import ssh
+
+
+def test_watch_reports_every_poll(monkeypatch):
+    """ Every poll is reported to `on_poll`; only changes to `on_change`. """
+
+    runs = [['off'], ['off'], ['on'], ['on']]
+    monkeypatch.setattr(ssh, 'poll', lambda client, cmd, interval: iter(runs))
+
+    polled = []
+    changed = []
+    ssh.watch(None, 'status', 1, lambda lines: lines[0],
+              lambda value, last, ts: changed.append((value, last)),
+              lambda value, ts: polled.append(value))
+
+    assert polled == ['off', 'off', 'on', 'on']
+    assert changed == [('off', None), ('on', 'off')]